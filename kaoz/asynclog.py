@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+# This file is a part of Kaoz, a free irc notifier
+
+"""Logging helpers which keep slow handlers away from the hot path"""
+
+import logging
+import sys
+import threading
+
+if sys.version_info < (3,):
+    import Queue as queue
+else:
+    import queue
+
+# Formatter of the exceptions of queued records
+_formatter = logging.Formatter()
+
+
+class ThreadedHandler(logging.Handler):
+    """Handler which delivers records to other handlers from its own thread
+
+    Emitting a record only puts it in a bounded queue, so that a slow handler
+    (like a syslog socket) never blocks the thread which logs. Records are
+    formatted before being queued, so that they don't change or keep objects
+    alive while they wait. When the queue is full, records are dropped, and
+    the next delivered record is preceded by a warning which counts them.
+    """
+
+    def __init__(self, handlers, queue_size=10000):
+        super(ThreadedHandler, self).__init__()
+        self._handlers = list(handlers)
+        self._queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def prepare(self, record):
+        """Merge the arguments and the exception of a record into its text"""
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _formatter.formatException(record.exc_info)
+            # Its traceback keeps every frame alive
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _deliver(self, record):
+        """Give a record to the underlying handlers"""
+        for handler in self._handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _run(self):
+        """Deliver queued records until None is received"""
+        reported = 0
+        while True:
+            record = self._queue.get()
+            dropped = self.dropped - reported
+            if dropped:
+                reported += dropped
+                self._deliver(logging.LogRecord(
+                    __name__, logging.WARNING, __file__, 0,
+                    "%d log records dropped, the logging queue was full",
+                    (dropped,), None))
+            if record is None:
+                break
+            self._deliver(record)
+
+    def close(self):
+        """Flush pending records and close underlying handlers"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(5)
+        for handler in self._handlers:
+            handler.close()
+        super(ThreadedHandler, self).close()
+
+
+class RateLimitFilter(logging.Filter):
+    """Let at most rate records with the same format pass each period
+
+    Records are grouped by logger name and unformatted message, which is why
+    hot paths have to use lazy formatting (logger.info("%s", arg)). The first
+    record which passes after some were suppressed tells how many were lost.
+    """
+
+    # Forget every key when there are too many of them, as eagerly formatted
+    # messages produce a key per record
+    max_keys = 1000
+
+    def __init__(self, rate, period=1.0):
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self.period = period
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.rate:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or record.created - window[0] >= self.period:
+                if window is None and len(self._windows) >= self.max_keys:
+                    self._windows.clear()
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [record.created, 1, 0]
+                if suppressed:
+                    record.msg = "%s [%d similar messages suppressed]" % (
+                        record.msg, suppressed)
+                return True
+            if window[1] < self.rate:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
@@ -9,17 +9,22 @@ import logging
 import logging.handlers
 import optparse
 import os
+import signal
 import sys
 import threading
 
 import kaoz
+from kaoz import asynclog
 from kaoz import publishbot
 from kaoz import listener
+from kaoz import httplistener
 
 if sys.version_info < (3,):
     from ConfigParser import SafeConfigParser as ConfigParser
+    from ConfigParser import Error as ConfigError
 else:
     from configparser import ConfigParser
+    from configparser import Error as ConfigError
 
 
 logger = logging.getLogger(__name__)
@@ -31,24 +36,205 @@ def get_default_config():
     """Build a ConfigParser object with the default configuration"""
     # Do not use the defaults argument of ConfigParser as it applies to all
     # sections
+    # The type of an option is the one of its default value, which check_config
+    # relies on: floats are written with a decimal point
     config = ConfigParser()
     config.add_section('irc')
     config.set('irc', 'server_password', '')
     config.set('irc', 'ssl', 'false')
+    config.set('irc', 'alternate_servers', '')
     config.set('irc', 'reconnection_interval', '60')
-    config.set('irc', 'line_sleep', '1')
+    config.set('irc', 'reconnection_delay', '1.0')
+    config.set('irc', 'line_sleep', '1.0')
     config.set('irc', 'fallback_channel', '')
     config.set('irc', 'max_join_attempts', '10')
     config.set('irc', 'memory_timeout', '3600')
     config.set('irc', 'channel_maxlen', '100')
+    config.set('irc', 'backlog_high_watermark', '0')
+    config.set('irc', 'backlog_low_watermark', '0')
+    config.set('irc', 'channel_backlog_high_watermark', '0')
+    config.set('irc', 'channel_backlog_low_watermark', '0')
+    config.set('irc', 'message_index_size', '10000')
+    config.set('irc', 'message_index_timeout', '3600')
+    config.set('irc', 'max_channels', '0')
+    config.set('irc', 'max_queued_bytes', '0')
+    config.set('irc', 'latency_channels', '10')
+    config.set('irc', 'message_ttl', '0')
+    config.set('irc', 'digest_threshold', '0')
+    config.set('irc', 'digest_interval', '60')
+    config.set('irc', 'digest_lines', '5')
+    config.set('irc', 'drain_timeout', '10')
+    config.set('irc', 'drain_line_sleep', '0.5')
+    config.set('irc', 'drain_file', '')
+    config.set('irc', 'schedule_file', '')
+    config.set('irc', 'adaptive_rate', 'false')
+    config.set('irc', 'min_line_sleep', '0.5')
+    config.set('irc', 'max_line_sleep', '4.0')
+    config.set('irc', 'rate_interval', '10')
+    config.set('irc', 'rate_increase', '0.1')
+    config.set('irc', 'auto_replies', 'true')
+    config.set('irc', 'reply_burst', '3')
+    config.set('irc', 'reply_interval', '60')
     config.add_section('listener')
     config.set('listener', 'host', '')
     config.set('listener', 'ssl', 'false')
     config.set('listener', 'ssl_cert', '')
+    config.set('listener', 'ssl_key', '')
+    config.set('listener', 'backpressure', 'block')
+    config.set('listener', 'workers', '0')
+    config.set('listener', 'max_connections', '0')
+    config.set('listener', 'max_connections_per_ip', '0')
+    config.set('listener', 'idle_timeout', '0')
+    config.set('listener', 'handshake_timeout', '10')
+    config.set('listener', 'max_line_length', '65536')
+    config.add_section('http')
+    config.set('http', 'host', '')
+    config.set('http', 'port', '0')
+    config.set('http', 'token', '')
+    config.set('http', 'idle_timeout', '60')
+    config.add_section('routing')
+    config.add_section('schedules')
+    config.add_section('profiling')
+    config.set('profiling', 'directory', '')
+    config.set('profiling', 'max_duration', '300')
+    config.set('profiling', 'interval', '0.01')
+    config.set('profiling', 'top', '20')
     config.add_section('automessages')
+    config.add_section('message_ttl')
+    config.add_section('logging')
+    config.set('logging', 'threaded', 'false')
+    config.set('logging', 'queue_size', '10000')
+    config.set('logging', 'rate_limit', '0')
     return config
 
 
+def setup_logging(config, loglevel, logstd):
+    """Configure the root logger according to the configuration"""
+    if logstd:
+        log_handler = logging.StreamHandler()
+        log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    else:
+        log_handler = logging.handlers.SysLogHandler(
+            '/dev/log',
+            facility=logging.handlers.SysLogHandler.LOG_DAEMON)
+        log_handler.setFormatter(logging.Formatter(
+            ('kaoz[%d]: ' % os.getpid()) +
+            '[%(levelname)s] %(name)s: %(message)s'))
+
+    # Write records from a dedicated thread so that the IRC reactor and the
+    # listener never wait for syslog
+    if config.getboolean('logging', 'threaded'):
+        log_handler = asynclog.ThreadedHandler(
+            [log_handler], config.getint('logging', 'queue_size'))
+
+    rate_limit = config.getint('logging', 'rate_limit')
+    if rate_limit:
+        log_handler.addFilter(asynclog.RateLimitFilter(rate_limit))
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(loglevel)
+    root_logger.addHandler(log_handler)
+
+
+def check_config(config):
+    """Read every option of a configuration with the type of its default
+    value, and raise ValueError or ConfigError if one is not valid
+    """
+    defaults = get_default_config()
+    for section in config.sections():
+        for name in config.options(section):
+            default = None
+            if defaults.has_option(section, name):
+                default = defaults.get(section, name)
+            if section == 'message_ttl' or (default or 'x').isdigit():
+                config.getint(section, name)
+            elif default in ('true', 'false'):
+                config.getboolean(section, name)
+            elif default is not None and default.replace('.', '', 1).isdigit():
+                config.getfloat(section, name)
+            else:
+                config.get(section, name)
+
+
+def reload_config(filename, config, publisher, listeners):
+    """Read the configuration file again and apply it to running threads
+
+    Nothing is applied if the new configuration is not valid, and ValueError
+    is raised. Once applied, config is updated, except for the logging
+    section which needs a restart.
+
+    Return the names of the options which changed but need a restart to be
+    applied.
+    """
+    logger.info("reloading configuration from %s", filename)
+    new_config = get_default_config()
+    try:
+        new_config.read(filename)
+        check_config(new_config)
+    except (ValueError, ConfigError) as e:
+        logger.error("Invalid configuration, not reloaded: %s", e)
+        raise ValueError(str(e))
+    not_applied = publisher.reload(new_config)
+    for thread in listeners:
+        not_applied += thread.reload(new_config)
+    not_applied += ['logging.' + name
+                    for name in new_config.options('logging')
+                    if new_config.get('logging', name) !=
+                    config.get('logging', name)]
+    for option in not_applied:
+        logger.warning("option %s changed, restart to apply it", option)
+    for section in new_config.sections():
+        if section == 'logging':
+            continue
+        config.remove_section(section)
+        config.add_section(section)
+        for name in new_config.options(section):
+            config.set(section, name, new_config.get(section, name, raw=True))
+    return not_applied
+
+
+def on_sighup(filename, config, publisher, listeners):
+    """Reload the configuration, an invalid one being only logged"""
+    try:
+        reload_config(filename, config, publisher, listeners)
+    except ValueError:
+        pass
+
+
+def shutdown(config, publisher, listeners, notify_systemd=False):
+    """Stop listening, say waiting messages and stop the publisher
+
+    Lines which could not be said before drain_timeout are counted in the
+    log, and written to drain_file if it is configured.
+    """
+    logger.info("shutting down")
+    if notify_systemd:
+        publishbot.send_systemd_notification(b'STOPPING=1\n')
+    for thread in listeners:
+        thread.stop()
+    publisher.drain(config.getint('irc', 'drain_timeout'))
+    publisher.stop()
+    publisher.save_schedules()
+
+    lines = publisher.waiting_lines()
+    if not lines:
+        return
+    counts = dict()
+    for (channel, message) in lines:
+        counts[channel] = counts.get(channel, 0) + 1
+    logger.warning("%d lines could not be said before shutdown: %s",
+                   len(lines), ', '.join(
+                       '%d on %s' % (count, channel)
+                       for (channel, count) in sorted(counts.items())))
+    drain_file = config.get('irc', 'drain_file')
+    if drain_file:
+        # Use the listener format so that lines may be sent again
+        with open(drain_file, 'ab') as f:
+            for (channel, message) in lines:
+                f.write(('%s:%s\n' % (channel, message)).encode('utf-8'))
+        logger.info("waiting lines written to %s", drain_file)
+
+
 def main(argv):
     """Start bot threads"""
     # Parse command line
@@ -71,25 +257,14 @@ def main(argv):
 
     opts, argv = parser.parse_args(argv)
 
-    # Setup logging
-    loglevel = logging.DEBUG if opts.debug else logging.INFO
-    if opts.logstd:
-        logging.basicConfig(level=loglevel)
-    else:
-        log_handler = logging.handlers.SysLogHandler(
-            '/dev/log',
-            facility=logging.handlers.SysLogHandler.LOG_DAEMON)
-        log_handler.setFormatter(logging.Formatter(
-            ('kaoz[%d]: ' % os.getpid()) +
-            '[%(levelname)s] %(name)s: %(message)s'))
-        root_logger = logging.getLogger()
-        root_logger.setLevel(loglevel)
-        root_logger.addHandler(log_handler)
-
     # Read configuration
     config = get_default_config()
     config.read(opts.config)
 
+    # Setup logging
+    loglevel = logging.DEBUG if opts.debug else logging.INFO
+    setup_logging(config, loglevel, opts.logstd)
+
     # Test wether the configuration gives a good server
     if config.get('irc', 'server').endswith('example.org'):
         logger.fatal(
@@ -102,11 +277,29 @@ def main(argv):
                                            debug=opts.debug,
                                            notify_systemd=opts.notify_systemd)
     publisher.daemon = True
-    tcplistener = listener.TCPListener(publisher, config, event=event)
-    tcplistener.daemon = True
+    listeners = [listener.TCPListener(
+        publisher, config, event=event,
+        reload_config=lambda: reload_config(opts.config, config, publisher,
+                                            listeners))]
+    if config.getint('http', 'port'):
+        listeners.append(httplistener.HTTPListener(
+            publisher, config, event=event))
     publisher.start()
-    tcplistener.start()
+    for thread in listeners:
+        thread.daemon = True
+        thread.start()
+
+    # Reload configuration on SIGHUP, and drain messages on SIGTERM
+    signal.signal(signal.SIGHUP, lambda signum, frame: on_sighup(
+        opts.config, config, publisher, listeners))
+    terminate = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: terminate.set())
 
-    # Wait everybody to end, which means error
-    event.wait()
+    # Wait everybody to end, which means error, or a termination request
+    # Use a timeout so that signals get processed
+    while not event.is_set() and not terminate.is_set():
+        event.wait(1)
+    if terminate.is_set():
+        shutdown(config, publisher, listeners, opts.notify_systemd)
+        sys.exit(0)
     sys.exit(1)
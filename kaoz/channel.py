@@ -4,11 +4,41 @@
 
 # This file is a part of Kaoz, a free irc notifier
 
+import collections
 import datetime
+import re
+import sys
+import threading
+import time
 
 # Useful function to differentiate nick and channel names
 from irc.client import is_channel
 
+import kaoz.message
+
+if sys.version_info < (3,):
+    def intern(string):
+        """Builtin intern() doesn't accept unicode strings"""
+        return string
+else:
+    intern = sys.intern
+
+
+def _translation_table(upper, lower):
+    """Build a table for unicode.translate and str.translate"""
+    return dict(zip([ord(c) for c in upper], [ord(c) for c in lower]))
+
+
+_UPPER = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_LOWER = 'abcdefghijklmnopqrstuvwxyz'
+
+# Translation tables of the casemappings defined in RPL_ISUPPORT
+CASEMAPPINGS = {
+    'ascii': _translation_table(_UPPER, _LOWER),
+    'rfc1459': _translation_table(_UPPER + '[]\\~', _LOWER + '{}|^'),
+    'strict-rfc1459': _translation_table(_UPPER + '[]\\', _LOWER + '{}|'),
+}
+
 
 class ChanStatus(object):
     """A simple structure which holds information about a channel
@@ -16,17 +46,37 @@ class ChanStatus(object):
     Note that this structure is not thread-safe
     """
 
-    def __init__(self, name):
+    __slots__ = ('name', 'key', 'messages', '_is_joined', '_join_attempts',
+                 '_last_join_attempt', 'digest', 'joined_at', 'expired')
+
+    def __init__(self, name, key=None):
         self.name = name
-        self.messages = list()
+        # Normalized name, which identifies the channel
+        self.key = key or name
+        self.messages = kaoz.message.LineQueue()
         self._is_joined = False
         self._join_attempts = 0
         self._last_join_attempt = None
+        # Digest of the messages which were not queued, in digest mode
+        self.digest = None
+        # Time at which the channel was last joined
+        self.joined_at = None
+        # Number of messages counted by the last summary of expired messages
+        self.expired = 0
 
     def need_join(self):
         """Return True if this channel needs to be joined"""
         return is_channel(self.name) and not self._is_joined
 
+    def is_joined(self):
+        """Return True if this channel has been joined"""
+        return self._is_joined
+
+    def is_blocked(self, max_join_attempts=0):
+        """Return True if joining this channel failed too many times"""
+        return bool(max_join_attempts and not self._is_joined
+                    and self._join_attempts >= max_join_attempts)
+
     def inc_join_counter(self, max_join_attempts=0, memory_timeout=0):
         """Increase the join counter if possible
 
@@ -60,44 +110,191 @@ class ChanStatus(object):
         """Mark this channel as joined"""
         self._is_joined = True
         self._join_attempts = 0
+        self.joined_at = time.time()
+
+    def mark_left(self):
+        """Mark this channel as not joined anymore"""
+        self._is_joined = False
+
+
+class Digest(object):
+    """Count messages by template, to summarize them instead of saying them
+
+    The template of a message is its beginning, where numbers are replaced
+    by N, so that a template usually matches a source of messages.
+    """
+
+    _number_re = re.compile(r'[0-9]+')
+
+    def __init__(self, template_len=80, max_templates=1000):
+        self.template_len = template_len
+        self.max_templates = max_templates
+        self.counts = dict()
+        self.total = 0
+
+    def add(self, message):
+        """Count a message"""
+        template = self._number_re.sub('N', message[:self.template_len])
+        template = template[:self.template_len]
+        self.total += 1
+        if template in self.counts:
+            self.counts[template] += 1
+        elif len(self.counts) < self.max_templates:
+            self.counts[template] = 1
+
+    def summary(self, max_lines):
+        """Get summary lines, with the most frequent templates first"""
+        templates = sorted(self.counts.items(), key=lambda tc: -tc[1])
+        lines = ["[digest] %d x %s" % (count, template)
+                 for (template, count) in templates[:max_lines]]
+        others = self.total - sum(count for (template, count)
+                                  in templates[:max_lines])
+        if others:
+            lines.append("[digest] %d other messages" % others)
+        return lines
 
 
 class IndexedChanDict(dict):
     """Dictionary of ChanStatus with an index.
 
+    Channels are keyed by their name, normalized with the casemapping of the
+    server, so that #Chan and #chan are the same channel.
+
     The index is used when saying messages on IRC, to remember the next channel
-    to take into account.
+    to take into account. Channels which may be forgotten, because they are
+    idle or blocked, are also kept apart, the least recently used being
+    first.
     """
 
-    def __init__(self):
-        # channel name => ChanStatus mapping
+    def __init__(self, casemapping='rfc1459'):
+        # normalized channel name => ChanStatus mapping
         super(IndexedChanDict, self).__init__()
         # Ordered channel names, to be used when running a loop
         self._list = list()
+        # Names of the channels which may be forgotten, the least recently
+        # used being first. New channels have no lines yet.
+        self._idle = collections.OrderedDict()
+        # First character of channel names => number of joined channels
+        self._joined = dict()
+        self._table = CASEMAPPINGS[casemapping]
+
+    def normalize(self, channel):
+        """Get the key of a channel name. This is thread-safe."""
+        return intern(channel.translate(self._table))
+
+    def set_casemapping(self, casemapping):
+        """Change the casemapping, merging the channels which become equal
+
+        Return True if the casemapping changed.
+        """
+        table = CASEMAPPINGS[casemapping]
+        if table == self._table:
+            return False
+        self._table = table
+        statuses = [super(IndexedChanDict, self).__getitem__(key)
+                    for key in self._list]
+        idle = set(self._idle)
+        self.clear()
+        self._list = list()
+        self._idle = collections.OrderedDict()
+        for status in statuses:
+            key = self.normalize(status.name)
+            was_idle = status.key in idle
+            if key in self:
+                self[key].messages.extend(status.messages)
+            else:
+                status.key = key
+                self[key] = status
+            if not was_idle:
+                self.mark_busy(key)
+        self._joined = dict()
+        for status in self.values():
+            if status.is_joined():
+                self._count_joined(status, 1)
+        return True
+
+    def __contains__(self, channel):
+        return super(IndexedChanDict, self).__contains__(
+            self.normalize(channel))
 
     def __getitem__(self, channel):
         """Get a ChanStatus or create a new one if it does not exist"""
-        if channel not in self:
-            self[channel] = ChanStatus(channel)
-        return super(IndexedChanDict, self).__getitem__(channel)
+        key = self.normalize(channel)
+        if not super(IndexedChanDict, self).__contains__(key):
+            self[key] = ChanStatus(channel, key)
+        return super(IndexedChanDict, self).__getitem__(key)
 
     def __setitem__(self, channel, status):
         """Set a specific ChanStatus"""
-        if channel not in self:
-            self._list.append(channel)
-        return super(IndexedChanDict, self).__setitem__(channel, status)
+        key = self.normalize(channel)
+        if not super(IndexedChanDict, self).__contains__(key):
+            self._list.append(key)
+            self._idle[key] = None
+        return super(IndexedChanDict, self).__setitem__(key, status)
 
     def __delitem__(self, channel):
         """Delete a channel status"""
-        super(IndexedChanDict, self).__delitem__(channel)
-        self._list.remove(channel)
+        key = self.normalize(channel)
+        status = super(IndexedChanDict, self).__getitem__(key)
+        if status.is_joined():
+            self._count_joined(status, -1)
+        super(IndexedChanDict, self).__delitem__(key)
+        self._list.remove(key)
+        self._idle.pop(key, None)
+
+    def _count_joined(self, status, increment):
+        """Account for a channel which was joined or left"""
+        prefix = status.name[:1]
+        self._joined[prefix] = self._joined.get(prefix, 0) + increment
+
+    def mark_idle(self, channel):
+        """Mark a channel as one which may be forgotten
+
+        A channel which already was keeps its place, otherwise it becomes
+        the most recently used one.
+        """
+        key = self.normalize(channel)
+        if key not in self._idle:
+            self._idle[key] = None
+
+    def mark_busy(self, channel):
+        """Mark a channel as one which must not be forgotten"""
+        self._idle.pop(self.normalize(channel), None)
+
+    def least_recent_idle(self):
+        """Get the least recently used ChanStatus which may be forgotten, or
+        None
+        """
+        for key in self._idle:
+            return super(IndexedChanDict, self).__getitem__(key)
+        return None
+
+    def idle_channels(self):
+        """Iterate over the ChanStatus which may be forgotten, the least
+        recently used being first
+
+        The dictionary must not be changed during the iteration, unless the
+        iteration stops right after.
+        """
+        for key in self._idle:
+            yield super(IndexedChanDict, self).__getitem__(key)
+
+    def mark_joined(self, channel):
+        """Mark a channel as joined"""
+        status = self[channel]
+        if not status.is_joined():
+            self._count_joined(status, 1)
+        status.mark_joined()
 
     def leave(self, channel):
         """Remove given channel due to a kick or a part"""
         if channel not in self:
             return
-        self[channel].is_joined = False
-        if not self[channel].messages:
+        status = self[channel]
+        if status.is_joined():
+            self._count_joined(status, -1)
+        status.mark_left()
+        if not status.messages and status.digest is None:
             del self[channel]
 
     def leave_all(self):
@@ -106,10 +303,130 @@ class IndexedChanDict(dict):
         for channel in list(self):
             self.leave(channel)
 
+    def count_joined(self, prefixes):
+        """Count joined channels whose name starts with one of prefixes"""
+        return sum(self._joined.get(prefix, 0) for prefix in prefixes)
+
     def find_waiting_channel(self):
         """Find a channel which has messages waiting to be sent, or None"""
-        for (i, channel) in enumerate(self._list):
-            if self[channel].messages:
+        for (i, key) in enumerate(self._list):
+            status = super(IndexedChanDict, self).__getitem__(key)
+            if status.messages:
                 self._list = self._list[(i + 1):] + self._list[0:i + 1]
-                return self[channel]
+                return status
         return None
+
+
+class Backlog(object):
+    """Thread-safe count of messages waiting to be sent, with watermarks
+
+    The backlog becomes busy when the number of waiting messages reaches the
+    high watermark, and stays so until it falls to the low watermark. This is
+    done both globally and for each channel. A zero high watermark disables
+    the corresponding limit, and a zero low watermark means half the high one.
+
+    The number of bytes of the waiting messages is also counted, in total.
+    """
+
+    def __init__(self, high=0, low=0, chan_high=0, chan_low=0):
+        self.total = 0
+        self.size = 0
+        self._counts = dict()
+        self._busy = False
+        self._busy_chans = set()
+        self._cond = threading.Condition()
+        self.set_watermarks(high, low, chan_high, chan_low)
+
+    def set_watermarks(self, high=0, low=0, chan_high=0, chan_low=0):
+        """Change the watermarks, and the busy states accordingly"""
+        with self._cond:
+            self.high = high
+            self.low = low or high // 2
+            self.chan_high = chan_high
+            self.chan_low = chan_low or chan_high // 2
+            if not self.high or self.total <= self.low:
+                self._busy = False
+            elif self.total >= self.high:
+                self._busy = True
+            for (channel, count) in self._counts.items():
+                if not self.chan_high or count <= self.chan_low:
+                    self._busy_chans.discard(channel)
+                elif count >= self.chan_high:
+                    self._busy_chans.add(channel)
+            self._cond.notify_all()
+
+    def add(self, channel, count=1, size=0):
+        """Account for count new messages of size bytes on channel"""
+        self.add_many({channel: count}, size)
+
+    def add_many(self, counts, size=0):
+        """Account for new messages, given as a channel => count dict, and
+        their size in bytes
+        """
+        with self._cond:
+            self.size += size
+            for (channel, count) in counts.items():
+                self.total += count
+                chan_count = self._counts.get(channel, 0) + count
+                self._counts[channel] = chan_count
+                if self.chan_high and chan_count >= self.chan_high:
+                    self._busy_chans.add(channel)
+            if self.high and self.total >= self.high:
+                self._busy = True
+
+    def remove(self, channel, count=1, size=0):
+        """Account for count messages of size bytes which left channel"""
+        with self._cond:
+            self.total -= count
+            self.size -= size
+            chan_count = self._counts.get(channel, 0) - count
+            if chan_count > 0:
+                self._counts[channel] = chan_count
+            else:
+                self._counts.pop(channel, None)
+            notify = False
+            if self._busy and self.total <= self.low:
+                self._busy = False
+                notify = True
+            if channel in self._busy_chans and chan_count <= self.chan_low:
+                self._busy_chans.discard(channel)
+                notify = True
+            if notify:
+                self._cond.notify_all()
+
+    def rekey(self, normalize):
+        """Merge the counts of channels which have the same normalized name"""
+        with self._cond:
+            counts = dict()
+            for (channel, count) in self._counts.items():
+                key = normalize(channel)
+                counts[key] = counts.get(key, 0) + count
+            self._counts = counts
+            self._busy_chans = set(normalize(channel)
+                                   for channel in self._busy_chans)
+
+    def count(self, channel):
+        """Number of messages waiting for a channel"""
+        return self._counts.get(channel, 0)
+
+    def is_busy(self, channel=None):
+        """Tell whether new messages for channel should be held back"""
+        return self._busy or channel in self._busy_chans
+
+    def excess(self, channel=None):
+        """Number of messages to be sent before channel stops being busy"""
+        with self._cond:
+            excess = 0
+            if self._busy:
+                excess = self.total - self.low
+            if channel in self._busy_chans:
+                excess = max(excess,
+                             self._counts.get(channel, 0) - self.chan_low)
+            return excess
+
+    def wait(self, channel=None, timeout=None):
+        """Wait until channel is not busy, return False on timeout"""
+        with self._cond:
+            if self.is_busy(channel):
+                self._cond.wait(timeout)
+            return not self.is_busy(channel)
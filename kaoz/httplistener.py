@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+# This file is a part of Kaoz, a free irc notifier
+
+"""HTTP endpoint which receives messages as JSON
+
+Clients POST a JSON array of {"channel": ..., "message": ..., "priority": ...}
+objects to /messages, with an "Authorization: Bearer <token>" header. The
+whole array is given to the publisher at once, and the reply is a JSON object
+with the identifiers of the messages, in the same order.
+"""
+
+import json
+import logging
+import sys
+import threading
+import traceback
+
+if sys.version_info < (3,):
+    import BaseHTTPServer as httpserver
+    import SocketServer as socketserver
+    text_type = unicode  # noqa
+else:
+    import http.server as httpserver
+    import socketserver
+    text_type = str
+
+import kaoz.listener
+
+logger = logging.getLogger(__name__)
+
+
+# Priorities of messages. High priority messages are accepted even when the
+# backlog is over its high watermark.
+PRIORITIES = ('low', 'normal', 'high')
+
+# Characters which would end an IRC line
+LINE_BREAKS = ('\r', '\n', '\0')
+
+
+class HTTPListenerHandler(httpserver.BaseHTTPRequestHandler):
+    """Handle the requests of an HTTP client
+
+    Connections are kept alive between requests, until the client closes them
+    or stays silent for idle_timeout seconds.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    # Maximum size of a request body
+    max_body_size = 1024 * 1024
+
+    def setup(self):
+        self.timeout = self.server.idle_timeout or None
+        httpserver.BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def reply(self, code, content, headers=()):
+        """Send a JSON reply"""
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def is_authorized(self):
+        """Check the bearer token of the request"""
+        header = self.headers.get('Authorization', '')
+        expected = 'Bearer ' + self.server.token
+        return kaoz.listener.compare_digest(header.encode('utf-8'),
+                                            expected.encode('utf-8'))
+
+    def do_POST(self):
+        # The body of rejected requests is not read, so the connection can't
+        # be used for another request
+        close = ('Connection', 'close')
+        if self.path != '/messages':
+            self.reply(404, {'error': "Not found"}, [close])
+            return
+        if not self.is_authorized():
+            self.reply(401, {'error': "Invalid token"},
+                       [('WWW-Authenticate', 'Bearer'), close])
+            return
+        length = self.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            self.reply(411, {'error': "Length required"}, [close])
+            return
+        if int(length) > self.max_body_size:
+            self.reply(413, {'error': "Request too large"}, [close])
+            return
+        body = self.rfile.read(int(length))
+        try:
+            messages = self.parse_messages(body.decode('utf-8'))
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+            return
+
+        # Hold the whole request back if a channel is busy, so that clients
+        # may send it again as is
+        publisher = self.server.publisher
+        busy = [channel for (channel, message, priority) in messages
+                if priority != 'high' and publisher.is_busy(channel)]
+        if busy:
+            retry_after = max(publisher.retry_after(channel)
+                              for channel in busy)
+            self.reply(503, {'error': "Busy", 'retry_after': retry_after},
+                       [('Retry-After', str(retry_after))])
+            return
+        msgids = publisher.send_many(
+            [(channel, message) for (channel, message, priority) in messages],
+            self.client_address[0])
+        self.reply(200, {'ids': msgids})
+
+    def parse_messages(self, body):
+        """Get (channel, message, priority) tuples from a request body
+
+        Raise ValueError if the body is not valid.
+        """
+        items = json.loads(body)
+        if not isinstance(items, list):
+            raise ValueError("Expected a list of messages")
+        messages = []
+        for item in items:
+            if not isinstance(item, dict):
+                raise ValueError("Expected a message object")
+            channel = item.get('channel')
+            message = item.get('message')
+            priority = item.get('priority', 'normal')
+            if not channel or not isinstance(channel, text_type):
+                raise ValueError("Invalid channel")
+            if not isinstance(message, text_type):
+                raise ValueError("Invalid message")
+            if any(c in channel or c in message for c in LINE_BREAKS):
+                raise ValueError("Line breaks are not allowed")
+            try:
+                # JSON escapes may give lone surrogates
+                channel.encode('utf-8')
+                message.encode('utf-8')
+            except UnicodeEncodeError:
+                raise ValueError("Invalid characters")
+            if priority not in PRIORITIES:
+                raise ValueError("Invalid priority")
+            messages.append((channel, message, priority))
+        return messages
+
+
+class HTTPListenerServer(socketserver.ThreadingMixIn, httpserver.HTTPServer):
+    """HTTP server with a thread per client"""
+
+    # Kept alive connections must not delay the shutdown
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class HTTPListener(threading.Thread):
+    """Thread to manage an HTTP server"""
+
+    # Options of the http section which can't be changed while running
+    STATIC_OPTIONS = ('host', 'port')
+
+    def __init__(self, publisher, config, event=None):
+        """Initialise an HTTP server depending on the configuration and
+        optionally set an event when the thread ends.
+        """
+        super(HTTPListener, self).__init__(name='http')
+        assert config.get('http', 'token'), "HTTP listener requires a token"
+        self._static_config = self._get_static_config(config)
+        self._server = HTTPListenerServer(
+            (config.get('http', 'host'), config.getint('http', 'port')),
+            HTTPListenerHandler)
+        self._configure(config)
+        self._server.publisher = publisher
+        self._event = event
+
+    def _get_static_config(self, config):
+        """Get the values of STATIC_OPTIONS in a configuration"""
+        return dict((name, config.get('http', name))
+                    for name in self.STATIC_OPTIONS)
+
+    def _configure(self, config):
+        """Read the options which can be changed while running"""
+        self._server.token = config.get('http', 'token')
+        self._server.idle_timeout = config.getint('http', 'idle_timeout')
+
+    def reload(self, config):
+        """Apply a new configuration to the running server
+
+        Return the names of the options which changed but need a restart to
+        be applied.
+        """
+        self._configure(config)
+        static_config = self._get_static_config(config)
+        return ['http.' + name for name in self.STATIC_OPTIONS
+                if static_config[name] != self._static_config[name]]
+
+    def run(self):
+        try:
+            logger.debug("HTTP server runs")
+            self._server.serve_forever()
+        except Exception:
+            logger.critical(traceback.format_exc().splitlines()[-1])
+        finally:
+            logger.debug("HTTP server has been shut down")
+            if self._event:
+                self._event.set()
+
+    def stop(self):
+        """Shut down the server"""
+        self._server.shutdown()
+        self._server.server_close()
+        self.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+# This file is a part of Kaoz, a free irc notifier
+
+"""Limits advertised by IRC servers in RPL_ISUPPORT (numeric 005)"""
+
+# Length of a line, with the trailing CR LF, according to the RFC
+DEFAULT_LINELEN = 512
+
+# Longest host name which may be shown in a prefix, when ours is unknown
+MAX_HOSTLEN = 63
+
+
+def parse_limits(value):
+    """Parse a "key:limit,key:limit" value into a dict
+
+    Keys without a limit are mapped to None, which means unlimited.
+    """
+    limits = dict()
+    for item in value.split(','):
+        key, _, limit = item.partition(':')
+        if key:
+            limits[key] = int(limit) if limit.isdigit() else None
+    return limits
+
+
+class ServerLimits(object):
+    """Limits of the server the bot is connected to
+
+    Attributes which are None are unknown or unlimited.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget what the previous server advertised"""
+        self.linelen = DEFAULT_LINELEN
+        self.channellen = None
+        self.casemapping = 'rfc1459'
+        # Channel prefixes => maximum number of joined channels
+        self.chanlimit = dict()
+        # Command => maximum number of targets
+        self.targmax = dict()
+
+    def update(self, tokens):
+        """Read the tokens of a RPL_ISUPPORT reply"""
+        for token in tokens:
+            name, _, value = token.partition('=')
+            if name == 'LINELEN' and value.isdigit():
+                self.linelen = int(value)
+            elif name == 'CHANNELLEN':
+                self.channellen = int(value) if value.isdigit() else None
+            elif name == 'CASEMAPPING' and value:
+                self.casemapping = value.lower()
+            elif name == 'CHANLIMIT':
+                self.chanlimit = parse_limits(value)
+            elif name == 'MAXCHANNELS' and value.isdigit():
+                self.chanlimit.setdefault('#', int(value))
+            elif name == 'TARGMAX':
+                self.targmax = parse_limits(value)
+
+    def payload_len(self, target_len, prefix_len):
+        """Number of bytes of text which fit in a PRIVMSG to a target
+
+        target_len is the length of the target name, and prefix_len the one
+        of the ":nick!user@host " prefix which the server adds when relaying
+        the message.
+        """
+        # ':{prefix} PRIVMSG {target} :{text}\r\n'
+        return (self.linelen - prefix_len - len('PRIVMSG  :\r\n')
+                - target_len)
+
+    def chanlimit_for(self, channel):
+        """Get the prefixes which share the limit of channel, and this limit
+
+        Return (None, None) when joining is not limited.
+        """
+        for (prefixes, limit) in self.chanlimit.items():
+            if channel[:1] in prefixes:
+                return (prefixes, limit)
+        return (None, None)
+
+    def as_dict(self):
+        """Get the limits as a flat dictionary"""
+        limits = {
+            'linelen': self.linelen,
+            'channellen': self.channellen,
+            'casemapping': self.casemapping,
+        }
+        for (prefixes, limit) in self.chanlimit.items():
+            limits['chanlimit' + prefixes] = limit
+        for (command, limit) in self.targmax.items():
+            limits['targmax_' + command.lower()] = limit
+        return limits
@@ -4,14 +4,23 @@
 
 # This file is a part of Kaoz, a free irc notifier
 
+import hmac
 import logging
+import select
+import socket
 import sys
 import threading
+import time
 import traceback
 
+import kaoz.profiling
+import kaoz.stats
+
 if sys.version_info < (3,):
+    import Queue as queue
     import SocketServer as socketserver
 else:
+    import queue
     import socketserver
 
 try:
@@ -23,101 +32,483 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+try:
+    compare_digest = hmac.compare_digest
+except AttributeError:
+    # Python < 2.7.7 and 3.2
+    def compare_digest(a, b):
+        """Compare two bytestrings in a time which doesn't depend on where
+        they differ
+        """
+        if len(a) != len(b):
+            return False
+        result = 0
+        for (x, y) in zip(bytearray(a), bytearray(b)):
+            result |= x ^ y
+        return result == 0
+
+
+def format_values(values):
+    """Format a dictionary as "name value" lines, sorted by name"""
+    return str('\n'.join(
+        '%s %s' % (name, values[name]) for name in sorted(values)))
+
+
 class TCPListenerHandler(socketserver.BaseRequestHandler):
-    """Manage a request from TCP listener module"""
+    """Manage a request from TCP listener module
+
+    Lines are read in chunks, and the messages of a chunk are given to the
+    publisher all at once. Lines are parsed as bytes, and only their channel
+    and message are decoded. A client which sends a line longer than
+    max_line_length is disconnected.
+    """
+
+    # Maximum number of bytes to read at once
+    read_size = 65536
 
     def setup(self):
         self.real_sock = None
+        # Reply with the identifier of each published message
+        self.ack = False
+        # (channel, message) tuples waiting to be given to the publisher,
+        # or None for invalid lines
+        self.batch = []
+        # Time at which the last chunk was received, and the first message
+        # of the batch
+        self.received = None
+        self.batch_created = None
         if self.server.use_ssl:
             try:
-                self.real_sock = ssl.wrap_socket(
-                    self.request,
-                    keyfile=self.server.ssl_keyfile,
-                    certfile=self.server.ssl_certfile,
-                    server_side=True,
-                    do_handshake_on_connect=True)
-                self.real_sock.settimeout(0.5)
-                self.rfile = self.real_sock.makefile('rwb')
+                self.real_sock = self.ssl_handshake()
+                self.sock = self.real_sock
+            except socket.timeout:
+                logger.warning("SSL handshake with %s:%d timed out" %
+                               self.client_address)
+                self.server.stats.incr('ssl_handshake_timeouts')
+                self.sock = None
+                return
             except Exception:
                 logger.error(traceback.format_exc().splitlines()[-1])
-                self.rfile = None
+                self.server.stats.incr('ssl_handshake_failures')
+                self.sock = None
                 return
         else:
-            self.rfile = self.request.makefile('rwb')
+            self.sock = self.request
+        self.sock.settimeout(self.server.idle_timeout or None)
+
+    def ssl_handshake(self):
+        """Wrap the connection in SSL
+
+        The handshake is done without blocking, so that it can't last more
+        than handshake_timeout seconds even if the client sends its data
+        byte by byte.
+        """
+        start = time.time()
+        deadline = start + self.server.handshake_timeout
+        sock = self.server.ssl_context.wrap_socket(
+            self.request,
+            server_side=True,
+            do_handshake_on_connect=False)
+        sock.setblocking(False)
+        while True:
+            try:
+                sock.do_handshake()
+                break
+            except ssl.SSLError as e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    waiting = ([sock], [])
+                elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                    waiting = ([], [sock])
+                else:
+                    raise
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                sock.close()
+                raise socket.timeout("SSL handshake timed out")
+            select.select(waiting[0], waiting[1], [], timeout)
+        sock.setblocking(True)
+        elapsed_ms = int((time.time() - start) * 1000)
+        self.server.stats.incr('ssl_handshakes')
+        self.server.stats.incr('ssl_handshake_ms', elapsed_ms)
+        self.server.stats.set('ssl_handshake_last_ms', elapsed_ms)
+        return sock
 
     def finish(self):
-        if self.rfile is not None:
-            self.rfile.close()
         if self.real_sock is not None:
             self.real_sock.close()
 
     def handle(self):
-        if self.rfile is None:
+        if self.sock is None:
             return
         client_addr = '%s:%d' % self.client_address
-        logger.debug("Client connected from %s" % client_addr)
-        for line in self.rfile:
-            line = line.decode('utf-8')
-            resp = self.handle_line(line)
-            if resp is not None:
-                resp += '\n'
-                resp = resp.encode('utf-8')
-                self.rfile.write(resp)
-        logger.debug("Client disconnected from %s" % client_addr)
+        logger.debug("Client connected from %s", client_addr)
+        max_length = self.server.max_line_length
+        # Pieces of a line which continues in the next chunk, only the new
+        # chunk is searched for its end
+        pending = []
+        pending_length = 0
+        while True:
+            try:
+                chunk = self.sock.recv(self.read_size)
+            except socket.timeout:
+                logger.info("Client %s timed out", client_addr)
+                self.server.stats.incr('connections_timed_out')
+                break
+            if not chunk:
+                break
+            self.received = time.time()
+            end = chunk.find(b'\n')
+            if end < 0:
+                pending.append(chunk)
+                pending_length += len(chunk)
+                if max_length and pending_length > max_length:
+                    pending = None
+                    break
+                continue
+            pending.append(chunk[:end])
+            lines = [b''.join(pending)]
+            lines.extend(chunk[end + 1:].split(b'\n'))
+            last = lines.pop()
+            pending = [last] if last else []
+            pending_length = len(last)
+            for line in lines:
+                if max_length and len(line) > max_length:
+                    pending = None
+                    break
+                self.handle_line(line)
+            self.flush_batch()
+            if pending is None:
+                break
+        if pending is None:
+            logger.warning("Line longer than %d bytes from %s, disconnecting",
+                           max_length, client_addr)
+            self.server.stats.incr('lines_too_long')
+        elif pending:
+            self.handle_line(b''.join(pending))
+            self.flush_batch()
+        logger.debug("Client disconnected from %s", client_addr)
+
+    def write_response(self, resp):
+        """Write a response to the client, after the pending acks"""
+        self.flush_batch()
+        self.sock.sendall((resp + '\n').encode('utf-8'))
+
+    def flush_batch(self):
+        """Give the waiting messages to the publisher"""
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = []
+        created = self.batch_created
+        self.batch_created = None
+        messages = [message for message in batch if message is not None]
+        msgids = self.server.publisher.send_many(
+            messages, self.client_address[0], created)
+        if len(messages) < len(batch):
+            msgids = iter(msgids)
+            msgids = [next(msgids) if message is not None else None
+                      for message in batch]
+        if self.ack:
+            self.sock.sendall(''.join(
+                ("OK %s\n" % msgid) if msgid else "ERROR Invalid message\n"
+                for msgid in msgids).encode('utf-8'))
 
     def handle_line(self, line):
-        """Remove 'password:' prefix of the incomming line"""
+        """Check and remove the 'password:' prefix of a received line, given
+        as bytes
+        """
         line = line.strip()
         if not line:
             return
-        expected_prefix = self.server.password + ':'
-        if not line.startswith(expected_prefix):
-            logger.warning("Invalid password on line %s" % line)
+        prefix = self.server.password_prefix
+        if not compare_digest(line[:len(prefix)], prefix):
+            logger.warning("Invalid password from %s:%d", *self.client_address)
             return
-        line = line[len(expected_prefix):]
-        logger.debug("Received line %s" % line)
-        if line[0] == ':':
-            line = line[1:]
-            return self.process_line(line)
+        line = line[len(prefix):]
+        if line[:1] == b':':
+            # Commands apply after the lines which were received before
+            self.flush_batch()
+            try:
+                resp = self.process_line(line[1:].decode('utf-8'))
+            except UnicodeDecodeError:
+                resp = "Invalid command"
         else:
-            return self.publish_line(line)
+            resp = self.publish_line(line)
+        if resp is not None:
+            self.write_response(resp)
 
     def process_line(self, line):
         """Process a command"""
-        if line == 'channels':
+        command, _, arg = line.partition(' ')
+        if command == 'channels':
             return str('\n'.join(self.server.publisher.channels()))
+        elif command == 'ack':
+            if arg not in ('on', 'off'):
+                return "Usage: ack on|off"
+            self.ack = (arg == 'on')
+            return "OK"
+        elif command == 'cancel':
+            if not self.server.publisher.cancel_schedule(arg):
+                return "%s unknown" % arg
+            return "OK"
+        elif command == 'latency':
+            publisher = self.server.publisher
+            if arg == 'top':
+                return str('\n'.join(
+                    '%s %d' % channel for channel in
+                    publisher.latency_channels()))
+            latency = publisher.latency(arg or None)
+            if latency is None:
+                return "%s unknown" % arg
+            return format_values(latency)
+        elif command == 'limits':
+            return format_values(self.server.publisher.limits())
+        elif command == 'profile':
+            return self.server.profiler.profile(arg)
+        elif command == 'reload':
+            if self.server.reload_config is None:
+                return "Reload is not available"
+            try:
+                not_applied = self.server.reload_config()
+            except ValueError as e:
+                return "Reload failed: %s" % e
+            return str('\n'.join(
+                ["OK"] + ["Restart needed to apply %s" % option
+                          for option in not_applied]))
+        elif command == 'schedule':
+            try:
+                return "OK %s" % self.server.publisher.schedule(arg)
+            except ValueError as e:
+                return ("Usage: schedule in|at|every <time> <channel> "
+                        "<message> (%s)" % e)
+        elif command == 'stats':
+            stats = self.server.publisher.stats()
+            stats.update(self.server.get_stats())
+            return format_values(stats)
+        elif command == 'status':
+            status = self.server.publisher.status(arg)
+            if status is None:
+                return "%s unknown" % arg
+            return str(status)
+        elif command == 'tracemalloc':
+            return self.server.profiler.tracemalloc(arg)
         else:
             return "Unknown command: %s" % line
 
     def publish_line(self, line):
-        """Transmit received line to the publisher"""
-        self.server.publisher.send_line(line)
+        """Queue a received channel:message line, given as bytes, for the
+        publisher
+        """
+        channel, separator, message = line.partition(b':')
+        try:
+            if not separator:
+                raise ValueError("missing channel")
+            channel = channel.decode('utf-8')
+            message = message.decode('utf-8')
+        except ValueError as e:
+            # UnicodeDecodeError is a ValueError
+            logger.warning("Invalid message from %s:%d (%s)",
+                           self.client_address[0], self.client_address[1], e)
+            self.batch.append(None)
+            return
+        logger.debug("Received message for %s: %s", channel, message)
+        publisher = self.server.publisher
+        if publisher.is_busy(channel):
+            if self.server.backpressure == 'reply':
+                return "BUSY %d" % publisher.retry_after(channel)
+            # Stop reading from the client until the backlog drains, so that
+            # TCP flow control slows it down
+            logger.debug("Backlog of %s is full, holding client back",
+                         channel)
+            self.flush_batch()
+            while not publisher.wait_ready(channel, 1):
+                if publisher.is_stopped():
+                    return
+        # The time spent waiting counts in the latency of the message
+        if self.batch_created is None:
+            self.batch_created = self.received
+        self.batch.append((channel, message))
+
+
+class TCPListenerServer(socketserver.ThreadingTCPServer):
+    """TCP server which limits the number of connections
+
+    Clients are handled by a new thread each, or by a fixed pool of worker
+    threads. Connections over the limits are closed as soon as they are
+    accepted.
+    """
+
+    # Closing connections leaves them in TIME_WAIT, which would keep a
+    # restarted server from listening again
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, workers=0):
+        self.workers = workers
+        self.max_connections = 0
+        self.max_connections_per_ip = 0
+        self.stats = kaoz.stats.Stats()
+        # Client address => number of connections
+        self._connections = dict()
+        self._connections_lock = threading.Lock()
+        # Connections waiting for a worker, None stopping a worker
+        self._requests = queue.Queue()
+        socketserver.ThreadingTCPServer.__init__(
+            self, server_address, handler_class)
+        for i in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def verify_request(self, request, client_address):
+        """Accept a connection only if it stays within the limits"""
+        address = client_address[0]
+        with self._connections_lock:
+            total = sum(self._connections.values())
+            count = self._connections.get(address, 0)
+            if ((self.max_connections and total >= self.max_connections) or
+                    (self.max_connections_per_ip and
+                     count >= self.max_connections_per_ip)):
+                logger.warning("Too many connections, rejecting %s", address)
+                self.stats.incr('connections_rejected')
+                return False
+            self._connections[address] = count + 1
+        self.stats.incr('connections_accepted')
+        return True
+
+    def process_request(self, request, client_address):
+        """Give a connection to a worker, or to a new thread"""
+        if not self.workers:
+            socketserver.ThreadingTCPServer.process_request(
+                self, request, client_address)
+        else:
+            self._requests.put((request, client_address))
+
+    def finish_request(self, request, client_address):
+        """Handle a connection, then forget it"""
+        try:
+            socketserver.ThreadingTCPServer.finish_request(
+                self, request, client_address)
+        finally:
+            address = client_address[0]
+            with self._connections_lock:
+                count = self._connections.pop(address) - 1
+                if count:
+                    self._connections[address] = count
+
+    def _work(self):
+        """Handle connections in a worker thread, until None is received"""
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            self.process_request_thread(*item)
+
+    def get_stats(self):
+        """Get a dictionary of statistics"""
+        stats = self.stats.snapshot()
+        with self._connections_lock:
+            stats['connections'] = sum(self._connections.values())
+        stats['connections_waiting'] = self._requests.qsize()
+        return stats
+
+    def server_close(self):
+        socketserver.ThreadingTCPServer.server_close(self)
+        for i in range(self.workers):
+            self._requests.put(None)
 
 
 class TCPListener(threading.Thread):
     """Thread to manage a TCP server (listener)"""
 
-    def __init__(self, publisher, config, event=None):
+    # Options of the listener section which can't be changed while running
+    STATIC_OPTIONS = ('host', 'port', 'ssl', 'workers')
+
+    def __init__(self, publisher, config, event=None, reload_config=None):
         """ Initialise a TCP server depending on the configuration and
         optionally set an event when the thread ends.
+
+        reload_config is a function which reloads the configuration file and
+        returns the options which could not be applied, or raises ValueError
+        if it is not valid, for the reload command
         """
-        super(TCPListener, self).__init__()
+        super(TCPListener, self).__init__(name='listener')
         self._host = config.get('listener', 'host')
         self._port = config.getint('listener', 'port')
-        self._server = socketserver.ThreadingTCPServer(
+        self._static_config = self._get_static_config(config)
+        self._server = TCPListenerServer(
             (self._host, self._port),
-            TCPListenerHandler)
-        self._server.password = config.get('listener', 'password')
-        if config.getboolean('listener', 'ssl'):
+            TCPListenerHandler,
+            config.getint('listener', 'workers'))
+        self._server.reload_config = reload_config
+        self._server.profiler = kaoz.profiling.Profiler()
+        self._server.use_ssl = config.getboolean('listener', 'ssl')
+        self._server.ssl_context = None
+        if self._server.use_ssl:
             assert has_ssl, "SSL support requested but not available"
-            self._server.use_ssl = True
-            self._server.ssl_keyfile = config.get('listener', 'ssl_key')
-            self._server.ssl_certfile = config.get('listener', 'ssl_cert')
-        else:
-            self._server.use_ssl = False
+        self._configure(config)
         self._server.publisher = publisher
         self._event = event
 
+    def _get_static_config(self, config):
+        """Get the values of STATIC_OPTIONS in a configuration"""
+        return dict((name, config.get('listener', name))
+                    for name in self.STATIC_OPTIONS)
+
+    def _configure(self, config):
+        """Read the options which can be changed while running"""
+        self._server.password = config.get('listener', 'password')
+        self._server.password_prefix = (
+            self._server.password + ':').encode('utf-8')
+        self._server.backpressure = config.get('listener', 'backpressure')
+        if self._server.backpressure not in ('block', 'reply'):
+            logger.warning("Invalid backpressure value (%s), using block" %
+                           self._server.backpressure)
+            self._server.backpressure = 'block'
+        self._server.max_connections = config.getint(
+            'listener', 'max_connections')
+        self._server.max_connections_per_ip = config.getint(
+            'listener', 'max_connections_per_ip')
+        self._server.idle_timeout = config.getint('listener', 'idle_timeout')
+        self._server.handshake_timeout = config.getint(
+            'listener', 'handshake_timeout')
+        self._server.max_line_length = config.getint(
+            'listener', 'max_line_length')
+        if self._server.use_ssl:
+            try:
+                self._server.ssl_context = self._get_ssl_context(config)
+            except (IOError, OSError, ssl.SSLError) as e:
+                if self._server.ssl_context is None:
+                    raise
+                logger.error("Unable to load the SSL certificate, keeping "
+                             "the previous one: %s", e)
+        profiler = self._server.profiler
+        profiler.directory = config.get('profiling', 'directory')
+        profiler.max_duration = config.getint('profiling', 'max_duration')
+        profiler.interval = config.getfloat('profiling', 'interval')
+        profiler.top = config.getint('profiling', 'top')
+
+    def _get_ssl_context(self, config):
+        """Load the certificate and key of the server in an SSL context
+
+        The files are read once, rather than for each connection.
+        """
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER',
+                                         ssl.PROTOCOL_SSLv23))
+        context.load_cert_chain(config.get('listener', 'ssl_cert'),
+                                config.get('listener', 'ssl_key'))
+        return context
+
+    def reload(self, config):
+        """Apply a new configuration to the running listener
+
+        Return the names of the options which changed but need a restart to
+        be applied.
+        """
+        self._configure(config)
+        static_config = self._get_static_config(config)
+        return ['listener.' + name for name in self.STATIC_OPTIONS
+                if static_config[name] != self._static_config[name]]
+
     def run(self):
         try:
             logger.debug("Server runs")
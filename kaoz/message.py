@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+# This file is a part of Kaoz, a free irc notifier
+
+import array
+import collections
+import itertools
+import threading
+import time
+
+
+QUEUED = 'queued'
+SENT = 'sent'
+DROPPED = 'dropped'
+EXPIRED = 'expired'
+DIGESTED = 'digested'
+
+
+class Line(object):
+    """A line waiting to be said on a channel, as taken out of a LineQueue
+
+    data is the UTF-8 encoded text of the line, msgid the identifier of the
+    message this line comes from, if any, created the time at which this
+    message was received and queued the time at which this line was queued
+    on its channel.
+    """
+
+    __slots__ = ('data', 'msgid', 'created', 'queued')
+
+    def __init__(self, data, msgid=None, created=None, queued=None):
+        self.data = data
+        self.msgid = msgid
+        self.created = time.time() if created is None else created
+        self.queued = self.created if queued is None else queued
+
+    @property
+    def text(self):
+        """Decoded text of the line"""
+        return self.data.decode('utf-8')
+
+    def size(self):
+        """Number of bytes of the line"""
+        return len(self.data)
+
+
+class LineQueue(object):
+    """Compact FIFO of lines waiting to be said on a channel
+
+    The UTF-8 encoded lines are stored one after another in a buffer, and
+    their length, message identifier, creation and queuing times in arrays,
+    rather than as one object per line. Lines are taken out of the head by
+    moving an offset, and the buffer is compacted once half of it is unused.
+
+    Message identifiers must be hexadecimal, like the ones of MessageIndex.
+    """
+
+    __slots__ = ('_buffer', '_lengths', '_msgids', '_created', '_queued',
+                 '_head', '_start')
+
+    # Number of lines taken out before compacting is considered
+    compact_threshold = 64
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._lengths = array.array('I')
+        # Identifiers as integers, 0 meaning no identifier
+        self._msgids = array.array('L')
+        self._created = array.array('d')
+        self._queued = array.array('d')
+        # Index of the first line, and offset of its data in the buffer
+        self._head = 0
+        self._start = 0
+
+    def clear(self):
+        """Remove every line"""
+        del self._buffer[:]
+        del self._lengths[:]
+        del self._msgids[:]
+        del self._created[:]
+        del self._queued[:]
+        self._head = 0
+        self._start = 0
+
+    def __len__(self):
+        return len(self._lengths) - self._head
+
+    def __bool__(self):
+        return len(self._lengths) > self._head
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        offset = self._start
+        for i in range(self._head, len(self._lengths)):
+            yield self._line(i, offset)
+            offset += self._lengths[i]
+
+    def _line(self, i, offset):
+        """Build the Line of index i, whose data starts at offset"""
+        msgid = self._msgids[i]
+        return Line(bytes(self._buffer[offset:offset + self._lengths[i]]),
+                    '%x' % msgid if msgid else None, self._created[i],
+                    self._queued[i])
+
+    def append(self, data, msgid=None, created=None, queued=None):
+        """Add a line, given as UTF-8 bytes, at the tail"""
+        self.append_parts(data, [len(data)], msgid, created, queued)
+
+    def append_parts(self, data, lengths, msgid=None, created=None,
+                     queued=None):
+        """Add the lines data is split into, given their lengths
+
+        The lines are copied at once, and their total length may be shorter
+        than data, whose end is then ignored. Times default to now.
+        """
+        now = time.time()
+        total = sum(lengths)
+        if total < len(data):
+            data = data[:total]
+        self._buffer.extend(data)
+        self._lengths.extend(lengths)
+        count = len(lengths)
+        self._msgids.extend([int(msgid, 16) if msgid else 0] * count)
+        self._created.extend([now if created is None else created] * count)
+        self._queued.extend([now if queued is None else queued] * count)
+
+    def appendleft(self, data, msgid=None, created=None, queued=None):
+        """Add a line, given as UTF-8 bytes, at the head"""
+        msgid = int(msgid, 16) if msgid else 0
+        created = time.time() if created is None else created
+        queued = created if queued is None else queued
+        if self._head and self._start >= len(data):
+            # Reuse the room left by the lines which were taken out
+            self._head -= 1
+            self._start -= len(data)
+            self._buffer[self._start:self._start + len(data)] = data
+            self._lengths[self._head] = len(data)
+            self._msgids[self._head] = msgid
+            self._created[self._head] = created
+            self._queued[self._head] = queued
+        else:
+            self._buffer[self._start:self._start] = data
+            self._lengths.insert(self._head, len(data))
+            self._msgids.insert(self._head, msgid)
+            self._created.insert(self._head, created)
+            self._queued.insert(self._head, queued)
+
+    def extend(self, other):
+        """Add the lines of another LineQueue at the tail"""
+        for line in other:
+            self.append(line.data, line.msgid, line.created, line.queued)
+
+    def first(self):
+        """Get the Line at the head, without taking it out"""
+        if not self:
+            raise IndexError("first of an empty LineQueue")
+        return self._line(self._head, self._start)
+
+    def first_created(self):
+        """Get the creation time of the line at the head"""
+        return self._created[self._head]
+
+    def popleft(self):
+        """Take the Line at the head out"""
+        if not self:
+            raise IndexError("pop from an empty LineQueue")
+        line = self._line(self._head, self._start)
+        self._start += self._lengths[self._head]
+        self._head += 1
+        if self._head == len(self._lengths):
+            self.clear()
+        elif (self._head >= self.compact_threshold
+              and 2 * self._head >= len(self._lengths)):
+            del self._buffer[:self._start]
+            del self._lengths[:self._head]
+            del self._msgids[:self._head]
+            del self._created[:self._head]
+            del self._queued[:self._head]
+            self._head = 0
+            self._start = 0
+        return line
+
+
+class MessageStatus(object):
+    """Delivery state of a message, with creation and update timestamps"""
+
+    __slots__ = ('msgid', 'state', 'created', 'updated', 'parts')
+
+    def __init__(self, msgid, created):
+        self.msgid = msgid
+        self.state = QUEUED
+        self.created = created
+        self.updated = created
+        # Number of lines which still need to be sent
+        self.parts = 1
+
+    def __str__(self):
+        return "%s %s %.3f %.3f" % (
+            self.msgid, self.state, self.created, self.updated)
+
+
+class MessageIndex(object):
+    """Bounded and expiring index of messages by identifier
+
+    Identifiers are short hexadecimal strings. The oldest messages are
+    forgotten when the index is full or when they are older than timeout
+    seconds, whatever their state. This class is thread-safe.
+    """
+
+    def __init__(self, size=10000, timeout=3600):
+        self.size = size
+        self.timeout = timeout
+        self._counter = itertools.count(1)
+        self._index = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def new(self):
+        """Register a new queued message and return its identifier"""
+        return self.new_many(1)[0]
+
+    def new_many(self, count):
+        """Register count new queued messages and return their identifiers"""
+        now = time.time()
+        with self._lock:
+            msgids = ['%x' % next(self._counter) for i in range(count)]
+            for msgid in msgids:
+                self._index[msgid] = MessageStatus(msgid, now)
+            # Forget old messages, the oldest being first
+            while self._index:
+                oldest = next(iter(self._index.values()))
+                if (len(self._index) <= self.size
+                        and now - oldest.created < self.timeout):
+                    break
+                self._index.popitem(last=False)
+            return msgids
+
+    def get(self, msgid):
+        """Get the MessageStatus of a message, or None if it is unknown"""
+        with self._lock:
+            return self._index.get(msgid)
+
+    def add_parts(self, msgid, parts):
+        """Account for the extra lines a message was split or copied into"""
+        with self._lock:
+            status = self._index.get(msgid)
+            if status is not None:
+                status.parts += parts
+
+    def part_sent(self, msgid):
+        """Mark one line of a message as sent"""
+        with self._lock:
+            status = self._index.get(msgid)
+            if status is None or status.state != QUEUED:
+                return
+            status.parts -= 1
+            if status.parts <= 0:
+                status.state = SENT
+                status.updated = time.time()
+
+    def mark(self, msgid, state):
+        """Set the final state of a message"""
+        with self._lock:
+            status = self._index.get(msgid)
+            if status is not None and status.state == QUEUED:
+                status.state = state
+                status.updated = time.time()
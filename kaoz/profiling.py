@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+# This file is a part of Kaoz, a free irc notifier
+
+"""Profiling of a running server, driven by listener commands
+
+Nothing is traced until a command starts it: the sampling profiler is a
+thread which only exists while profiling, and allocations are only traced
+between "tracemalloc start" and "tracemalloc stop".
+"""
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+    has_tracemalloc = True
+except ImportError:
+    has_tracemalloc = False
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler(object):
+    """Record the stacks of every thread at a regular interval
+
+    Stacks are counted in the "collapsed" format of flame graph tools, where
+    a stack is the name of its thread followed by its frames, separated by
+    semicolons.
+    """
+
+    def __init__(self, interval=0.01, on_finish=None):
+        """on_finish is called with the profiler once sampling ended"""
+        self.interval = interval
+        self.on_finish = on_finish
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, duration):
+        """Sample stacks for at most duration seconds"""
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, args=(duration,),
+                                        name='profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait until on_finish returned"""
+        self._stop.set()
+        self._thread.join()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self, duration):
+        deadline = self.started + duration
+        ident = threading.current_thread().ident
+        try:
+            while not self._stop.wait(self.interval):
+                if time.time() >= deadline:
+                    break
+                names = dict((thread.ident, thread.name)
+                             for thread in threading.enumerate())
+                for (thread_id, frame) in sys._current_frames().items():
+                    if thread_id != ident:
+                        self._sample(names.get(thread_id, 'unknown'), frame)
+                self.samples += 1
+        finally:
+            if self.on_finish is not None:
+                self.on_finish(self)
+
+    def _sample(self, thread_name, frame):
+        """Count the stack of a thread"""
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno))
+            frame = frame.f_back
+        stack.append(thread_name)
+        stack.reverse()
+        self.counts[';'.join(stack)] += 1
+
+    def write(self, path):
+        """Write the counted stacks to a file"""
+        with open(path, 'w') as f:
+            for (stack, count) in self.counts.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+    def top(self, count):
+        """Get the functions which were running in most samples, as
+        (samples, thread, function) tuples
+        """
+        functions = collections.Counter()
+        for (stack, samples) in self.counts.items():
+            frames = stack.split(';')
+            functions[(frames[0], frames[-1])] += samples
+        return [(samples, thread, function) for ((thread, function), samples)
+                in functions.most_common(count)]
+
+
+class Profiler(object):
+    """Run the profile and tracemalloc listener commands
+
+    Results are written to directory, if it is not empty, and their top
+    entries are returned.
+    """
+
+    def __init__(self, directory='', max_duration=300, interval=0.01,
+                 top=20):
+        self.directory = directory
+        self.max_duration = max_duration
+        self.interval = interval
+        self.top = top
+        self._profiler = None
+        self._lock = threading.Lock()
+
+    def _path(self, kind, extension):
+        """Get the name of a new result file, or None"""
+        if not self.directory:
+            return None
+        return os.path.join(self.directory, time.strftime(
+            kind + '-%Y%m%d-%H%M%S.' + extension))
+
+    def _profile_finished(self, profiler):
+        """Write the results of the sampling profiler"""
+        path = self._path('profile', 'txt')
+        if path is None:
+            return
+        try:
+            profiler.write(path)
+            logger.info("profile written to %s", path)
+        except (IOError, OSError) as e:
+            logger.error("Unable to write profile to %s: %s", path, e)
+
+    def profile(self, arg):
+        """Run the profile command"""
+        args = arg.split()
+        with self._lock:
+            if args[:1] == ['start'] and len(args) <= 2:
+                if self._profiler is not None and self._profiler.is_running():
+                    return "Profiling is already running"
+                duration = self.max_duration
+                if len(args) == 2:
+                    if not args[1].isdigit():
+                        return "Usage: profile start [seconds]"
+                    duration = min(int(args[1]), duration)
+                self._profiler = SamplingProfiler(self.interval,
+                                                  self._profile_finished)
+                self._profiler.start(duration)
+                return "OK, profiling for %d seconds" % duration
+            elif args == ['stop']:
+                if self._profiler is None:
+                    return "Profiling is not running"
+                profiler, self._profiler = self._profiler, None
+        if args != ['stop']:
+            return "Usage: profile start [seconds]|stop"
+        # Don't hold the lock while the results are written
+        profiler.stop()
+        lines = ["%d samples in %.1f seconds" % (
+            profiler.samples, time.time() - profiler.started)]
+        lines.extend("%5.1f%% %s %s" % (
+            100.0 * samples / max(1, profiler.samples), thread, function)
+            for (samples, thread, function) in profiler.top(self.top))
+        return str('\n'.join(lines))
+
+    def tracemalloc(self, arg):
+        """Run the tracemalloc command"""
+        if not has_tracemalloc:
+            return "tracemalloc is not available"
+        if arg == 'start':
+            tracemalloc.start()
+            return "OK"
+        elif arg == 'stop':
+            tracemalloc.stop()
+            return "OK"
+        elif arg != 'snapshot':
+            return "Usage: tracemalloc start|snapshot|stop"
+        if not tracemalloc.is_tracing():
+            return "Tracing is not started"
+        snapshot = tracemalloc.take_snapshot()
+        lines = []
+        path = self._path('tracemalloc', 'snapshot')
+        if path is not None:
+            try:
+                snapshot.dump(path)
+                lines.append("Snapshot written to %s" % path)
+            except (IOError, OSError) as e:
+                logger.error("Unable to write snapshot to %s: %s", path, e)
+                lines.append("Unable to write snapshot to %s: %s" % (path, e))
+        lines.extend(str(stat) for stat in
+                     snapshot.statistics('lineno')[:self.top])
+        return str('\n'.join(lines))
@@ -8,17 +8,20 @@ import irc.client
 import irc.connection
 import logging
 import os
+import random
+import re
 import socket
-import sys
 import threading
+import time
 import traceback
 
 import kaoz.channel
-
-if sys.version_info < (3,):
-    import Queue as queue
-else:
-    import queue
+import kaoz.isupport
+import kaoz.message
+import kaoz.replies
+import kaoz.routing
+import kaoz.schedule
+import kaoz.stats
 
 try:
     import ssl
@@ -37,15 +40,62 @@ logger = logging.getLogger(__name__)
 #     'PRIVMSG {channel} :{message}\r\n'
 # so we only send messages which satisfy:
 #     len(channel) + len(message) <= 512 - 12
+# Messages are relayed to other clients with a ':nick!user@host ' prefix, so
+# the actual limit is lower, see ServerLimits.payload_len.
 IRC_CHANMSG_MAXLEN = 500
 
+# Stages of the latency of a line: from its arrival, including the time a
+# listener held it back, until it is dequeued by the publisher, then waiting
+# for its channel to be joined, and for its turn to be said, then in total
+LATENCY_STAGES = ('queue', 'join', 'send', 'total')
+
+# The server is considered congested when the round-trip time of a PING goes
+# over the smallest one times this factor plus this margin, in seconds
+RTT_CONGESTION_FACTOR = 2
+RTT_CONGESTION_MARGIN = 0.1
+
+# Notices of servers which warn that we send too fast
+FLOOD_NOTICE_RE = re.compile(
+    r'flood|throttl|too (fast|many)|slow down|rate.?limit|try again',
+    re.IGNORECASE)
+
+
+def expired_summary(count):
+    """Get the line which replaces count expired messages"""
+    return ("%d messages expired" % count).encode('utf-8')
+
 
-def utf8_cut(bytestr, maxlen):
-    """Cuts an utf8 bytestring in two parts where the left is at most maxlen
-    long, and both are valid utf8 strings.
+def utf8_split(bytestr, maxlen):
+    """Get the lengths of the parts of at most maxlen bytes of a valid utf8
+    bytestring, which is cut between characters.
+
+    The lengths may add up to less than the length of bytestr if it can't be
+    cut, when maxlen is shorter than a character.
     """
-    left = bytestr[:maxlen].decode('utf-8', 'ignore').encode('utf-8')
-    return left, bytestr[len(left):]
+    lengths = []
+    start = 0
+    while len(bytestr) - start > maxlen:
+        end = start + maxlen
+        # Continuation bytes of a character look like 0b10xxxxxx
+        while end > start and ord(bytestr[end:end + 1]) & 0xc0 == 0x80:
+            end -= 1
+        if end == start:
+            return lengths
+        lengths.append(end - start)
+        start = end
+    if start < len(bytestr):
+        lengths.append(len(bytestr) - start)
+    return lengths
+
+
+def parse_servers(value, default_port):
+    """Parse a space-separated list of host[:port] into (host, port) tuples
+    """
+    servers = []
+    for server in value.split():
+        host, _, port = server.partition(':')
+        servers.append((host, int(port) if port else default_port))
+    return servers
 
 
 def send_systemd_notification(message):
@@ -62,25 +112,89 @@ def send_systemd_notification(message):
 class Publisher(irc.client.SimpleIRCClient):
     """A basic IRC publisher which sends lines to IRC
 
-    This class uses a Queue to get messages from the outside. It deques the
-    messages into an internal list which containes (channel, message) tuples,
-    waiting to be sent. When the bot joined a channel, it may send waiting
-    messages out, in a relatively slow rate to prevent server spamming.
+    This class uses a locked list to get messages from the outside. It deques
+    the messages into per-channel queues of lines, waiting to be sent. When the bot
+    joined a channel, it may send waiting messages out, in a relatively slow
+    rate to prevent server spamming.
     """
 
+    # Options of the irc section which can't be changed without reconnecting
+    STATIC_OPTIONS = ('server', 'port', 'alternate_servers', 'ssl',
+                      'nickname', 'realname', 'username', 'server_password')
+
     def __init__(self, config, notify_systemd=False, *args, **kwargs):
         """Instantiate the publisher based on configuration."""
         super(Publisher, self).__init__()
         self._notify_systemd = notify_systemd
         self._server = config.get('irc', 'server')
         self._port = config.getint('irc', 'port')
+        # Servers to rotate through when connection fails
+        self._servers = [(self._server, self._port)] + parse_servers(
+            config.get('irc', 'alternate_servers'), self._port)
+        self._server_index = 0
         self._use_ssl = config.getboolean('irc', 'ssl')
-        self._reconn_interval = config.getint('irc', 'reconnection_interval')
         self._nickname = config.get('irc', 'nickname')
         self._realname = config.get('irc', 'realname')
         self._username = config.get('irc', 'username')
         self._password = config.get('irc', 'server_password')
-        self._line_sleep = config.getint('irc', 'line_sleep')
+        self._static_config = self._get_static_config(config)
+
+        self._chans = kaoz.channel.IndexedChanDict()
+        self._limits = kaoz.isupport.ServerLimits()
+        # Our nick!user@host, as seen by the server
+        self._source = None
+        # Messages sent from other threads, swapped out as a whole
+        self._queue = []
+        self._queue_lock = threading.Lock()
+        self._backlog = kaoz.channel.Backlog()
+        self._messages = kaoz.message.MessageIndex()
+        self._stats = kaoz.stats.Stats()
+        self._latency = kaoz.stats.Latency(LATENCY_STAGES)
+        # Names of the channels in digest mode
+        self._digest_chans = set()
+        self._connect_lock = threading.Lock()
+        self._has_welcome = False
+        self._stop = threading.Event()
+        self._reconnect_attempts = 0
+        self._reconnect_scheduled = False
+        self._disconnected_at = None
+        self._scheduler = kaoz.schedule.Scheduler()
+        # Time of the timer which sends the next scheduled messages
+        self._schedule_timer_at = None
+        # Name => value of the schedules of the configuration
+        self._config_schedules = dict()
+        # Time and token of the PING which measures the round-trip time
+        self._ping_sent = None
+        self._ping_token = None
+        self._min_rtt = None
+        self._last_slowdown = 0
+        self._replies = kaoz.replies.ReplyQueue()
+        self._configure(config)
+        self._schedule_file = config.get('irc', 'schedule_file')
+        if self._schedule_file and os.path.exists(self._schedule_file):
+            try:
+                count = self._scheduler.load(self._schedule_file)
+                logger.info("%d schedules loaded from %s" %
+                            (count, self._schedule_file))
+            except (IOError, OSError, ValueError) as e:
+                logger.error("Unable to load schedules from %s: %s" %
+                             (self._schedule_file, e))
+            self._arm_schedules()
+        self._execute_every('_reconn_interval', self._check_connect)
+        self._execute_every('_line_sleep', self._say_messages)
+        self._execute_every('_digest_interval', self._flush_digests)
+        self._execute_every('_rate_interval', self._check_rate)
+
+    def _get_static_config(self, config):
+        """Get the values of STATIC_OPTIONS in a configuration"""
+        return dict((name, config.get('irc', name))
+                    for name in self.STATIC_OPTIONS)
+
+    def _configure(self, config):
+        """Read the options which can be changed while running"""
+        self._reconn_interval = config.getint('irc', 'reconnection_interval')
+        self._reconn_delay = config.getfloat('irc', 'reconnection_delay')
+        self._line_sleep = config.getfloat('irc', 'line_sleep')
         self._fallbackchan = config.get('irc', 'fallback_channel')
         self._max_join_attempts = config.getint('irc', 'max_join_attempts')
         self._memory_timeout = config.getint('irc', 'memory_timeout')
@@ -88,27 +202,173 @@ class Publisher(irc.client.SimpleIRCClient):
         self._automessages = [
             ('#' + chan, config.get('automessages', chan))
             for chan in config.options(section='automessages')]
+        self._message_ttl = config.getint('irc', 'message_ttl')
+        self._channel_ttls = dict(
+            (self._chans.normalize('#' + chan),
+             config.getint('message_ttl', chan))
+            for chan in config.options(section='message_ttl'))
+        self._digest_threshold = config.getint('irc', 'digest_threshold')
+        self._digest_interval = config.getint('irc', 'digest_interval')
+        self._digest_lines = config.getint('irc', 'digest_lines')
+        self._drain_line_sleep = config.getfloat('irc', 'drain_line_sleep')
+        self._adaptive_rate = config.getboolean('irc', 'adaptive_rate')
+        self._min_line_sleep = config.getfloat('irc', 'min_line_sleep')
+        self._max_line_sleep = config.getfloat('irc', 'max_line_sleep')
+        self._rate_interval = config.getint('irc', 'rate_interval')
+        self._rate_increase = config.getfloat('irc', 'rate_increase')
+        self._auto_replies = config.getboolean('irc', 'auto_replies')
+        self._replies.burst = config.getint('irc', 'reply_burst')
+        self._replies.interval = config.getint('irc', 'reply_interval')
 
         if not 1 <= self._channel_maxlen < IRC_CHANMSG_MAXLEN:
             logger.warning("Invalid channel_maxlen value (%d), using 100" %
                            self._channel_maxlen)
             self._channel_maxlen = 100
 
-        self._chans = kaoz.channel.IndexedChanDict()
-        self._queue = queue.Queue()
-        self._connect_lock = threading.Lock()
-        self._has_welcome = False
-        self._stop = threading.Event()
+        if self._adaptive_rate:
+            if not 0 < self._min_line_sleep <= self._max_line_sleep:
+                logger.warning("Invalid min_line_sleep and max_line_sleep " +
+                               "values, disabling adaptive_rate")
+                self._adaptive_rate = False
+            else:
+                self._line_sleep = min(self._max_line_sleep,
+                                       max(self._min_line_sleep,
+                                           self._line_sleep))
+
+        self._backlog.set_watermarks(
+            config.getint('irc', 'backlog_high_watermark'),
+            config.getint('irc', 'backlog_low_watermark'),
+            config.getint('irc', 'channel_backlog_high_watermark'),
+            config.getint('irc', 'channel_backlog_low_watermark'))
+        self._messages.size = config.getint('irc', 'message_index_size')
+        self._messages.timeout = config.getint('irc', 'message_index_timeout')
+        self._max_channels = config.getint('irc', 'max_channels')
+        self._max_queued_bytes = config.getint('irc', 'max_queued_bytes')
+        self._latency.max_channels = config.getint('irc', 'latency_channels')
+        rules = []
+        for name in config.options('routing'):
+            try:
+                rules.append(kaoz.routing.Rule(
+                    name, config.get('routing', name)))
+            except ValueError as e:
+                logger.warning("Invalid routing rule %s (%s), ignoring it" %
+                               (name, e))
+        self._router = kaoz.routing.Router(rules) if rules else None
+        self._configure_schedules(dict(
+            (name, config.get('schedules', name))
+            for name in config.options('schedules')))
+
+    def _configure_schedules(self, schedules):
+        """Apply the schedules of the configuration, a name => value dict
+
+        Schedules which did not change are left alone, so that messages
+        which were already sent are not sent again, and recurring messages
+        keep their times.
+        """
+        for (name, value) in self._config_schedules.items():
+            if schedules.get(name) != value:
+                self._scheduler.cancel(name)
+        for (name, value) in schedules.items():
+            if self._config_schedules.get(name) == value:
+                continue
+            try:
+                (when, interval, channel, message) = \
+                    kaoz.schedule.parse_schedule(value)
+            except ValueError as e:
+                logger.warning("Invalid schedule %s (%s), ignoring it" %
+                               (name, e))
+                continue
+            self._scheduler.add(when, interval, channel, message, name,
+                                persist=False)
+        self._config_schedules = schedules
+        self._arm_schedules()
+
+    def reload(self, config):
+        """Apply a new configuration to the running publisher
+
+        This is thread-safe. Return the names of the options which changed
+        but need a restart to be applied.
+        """
+        # Holding the reactor mutex keeps handlers and timers from running
+        with self.reactor.mutex:
+            self._configure(config)
+        static_config = self._get_static_config(config)
+        return ['irc.' + name for name in self.STATIC_OPTIONS
+                if static_config[name] != self._static_config[name]]
+
+    def _execute_after(self, delay, function):
+        """Call a function from the reactor after some delay"""
         # Use scheduler if available (python-irc>=15.0)
         if hasattr(self.reactor, 'scheduler'):
-            self.reactor.scheduler.execute_every(self._reconn_interval,
-                                                 self._check_connect)
-            self.reactor.scheduler.execute_every(self._line_sleep,
-                                                 self._say_messages)
+            self.reactor.scheduler.execute_after(delay, function)
         else:
-            self.reactor.execute_every(self._reconn_interval,
-                                       self._check_connect)
-            self.reactor.execute_every(self._line_sleep, self._say_messages)
+            self.reactor.execute_delayed(delay, function)
+
+    def _execute_every(self, period_attr, function):
+        """Periodically call a function from the reactor
+
+        The period is read from attribute period_attr before each call, so
+        that reloading the configuration reschedules the function.
+        """
+        def run_and_reschedule():
+            try:
+                function()
+            finally:
+                self._execute_after(getattr(self, period_attr),
+                                    run_and_reschedule)
+
+        self._execute_after(getattr(self, period_attr), run_and_reschedule)
+
+    def _arm_schedules(self):
+        """Set a timer for the next scheduled message, unless one is
+        already set to fire before it. This is thread-safe.
+        """
+        with self.reactor.mutex:
+            when = self._scheduler.next_time()
+            if when is None or (self._schedule_timer_at is not None and
+                                self._schedule_timer_at <= when):
+                return
+            self._schedule_timer_at = when
+            self._execute_after(max(0, when - time.time()),
+                                lambda: self._send_schedules(when))
+
+    def _send_schedules(self, when):
+        """Send the scheduled messages which are due"""
+        if when != self._schedule_timer_at:
+            # An earlier timer replaced this one
+            return
+        self._schedule_timer_at = None
+        due = self._scheduler.pop_due()
+        if due:
+            self._stats.incr('messages_scheduled', len(due))
+            self.send_many(due)
+        self._arm_schedules()
+
+    def schedule(self, value):
+        """Schedule a message written "<when> <channel> <message>"
+
+        This is thread-safe. Return the identifier of the schedule, raise
+        ValueError if it is not valid.
+        """
+        (when, interval, channel, message) = \
+            kaoz.schedule.parse_schedule(value)
+        schedid = self._scheduler.add(when, interval, channel, message)
+        self._arm_schedules()
+        return schedid
+
+    def cancel_schedule(self, schedid):
+        """Cancel a scheduled message, return False if it is unknown"""
+        return self._scheduler.cancel(schedid)
+
+    def save_schedules(self):
+        """Write the scheduled messages to schedule_file, if it is set"""
+        if not self._schedule_file:
+            return
+        try:
+            self._scheduler.save(self._schedule_file)
+        except (IOError, OSError) as e:
+            logger.error("Unable to save schedules to %s: %s" %
+                         (self._schedule_file, e))
 
     def connect(self):
         """Connect to a server"""
@@ -119,6 +379,10 @@ class Publisher(irc.client.SimpleIRCClient):
 
             # Ensure is_connected() returns False until the welcome message
             self._has_welcome = False
+            self._limits.reset()
+            self._source = None
+            self._ping_sent = None
+            self._min_rtt = None
 
             logger.info("connecting to %s:%d..." % (self._server, self._port))
             if self._use_ssl:
@@ -143,12 +407,80 @@ class Publisher(irc.client.SimpleIRCClient):
             except irc.client.ServerConnectionError as e:
                 logger.error("Error connecting to %s: %s" % (self._server, e))
                 self._has_welcome = False
+                self._next_server()
+                self._schedule_reconnect()
 
     def _check_connect(self):
         """Force reconnection periodically"""
+        if self._reconnect_scheduled:
+            return
         if (not self.is_connected()) and (not self._stop.is_set()):
             self.connect()
 
+    def _check_rate(self):
+        """Send a PING to measure the round-trip time to the server"""
+        if not self._adaptive_rate or not self.is_connected():
+            return
+        now = time.time()
+        if self._ping_sent is not None:
+            self._slow_down("no PONG after %d seconds" %
+                            (now - self._ping_sent))
+            # Wait for the PONG, unless it was lost
+            if now - self._ping_sent < 6 * self._rate_interval:
+                return
+        self._ping_sent = now
+        self._ping_token = 'kaoz-%d' % (self._ping_sent * 1000)
+        self.connection.ping(self._ping_token)
+
+    def _slow_down(self, reason):
+        """Halve the send rate, at most once per rate_interval"""
+        now = time.time()
+        if (not self._adaptive_rate or
+                now - self._last_slowdown < self._rate_interval):
+            return
+        self._last_slowdown = now
+        self._line_sleep = min(self._max_line_sleep, 2 * self._line_sleep)
+        self._stats.incr('rate_decreases')
+        logger.info("sending %.2f lines per second (%s)",
+                    1.0 / self._line_sleep, reason)
+
+    def _speed_up(self):
+        """Add rate_increase lines per second to the send rate"""
+        rate = 1.0 / self._line_sleep + self._rate_increase
+        self._line_sleep = max(self._min_line_sleep, 1.0 / rate)
+
+    def _next_server(self):
+        """Use the next server of the list for the next connection"""
+        if len(self._servers) < 2:
+            return
+        self._server_index = (self._server_index + 1) % len(self._servers)
+        (self._server, self._port) = self._servers[self._server_index]
+
+    def _schedule_reconnect(self):
+        """Schedule a connection attempt with exponential backoff
+
+        The first attempt is immediate, then the delay doubles each time from
+        reconnection_delay up to reconnection_interval. A random jitter keeps
+        many bots from reconnecting all at once.
+        """
+        if self._stop.is_set() or self._reconnect_scheduled:
+            return
+        delay = 0
+        if self._reconnect_attempts:
+            delay = min(self._reconn_interval, self._reconn_delay *
+                        2 ** (self._reconnect_attempts - 1))
+            delay *= random.uniform(0.5, 1)
+        self._reconnect_attempts += 1
+        self._reconnect_scheduled = True
+        logger.info("reconnecting in %.1f seconds", delay)
+        self._execute_after(delay, self._reconnect)
+
+    def _reconnect(self):
+        """Connection attempt scheduled by _schedule_reconnect"""
+        self._reconnect_scheduled = False
+        if not self.is_connected():
+            self.connect()
+
     def on_nicknameinuse(self, connection, event):
         """Nickname is already in use
 
@@ -165,6 +497,12 @@ class Publisher(irc.client.SimpleIRCClient):
         """
         logger.info("connection made to %s" % event.source)
         self._has_welcome = True
+        self._reconnect_attempts = 0
+        if self._disconnected_at is not None:
+            self._stats.incr('reconnections')
+            self._stats.set('last_reconnection_seconds',
+                            round(time.time() - self._disconnected_at, 3))
+            self._disconnected_at = None
         # Send automessages
         for (channel, message) in self._automessages:
             self.send(channel, message)
@@ -173,11 +511,66 @@ class Publisher(irc.client.SimpleIRCClient):
         if self._notify_systemd:
             send_systemd_notification(b'READY=1\n')
 
+    def on_featurelist(self, connection, event):
+        """Read the features advertised by the server in RPL_ISUPPORT"""
+        self._limits.update(event.arguments)
+        self._set_casemapping(self._limits.casemapping)
+
+    def _set_casemapping(self, casemapping):
+        """Use the casemapping of the server to identify channels"""
+        if casemapping not in kaoz.channel.CASEMAPPINGS:
+            logger.warning("Unknown casemapping %s", casemapping)
+            return
+        if not self._chans.set_casemapping(casemapping):
+            return
+        logger.info("using casemapping %s", casemapping)
+        self._backlog.rekey(self._chans.normalize)
+        self._digest_chans = set(
+            self._chans.normalize(channel) for channel in self._digest_chans)
+        self._channel_ttls = dict(
+            (self._chans.normalize(channel), ttl)
+            for (channel, ttl) in self._channel_ttls.items())
+
     def on_disconnect(self, connection, event):
         """On disconnect, reconnect !"""
         logger.info("disconnect event received")
         self._chans.leave_all()
+        if not self._has_welcome:
+            # This server did not accept us, try the next one
+            self._next_server()
         self._has_welcome = False
+        if self._disconnected_at is None:
+            self._disconnected_at = time.time()
+        self._schedule_reconnect()
+
+    def on_pong(self, connection, event):
+        """Adapt the send rate to the round-trip time to the server
+
+        Servers process the lines of a client which sends too fast with a
+        delay, which delays our PING as well.
+        """
+        if (self._ping_sent is None or
+                event.arguments[-1:] != [self._ping_token]):
+            return
+        rtt = time.time() - self._ping_sent
+        self._ping_sent = None
+        self._stats.set('rtt_seconds', round(rtt, 3))
+        if self._min_rtt is None or rtt < self._min_rtt:
+            self._min_rtt = rtt
+        if rtt > RTT_CONGESTION_FACTOR * self._min_rtt + RTT_CONGESTION_MARGIN:
+            self._slow_down("round-trip time of %.3f seconds" % rtt)
+        elif self._backlog.total:
+            self._speed_up()
+
+    def on_tryagain(self, connection, event):
+        """The server is overloaded (RPL_TRYAGAIN)"""
+        self._slow_down("server asked to try again")
+
+    def on_privnotice(self, connection, event):
+        """Slow down on notices of the server which warn about flooding"""
+        if ('!' not in event.source and event.arguments and
+                FLOOD_NOTICE_RE.search(event.arguments[0])):
+            self._slow_down("notice from %s" % event.source)
 
     def on_join(self, connection, event):
         """Join a new channel, say what we need"""
@@ -187,7 +580,9 @@ class Publisher(irc.client.SimpleIRCClient):
             return
         channel = event.target
         logger.info("Joined channel %s" % channel)
-        self._chans[channel].mark_joined()
+        self._chans.mark_joined(channel)
+        # The prefix of our messages is now known
+        self._source = str(event.source)
 
     def on_kick(self, connection, event):
         """Kicked from a channel"""
@@ -199,8 +594,8 @@ class Publisher(irc.client.SimpleIRCClient):
         channel = event.target
         kicker = event.source
         logger.info("kicked from channel %s by %s" % (channel, kicker))
-        self.connection.notice(kicker,
-                               "That was mean, I'm just a bot you know")
+        self._reply(kicker, 'notice', kicker.nick,
+                    "That was mean, I'm just a bot you know")
         self._chans.leave(channel)
 
     def on_part(self, connection, event):
@@ -218,12 +613,43 @@ class Publisher(irc.client.SimpleIRCClient):
             return
         channel = event.arguments[0]
         logger.info("invited to channel %s" % channel)
-        self.send(channel, "Hello, I've been invited here to spam you ;)")
+        self._reply(event.source, 'channel', channel,
+                    "Hello, I've been invited here to spam you ;)")
 
     def on_privmsg(self, connection, event):
         """Answer to a user privmsg and die on demand"""
-        self.connection.privmsg(event.source.nick,
-                                "I'm a bot, hence I will never answer")
+        self._reply(event.source, 'privmsg', event.source.nick,
+                    "I'm a bot, hence I will never answer")
+
+    def _reply(self, source, kind, target, text):
+        """Queue an automatic reply to source, a NickMask
+
+        Replies are said when no line of a message is waiting, and are
+        dropped rather than delaying messages. kind is 'privmsg' or 'notice'
+        for replies to users, and 'channel' for a message on a channel.
+        """
+        if not self._auto_replies:
+            return
+        sender = source.host or str(source)
+        if self._backlog.total or not self._replies.add(sender, kind, target,
+                                                        text):
+            logger.debug("dropping reply to %s", source)
+            self._stats.incr('replies_dropped')
+
+    def _say_reply(self):
+        """Say the next automatic reply, if any"""
+        reply = self._replies.pop()
+        if reply is None:
+            return
+        (kind, target, text) = reply
+        if kind == 'channel':
+            # Said like messages, after joining the channel
+            self.send(target, text)
+        elif kind == 'notice':
+            self.connection.notice(target, text)
+        else:
+            self.connection.privmsg(target, text)
+        self._stats.incr('replies_sent')
 
     def send(self, channel, message):
         """Send a message to a channel. Join the channel before talking.
@@ -231,11 +657,214 @@ class Publisher(irc.client.SimpleIRCClient):
         This is the interface of this class and is thread-safe.
 
         channel and message are unicode strings.
+
+        Return the identifier of the message.
         """
-        if len(channel.encode('utf8')) > self._channel_maxlen:
-            logger.warning("Channel length limit exceeded, dropping message")
-            return
-        self._queue.put((channel, message))
+        return self.send_many([(channel, message)])[0]
+
+    def send_many(self, messages, source=None, created=None):
+        """Send a list of (channel, message) tuples, like send()
+
+        The whole list is queued at once, after the routing rules chose the
+        channels of each message. source is the address of the client which
+        sent the messages, if any, and created the time at which they
+        arrived, now by default. This is thread-safe.
+
+        Return the list of the identifiers of the messages.
+        """
+        if created is None:
+            created = time.time()
+        router = self._router
+        msgids = self._messages.new_many(len(messages))
+        channel_maxlen = self._channel_maxlen
+        if self._limits.channellen:
+            channel_maxlen = min(channel_maxlen, self._limits.channellen)
+        max_queued_bytes = self._max_queued_bytes
+        queued_bytes = self._backlog.size
+        batch = []
+        counts = dict()
+        batch_size = 0
+        for ((channel, message), msgid) in zip(messages, msgids):
+            channels = [channel]
+            if router is not None:
+                channels = router.route(source, channel, message)
+                if not channels:
+                    self._messages.mark(msgid, kaoz.message.DROPPED)
+                    self._stats.incr('messages_filtered')
+                    continue
+            encoded = message.encode('utf-8')
+            size = len(encoded)
+            copies = 0
+            for channel in channels:
+                if len(channel.encode('utf8')) > channel_maxlen:
+                    logger.warning(
+                        "Channel length limit exceeded, dropping message")
+                    self._stats.incr('messages_dropped')
+                    continue
+                if (max_queued_bytes and
+                        queued_bytes + batch_size + size > max_queued_bytes):
+                    logger.warning(
+                        "Queued bytes limit reached, rejecting message")
+                    self._stats.incr('messages_rejected')
+                    continue
+                batch.append((channel, encoded, msgid, created))
+                batch_size += size
+                key = self._chans.normalize(channel)
+                counts[key] = counts.get(key, 0) + 1
+                copies += 1
+            # A message is dropped only when none of its copies is queued
+            if not copies:
+                self._messages.mark(msgid, kaoz.message.DROPPED)
+            elif copies > 1:
+                self._messages.add_parts(msgid, copies - 1)
+        self._stats.incr('messages_received', len(messages))
+        if batch:
+            self._backlog.add_many(counts, batch_size)
+            with self._queue_lock:
+                self._queue.extend(batch)
+        return msgids
+
+    def status(self, msgid):
+        """Get the MessageStatus of a message, or None if it is unknown"""
+        return self._messages.get(msgid)
+
+    def limits(self):
+        """Get a dictionary of the limits of the server"""
+        limits = self._limits.as_dict()
+        limits['prefixlen'] = self._prefix_len()
+        return limits
+
+    def _prefix_len(self):
+        """Length of the prefix the server adds to relayed messages"""
+        source = self._source
+        if source is None:
+            # Assume the worst until the server tells us
+            source = '%s!~%s@%s' % (self._nickname, self._username,
+                                    'x' * kaoz.isupport.MAX_HOSTLEN)
+        # ':{source} '
+        return len(source.encode('utf-8')) + 2
+
+    def _can_join(self, chanstatus):
+        """Tell whether joining a channel stays within CHANLIMIT"""
+        (prefixes, limit) = self._limits.chanlimit_for(chanstatus.name)
+        if limit is None:
+            return True
+        return self._chans.count_joined(prefixes) < limit
+
+    def _part_idle_channel(self, chanstatus):
+        """Leave the least recently used idle channel which counts in the
+        same CHANLIMIT as chanstatus, to make room for it
+
+        Return False if every joined channel still has lines to say.
+        """
+        (prefixes, limit) = self._limits.chanlimit_for(chanstatus.name)
+        for idle in self._chans.idle_channels():
+            if idle.is_joined() and idle.name[:1] in prefixes:
+                break
+        else:
+            logger.debug("Channel limit reached, %s waits", chanstatus.name)
+            return False
+        logger.info("Leaving %s to join %s", idle.name, chanstatus.name)
+        self.connection.part(idle.name)
+        self._chans.leave(idle.key)
+        self._stats.incr('channels_parted')
+        return True
+
+    def _track_channel(self, channel):
+        """Get the ChanStatus of a channel which receives a message
+
+        When max_channels channels are known, one of them is forgotten to
+        make room for a new one. Return None if none can be.
+        """
+        if channel not in self._chans:
+            if (self._max_channels and len(self._chans) >= self._max_channels
+                    and not self._evict_channel()):
+                return None
+        return self._chans[channel]
+
+    def _update_idle(self, chanstatus):
+        """Tell the channel dictionary whether a channel may be forgotten,
+        because it is either idle or blocked
+        """
+        if chanstatus.digest is None and (
+                not chanstatus.messages or
+                chanstatus.is_blocked(self._max_join_attempts)):
+            self._chans.mark_idle(chanstatus.key)
+        else:
+            self._chans.mark_busy(chanstatus.key)
+
+    def _evict_channel(self):
+        """Forget the least recently used channel which is either idle or
+        blocked, dropping its lines and leaving it if needed.
+
+        Return False if every channel is busy.
+        """
+        while True:
+            chanstatus = self._chans.least_recent_idle()
+            if chanstatus is None:
+                return False
+            if chanstatus.digest is not None or (
+                    chanstatus.messages and not chanstatus.is_blocked(
+                        self._max_join_attempts)):
+                # Its join block expired
+                self._chans.mark_busy(chanstatus.key)
+                continue
+            logger.info("Forgetting channel %s", chanstatus.name)
+            if chanstatus.messages:
+                for line in chanstatus.messages:
+                    self._messages.mark(line.msgid, kaoz.message.DROPPED)
+                self._backlog.remove(
+                    chanstatus.key, len(chanstatus.messages),
+                    sum(line.size() for line in chanstatus.messages))
+                self._stats.incr('messages_dropped', len(chanstatus.messages))
+            if chanstatus.is_joined() and self.is_connected():
+                self.connection.part(chanstatus.name)
+            del self._chans[chanstatus.key]
+            self._stats.incr('channels_evicted')
+            return True
+
+    def stats(self):
+        """Get a dictionary of statistics"""
+        stats = self._stats.snapshot()
+        stats['backlog'] = self._backlog.total
+        stats['backlog_bytes'] = self._backlog.size
+        stats['channels'] = len(self._chans)
+        stats['schedules'] = len(self._scheduler)
+        stats['send_rate'] = round(1.0 / self._line_sleep, 3)
+        return stats
+
+    def latency(self, channel=None):
+        """Get the percentiles of the latency of each stage of the lines
+        which were sent, in total or for a channel, or None if this channel
+        is not tracked. This is thread-safe.
+        """
+        if channel is not None:
+            channel = self._chans.normalize(channel)
+        return self._latency.report(channel)
+
+    def latency_channels(self):
+        """Get (channel, count) tuples of the channels whose latency is
+        tracked, the busiest being first. This is thread-safe.
+        """
+        return self._latency.top()
+
+    def is_busy(self, channel=None):
+        """Tell whether the backlog of a channel is over its watermark"""
+        if channel is not None:
+            channel = self._chans.normalize(channel)
+        return self._backlog.is_busy(channel)
+
+    def wait_ready(self, channel=None, timeout=None):
+        """Wait until channel is not busy, return False on timeout"""
+        if channel is not None:
+            channel = self._chans.normalize(channel)
+        return self._backlog.wait(channel, timeout)
+
+    def retry_after(self, channel=None):
+        """Estimate the number of seconds until channel is not busy"""
+        if channel is not None:
+            channel = self._chans.normalize(channel)
+        return max(1, self._backlog.excess(channel) * self._line_sleep)
 
     def _say_messages(self):
         """Try to send as much waiting messages as possible.
@@ -244,25 +873,61 @@ class Publisher(irc.client.SimpleIRCClient):
         such as publishing a line, joining a chan or something else.
         """
         # Dequeue everything, creating channel objects if needed
-        while not self._queue.empty():
-            (channel, message) = self._queue.get()
+        with self._queue_lock:
+            batch, self._queue = self._queue, []
+        queued = time.time()
+        prefix_len = self._prefix_len()
+        for (channel, encoded, msgid, created) in batch:
+            size = len(encoded)
             # Split message if it is too long
             channel_length = len(channel.encode('utf8'))
-            max_message_size = IRC_CHANMSG_MAXLEN - channel_length
+            max_message_size = min(
+                IRC_CHANMSG_MAXLEN - channel_length,
+                self._limits.payload_len(channel_length, prefix_len))
             # Need at least 5 characters
             if max_message_size <= 5:
                 logger.error("Channel name too long, dropping message")
+                self._backlog.remove(self._chans.normalize(channel), 1, size)
+                self._messages.mark(msgid, kaoz.message.DROPPED)
+                self._stats.incr('messages_dropped')
                 continue
-            encoded = message.encode('utf-8')
-            while len(encoded) > max_message_size:
-                left, encoded = utf8_cut(encoded, max_message_size)
-                if not left:
-                    logger.error("Unable to decode message, dropping it")
-                    break
-                self._chans[channel].messages.append(left.decode('utf-8'))
-            if encoded and len(encoded) <= max_message_size:
-                self._chans[channel].messages.append(
-                    encoded.decode('utf-8', 'ignore'))
+            chanstatus = self._track_channel(channel)
+            if chanstatus is None:
+                logger.warning("Too many channels, rejecting message for %s",
+                               channel)
+                self._backlog.remove(self._chans.normalize(channel), 1, size)
+                self._messages.mark(msgid, kaoz.message.DROPPED)
+                self._stats.incr('messages_rejected')
+                continue
+            self._chans.mark_busy(chanstatus.key)
+            if self._digest_threshold and (
+                    chanstatus.digest is not None
+                    or len(chanstatus.messages) >= self._digest_threshold):
+                self._digest_message(chanstatus, encoded, msgid)
+                continue
+            lengths = utf8_split(encoded, max_message_size)
+            queued_size = sum(lengths)
+            if queued_size < size:
+                logger.error("Unable to split message, dropping its end")
+            chanstatus.messages.append_parts(encoded, lengths, msgid, created,
+                                             queued)
+            # Account for split messages, which may be several lines or none
+            num_messages = len(lengths)
+            if num_messages < 1:
+                self._backlog.remove(chanstatus.key, 1, size)
+                self._messages.mark(msgid, kaoz.message.DROPPED)
+                self._stats.incr('messages_dropped')
+                self._update_idle(chanstatus)
+                continue
+            if num_messages > 1 or queued_size != size:
+                self._backlog.add(chanstatus.key, num_messages - 1,
+                                  queued_size - size)
+            if num_messages > 1:
+                self._messages.add_parts(msgid, num_messages - 1)
+
+        # Automatic replies make way for messages
+        if self._replies and self._backlog.total:
+            self._stats.incr('replies_dropped', self._replies.clear())
 
         # Don't do anything if server is stopped
         if self._stop.is_set():
@@ -275,30 +940,152 @@ class Publisher(irc.client.SimpleIRCClient):
         # Find the next channel which needs work
         chanstatus = self._chans.find_waiting_channel()
         if chanstatus is None:
+            # Automatic replies only use the slots messages don't need
+            self._say_reply()
             return
 
+        # Discard stale messages instead of delaying fresh ones
+        self._expire_lines(chanstatus)
+
         # Join the channel if needed
         if chanstatus.need_join():
-            if chanstatus.inc_join_counter(self._max_join_attempts,
-                                           self._memory_timeout):
+            if not self._can_join(chanstatus):
+                # Make room, or keep the lines until a channel becomes idle
+                self._part_idle_channel(chanstatus)
+            elif chanstatus.inc_join_counter(self._max_join_attempts,
+                                             self._memory_timeout):
                 self.connection.join(chanstatus.name)
-            elif self._fallbackchan and chanstatus.name != self._fallbackchan:
+            elif (self._fallbackchan and chanstatus.key !=
+                  self._chans.normalize(self._fallbackchan)):
                 # Channel is blocked. Do fallback !
-                logger.warning("Channel %s is blocked. Using fallback" %
+                logger.warning("Channel %s is blocked. Using fallback",
                                chanstatus.name)
-                message = chanstatus.messages.pop(0)
-                self._chans[self._fallbackchan].messages.append(message)
+                line = chanstatus.messages.popleft()
+                fallback = self._chans[self._fallbackchan]
+                fallback.messages.append(line.data, line.msgid, line.created,
+                                         line.queued)
+                self._backlog.remove(chanstatus.key)
+                self._backlog.add(fallback.key)
+                self._chans.mark_busy(fallback.key)
             else:
-                logger.error("Channel %s is blocked. Dropping message" %
+                logger.error("Channel %s is blocked. Dropping message",
                              chanstatus.name)
-                message = chanstatus.messages.pop(0)
-                logger.error("Dropped message was %s" % message)
+                line = chanstatus.messages.popleft()
+                self._backlog.remove(chanstatus.key, 1, line.size())
+                self._messages.mark(line.msgid, kaoz.message.DROPPED)
+                self._stats.incr('messages_dropped')
+                logger.error("Dropped message was %s", line.text)
+            self._update_idle(chanstatus)
             return
 
         # Say first message and unqueue
-        message = chanstatus.messages.pop(0)
-        logger.info("[%s] say %s" % (chanstatus.name, message))
-        self.connection.privmsg(chanstatus.name, message)
+        line = chanstatus.messages.popleft()
+        self._backlog.remove(chanstatus.key, 1, line.size())
+        text = line.text
+        logger.info("[%s] say %s", chanstatus.name, text)
+        self.connection.privmsg(chanstatus.name, text)
+        self._messages.part_sent(line.msgid)
+        self._stats.incr('lines_sent')
+        self._trace_latency(chanstatus, line)
+        self._update_idle(chanstatus)
+
+    def _trace_latency(self, chanstatus, line):
+        """Count the latency of each stage of a line which was just sent"""
+        now = time.time()
+        ready = line.queued
+        if chanstatus.joined_at is not None:
+            ready = max(ready, chanstatus.joined_at)
+        self._latency.add(chanstatus.key, chanstatus.name, (
+            line.queued - line.created, ready - line.queued, now - ready,
+            now - line.created))
+
+    def _digest_message(self, chanstatus, encoded, msgid):
+        """Count an encoded message in the digest of its channel instead of
+        saying it
+        """
+        if chanstatus.digest is None:
+            logger.warning("Backlog of %s is too long, switching to digest",
+                           chanstatus.name)
+            chanstatus.digest = kaoz.channel.Digest()
+            self._digest_chans.add(chanstatus.key)
+        chanstatus.digest.add(encoded.decode('utf-8'))
+        self._backlog.remove(chanstatus.key, 1, len(encoded))
+        self._messages.mark(msgid, kaoz.message.DIGESTED)
+        self._stats.incr('messages_digested')
+
+    def _flush_digests(self):
+        """Queue the summary of every digest, and leave digest mode for
+        channels whose backlog cleared.
+
+        This function is called every "digest_interval" seconds.
+        """
+        for channel in list(self._digest_chans):
+            chanstatus = self._chans[channel]
+            backlog_cleared = (
+                len(chanstatus.messages) < max(1, self._digest_threshold // 2))
+            summary = [text.encode('utf-8') for text in
+                       chanstatus.digest.summary(self._digest_lines)]
+            for data in summary:
+                chanstatus.messages.append(data)
+            self._backlog.add(chanstatus.key, len(summary),
+                              sum(len(data) for data in summary))
+            if backlog_cleared:
+                logger.info("Backlog of %s cleared, leaving digest", channel)
+                chanstatus.digest = None
+                self._digest_chans.discard(channel)
+                self._update_idle(chanstatus)
+            else:
+                chanstatus.digest = kaoz.channel.Digest()
+
+    def _expire_lines(self, chanstatus):
+        """Drop the lines older than the TTL at the head of a channel
+
+        Lines are mostly ordered by age, so this stops at the first fresh
+        line. Expired lines are replaced by a single summary line, which
+        counts messages rather than the lines they were split into. A
+        summary still at the head is merged into the next one.
+        """
+        ttl = self._channel_ttls.get(chanstatus.key, self._message_ttl)
+        if not ttl:
+            return
+        deadline = time.time() - ttl
+        messages = chanstatus.messages
+        summary = None
+        if chanstatus.expired and messages:
+            # The previous summary is fresh and would hold back stale lines
+            head = messages.first()
+            if (head.msgid is None and
+                    head.data == expired_summary(chanstatus.expired)):
+                summary = messages.popleft()
+        expired = chanstatus.expired if summary is not None else 0
+        expired_lines = 0
+        expired_size = 0
+        last_msgid = None
+        while messages and messages.first_created() < deadline:
+            line = messages.popleft()
+            self._messages.mark(line.msgid, kaoz.message.EXPIRED)
+            # The parts of a split message follow each other
+            if line.msgid is None or line.msgid != last_msgid:
+                expired += 1
+            last_msgid = line.msgid
+            expired_lines += 1
+            expired_size += line.size()
+        if not expired_lines:
+            if summary is not None:
+                messages.appendleft(summary.data, None, summary.created)
+            return
+        logger.warning("%d lines expired on %s", expired_lines,
+                       chanstatus.name)
+        self._stats.incr('lines_expired', expired_lines)
+        data = expired_summary(expired)
+        removed = expired_lines - 1
+        if summary is not None:
+            removed += 1
+            expired_size += summary.size()
+        self._backlog.remove(chanstatus.key, removed,
+                             expired_size - len(data))
+        messages.appendleft(data)
+        chanstatus.expired = expired
 
     def is_connected(self):
         """Tell wether the bot is connected or not"""
@@ -306,7 +1093,7 @@ class Publisher(irc.client.SimpleIRCClient):
 
     def channels(self):
         """Return the list of chans the server has joined"""
-        chanlist = [name for name, chan in self._chans.items()
+        chanlist = [chan.name for chan in self._chans.values()
                     if not chan.need_join()]
         chanlist.sort()
         return chanlist
@@ -315,6 +1102,41 @@ class Publisher(irc.client.SimpleIRCClient):
         """Tell wether the connection is stopped"""
         return self._stop.is_set()
 
+    def drain(self, timeout):
+        """Say waiting messages faster, until none is left or timeout expires
+
+        This is thread-safe and returns the number of lines still waiting.
+        """
+        with self.reactor.mutex:
+            # Digested messages would otherwise be lost
+            self._flush_digests()
+            self._line_sleep = min(self._line_sleep, self._drain_line_sleep)
+            self._adaptive_rate = False
+        deadline = time.time() + timeout
+        while self._backlog.total > 0 and time.time() < deadline:
+            logger.info("draining, %d lines left", self._backlog.total)
+            if self._notify_systemd:
+                send_systemd_notification(
+                    ('STATUS=Draining, %d lines left\n' %
+                     self._backlog.total).encode('ascii'))
+            time.sleep(min(1, max(0, deadline - time.time())))
+        return self._backlog.total
+
+    def waiting_lines(self):
+        """Get the (channel, message) tuples which are still waiting
+
+        This is not thread-safe and should only be used once stopped.
+        """
+        lines = []
+        for chanstatus in self._chans.values():
+            lines.extend((chanstatus.name, line.text)
+                         for line in chanstatus.messages)
+        with self._queue_lock:
+            lines.extend((channel, encoded.decode('utf-8'))
+                         for (channel, encoded, msgid, created) in self._queue)
+            self._queue = []
+        return lines
+
     def run(self):
         """Infinite loop of message processing"""
         # There is a periodic task which checks connection
@@ -356,7 +1178,7 @@ class PublisherThread(threading.Thread):
         """
         self._publisher = Publisher(config, notify_systemd=notify_systemd,
                                     *args, **kwargs)
-        super(PublisherThread, self).__init__()
+        super(PublisherThread, self).__init__(name='publisher')
         self._event = event
         self._debug = debug
         self._notify_systemd = notify_systemd
@@ -383,21 +1205,83 @@ class PublisherThread(threading.Thread):
         self.join()
 
     def send(self, channel, message):
-        self._publisher.send(channel, message)
+        return self._publisher.send(channel, message)
 
-    def send_line(self, line):
-        """Process a line which contains channel:message"""
-        line_parts = line.split(':', 1)
-        if len(line_parts) != 2:
-            logger.warning("Invalid message: %s", line)
-            return
+    def send_line(self, line, source=None):
+        """Process a line which contains channel:message
+
+        Return the identifier of the message, or None if the line is invalid.
+        """
+        return self.send_lines([line], source)[0]
+
+    def send_many(self, messages, source=None, created=None):
+        return self._publisher.send_many(messages, source, created)
+
+    def send_lines(self, lines, source=None):
+        """Process a list of lines which contain channel:message, sent from
+        the source address
+
+        Return the list of the identifiers of the messages, with None for
+        invalid lines.
+        """
+        messages = []
+        for line in lines:
+            line_parts = line.split(':', 1)
+            if len(line_parts) != 2:
+                logger.warning("Invalid message: %s", line)
+                continue
+            messages.append(line_parts)
+        msgids = iter(self._publisher.send_many(messages, source))
+        return [next(msgids) if ':' in line else None for line in lines]
+
+    def status(self, msgid):
+        return self._publisher.status(msgid)
+
+    def reload(self, config):
+        return self._publisher.reload(config)
+
+    def stats(self):
+        return self._publisher.stats()
+
+    def latency(self, channel=None):
+        return self._publisher.latency(channel)
+
+    def schedule(self, value):
+        return self._publisher.schedule(value)
 
-        channel, message = line_parts
-        self.send(channel, message)
+    def cancel_schedule(self, schedid):
+        return self._publisher.cancel_schedule(schedid)
+
+    def save_schedules(self):
+        return self._publisher.save_schedules()
+
+    def latency_channels(self):
+        return self._publisher.latency_channels()
+
+    def limits(self):
+        return self._publisher.limits()
 
     def channels(self):
         return self._publisher.channels()
 
+    def is_stopped(self):
+        return self._publisher.is_stopped()
+
+    def drain(self, timeout):
+        return self._publisher.drain(timeout)
+
+    def waiting_lines(self):
+        return self._publisher.waiting_lines()
+
+    def is_busy(self, channel=None):
+        return self._publisher.is_busy(channel)
+
+    def wait_ready(self, channel=None, timeout=None):
+        return self._publisher.wait_ready(channel, timeout)
+
+    def retry_after(self, channel=None):
+        return self._publisher.retry_after(channel)
+
     def __enter__(self):
         self.start()
         return self
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+# This file is a part of Kaoz, a free irc notifier
+
+"""Automatic replies of the bot to other users
+
+Anyone may talk to the bot, so its replies are budgeted: each sender may get
+burst replies, and one more every interval seconds. Replies wait in a small
+queue, where a reply which is already waiting is not added twice.
+"""
+
+import collections
+import time
+
+
+class ReplyQueue(object):
+    """Queue of (kind, target, text) replies, limited per sender
+
+    This is not thread-safe, it is only used from the reactor.
+    """
+
+    def __init__(self, size=10, burst=3, interval=60, max_senders=10000):
+        self.size = size
+        self.burst = burst
+        self.interval = interval
+        self.max_senders = max_senders
+        self._replies = collections.deque()
+        # Sender => (budget, time it was computed)
+        self._budgets = dict()
+
+    def __len__(self):
+        return len(self._replies)
+
+    def _take_budget(self, sender, now):
+        """Use one reply of the budget of a sender, return False if none is
+        left
+        """
+        budget, updated = self._budgets.get(sender, (self.burst, now))
+        if self.interval:
+            budget = min(self.burst,
+                         budget + (now - updated) / float(self.interval))
+        if budget < 1:
+            self._budgets[sender] = (budget, now)
+            return False
+        if sender not in self._budgets and (
+                len(self._budgets) >= self.max_senders):
+            self._budgets.clear()
+        self._budgets[sender] = (budget - 1, now)
+        return True
+
+    def add(self, sender, kind, target, text, now=None):
+        """Queue a reply to sender, return False if it was dropped"""
+        reply = (kind, target, text)
+        if len(self._replies) >= self.size or reply in self._replies:
+            return False
+        if not self._take_budget(sender, time.time() if now is None else now):
+            return False
+        self._replies.append(reply)
+        return True
+
+    def pop(self):
+        """Get the next reply, or None"""
+        return self._replies.popleft() if self._replies else None
+
+    def clear(self):
+        """Drop every waiting reply and return their number"""
+        count = len(self._replies)
+        self._replies.clear()
+        return count
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+# This file is a part of Kaoz, a free irc notifier
+
+"""Rules which choose the channels of messages before they are queued
+
+A rule is written "conditions -> action", for example:
+
+    source:10.0.* channel:#alerts-* message:^CRITICAL -> to #ops #oncall
+
+Conditions are optional and all have to match: source and channel are shell
+patterns on the address of the client and the name of the channel, message
+is a regular expression searched in the message. The action is "drop", "to"
+followed by the channels which replace the channel of the message, or "copy"
+followed by channels which get the message too. The first matching rule
+applies.
+
+Patterns can't contain spaces, use \\s in regular expressions instead.
+"""
+
+import fnmatch
+import re
+
+
+ACTIONS = ('drop', 'to', 'copy')
+
+# Backreferences, whose group numbers change once expressions are merged
+_backref_re = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class Rule(object):
+    """A routing rule"""
+
+    def __init__(self, name, value):
+        """Parse a rule. Raise ValueError if it is not valid"""
+        self.name = name
+        conditions, arrow, action = value.partition('->')
+        if not arrow:
+            raise ValueError("missing ->")
+        self.source = None
+        self.channel = None
+        self.message = None
+        for condition in conditions.split():
+            kind, colon, pattern = condition.partition(':')
+            if not colon or not pattern:
+                raise ValueError("invalid condition %s" % condition)
+            if kind == 'source':
+                self.source = re.compile(fnmatch.translate(pattern))
+            elif kind == 'channel':
+                self.channel = re.compile(fnmatch.translate(pattern),
+                                          re.IGNORECASE)
+            elif kind == 'message':
+                try:
+                    self.message = re.compile(pattern)
+                except re.error as e:
+                    raise ValueError("invalid expression %s (%s)" %
+                                     (pattern, e))
+            else:
+                raise ValueError("unknown condition %s" % kind)
+        action = action.split()
+        if not action or action[0] not in ACTIONS:
+            raise ValueError("unknown action")
+        self.action = action[0]
+        self.channels = action[1:]
+        if (self.action == 'drop') != (not self.channels):
+            raise ValueError("invalid channels for %s" % self.action)
+
+    def matches(self, source, message):
+        """Tell whether a message of a matching channel matches this rule"""
+        if self.source is not None and (
+                source is None or not self.source.match(source)):
+            return False
+        return self.message is None or bool(self.message.search(message))
+
+    def apply(self, channel):
+        """Get the channels of a message"""
+        if self.action == 'to':
+            return self.channels
+        elif self.action == 'copy':
+            return [channel] + self.channels
+        return []
+
+
+class Router(object):
+    """Compiled list of routing rules
+
+    For each channel, the rules whose channel pattern matches are found once
+    and remembered. The message expressions of consecutive rules are merged
+    into a single one, which rules most messages out in one search. This
+    keeps the cost of routing a message mostly independent of the number of
+    rules, even when some of them have no message condition.
+    """
+
+    def __init__(self, rules, cache_size=10000):
+        self.rules = rules
+        self.cache_size = cache_size
+        # Channel => list of (merged message expression or None, rules),
+        # in the order of the rules
+        self._candidates = dict()
+
+    @staticmethod
+    def _merge(rules):
+        """Merge the message expressions of rules, or return None if they
+        can't be
+        """
+        patterns = [rule.message.pattern for rule in rules]
+        if len(patterns) < 2 or any(_backref_re.search(p) for p in patterns):
+            return None
+        try:
+            return re.compile('|'.join('(?:%s)' % p for p in patterns))
+        except re.error:
+            # Some flags and group names can't be merged
+            return None
+
+    def _get_candidates(self, channel):
+        """Get the groups of rules which may apply to a channel"""
+        candidates = self._candidates.get(channel)
+        if candidates is not None:
+            return candidates
+        candidates = []
+        # Consecutive rules with a message condition
+        run = []
+        for rule in self.rules:
+            if rule.channel is not None and not rule.channel.match(channel):
+                continue
+            if rule.message is not None:
+                run.append(rule)
+                continue
+            if run:
+                candidates.append((self._merge(run), run))
+                run = []
+            candidates.append((None, [rule]))
+        if run:
+            candidates.append((self._merge(run), run))
+        if len(self._candidates) >= self.cache_size:
+            self._candidates.clear()
+        self._candidates[channel] = candidates
+        return candidates
+
+    def route(self, source, channel, message):
+        """Get the list of channels of a message, which may be empty
+
+        source is the address of the client which sent it, or None.
+        """
+        for (merged, rules) in self._get_candidates(channel):
+            if merged is not None and not merged.search(message):
+                continue
+            for rule in rules:
+                if rule.matches(source, message):
+                    return rule.apply(channel)
+        return [channel]
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+# This file is a part of Kaoz, a free irc notifier
+
+"""Messages scheduled for a future time, or on a recurring interval
+
+A schedule is written "<when> <channel> <message>", where when is one of:
+
+    in <duration>       once, after duration
+    at <time>           once, at a time given as a Unix timestamp or as
+                        YYYY-MM-DDTHH:MM[:SS] in local time, which must not
+                        be in the past
+    every <duration>    every duration, starting after one duration
+
+Durations are a number of seconds, optionally followed by m, h or d for
+minutes, hours or days.
+"""
+
+import heapq
+import itertools
+import json
+import threading
+import time
+
+# Seconds in a unit of duration
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# Formats of times after "at"
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M')
+
+
+def parse_duration(value):
+    """Get a number of seconds from a duration like 90, 90s, 5m or 1h
+
+    Raise ValueError if it is not valid or not positive.
+    """
+    factor = DURATION_UNITS.get(value[-1:])
+    if factor is not None:
+        value = value[:-1]
+    else:
+        factor = 1
+    if not value.isdigit() or not int(value):
+        raise ValueError("invalid duration")
+    return int(value) * factor
+
+
+def parse_time(value):
+    """Get a Unix timestamp from a timestamp or a local time"""
+    if value.isdigit():
+        return float(value)
+    for time_format in TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(value, time_format))
+        except ValueError:
+            pass
+    raise ValueError("invalid time")
+
+
+def parse_schedule(value, now=None):
+    """Parse "<when> <channel> <message>" into a (when, interval, channel,
+    message) tuple, interval being 0 for messages sent once
+
+    Raise ValueError if it is not valid.
+    """
+    now = time.time() if now is None else now
+    fields = value.split(None, 3)
+    if len(fields) < 4:
+        raise ValueError("expected <when> <channel> <message>")
+    kind, argument, channel, message = fields
+    interval = 0
+    if kind == 'in':
+        when = now + parse_duration(argument)
+    elif kind == 'at':
+        when = parse_time(argument)
+        if when < now:
+            raise ValueError("time is in the past")
+    elif kind == 'every':
+        interval = parse_duration(argument)
+        when = now + interval
+    else:
+        raise ValueError("expected in, at or every")
+    return (when, interval, channel, message)
+
+
+class ScheduledMessage(object):
+    """A message to send at a given time, and every interval seconds after
+    it if interval is not 0
+
+    Messages which persist are saved with the schedules, unlike the ones
+    from the configuration.
+    """
+
+    __slots__ = ('schedid', 'when', 'interval', 'channel', 'message',
+                 'persist', 'cancelled')
+
+    def __init__(self, schedid, when, interval, channel, message,
+                 persist=True):
+        self.schedid = schedid
+        self.when = when
+        self.interval = interval
+        self.channel = channel
+        self.message = message
+        self.persist = persist
+        self.cancelled = False
+
+    def as_dict(self):
+        return dict((name, getattr(self, name))
+                    for name in ('schedid', 'when', 'interval', 'channel',
+                                 'message'))
+
+
+class Scheduler(object):
+    """Thread-safe heap of scheduled messages, the next one being first
+
+    Adding, cancelling and taking out a message costs O(log n). Cancelled
+    messages are left in the heap and skipped, until they are half of it.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # Identifier => ScheduledMessage
+        self._messages = dict()
+        self._counter = itertools.count(1)
+        # Order of messages scheduled at the same time
+        self._sequence = itertools.count()
+        self._cancelled = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, when, interval, channel, message, schedid=None,
+            persist=True):
+        """Schedule a message and return its identifier
+
+        An existing message with the same identifier is replaced.
+        """
+        with self._lock:
+            if schedid is None:
+                schedid = '%x' % next(self._counter)
+                while schedid in self._messages:
+                    schedid = '%x' % next(self._counter)
+            self._cancel(schedid)
+            scheduled = ScheduledMessage(schedid, when, interval, channel,
+                                         message, persist)
+            self._messages[schedid] = scheduled
+            heapq.heappush(self._heap,
+                           (when, next(self._sequence), scheduled))
+            return schedid
+
+    def cancel(self, schedid):
+        """Cancel a message, return False if it is unknown"""
+        with self._lock:
+            return self._cancel(schedid)
+
+    def _cancel(self, schedid):
+        scheduled = self._messages.pop(schedid, None)
+        if scheduled is None:
+            return False
+        scheduled.cancelled = True
+        self._cancelled += 1
+        if self._cancelled > 64 and 2 * self._cancelled > len(self._heap):
+            self._heap = [item for item in self._heap
+                          if not item[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+        return True
+
+    def _drop_cancelled(self):
+        """Take the cancelled messages at the top of the heap out"""
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+    def next_time(self):
+        """Get the time of the next message, or None"""
+        with self._lock:
+            self._drop_cancelled()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """Get the (channel, message) tuples which are due
+
+        Recurring messages are scheduled again, once even if several
+        intervals were missed.
+        """
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            self._drop_cancelled()
+            while self._heap and self._heap[0][0] <= now:
+                scheduled = self._heap[0][2]
+                due.append((scheduled.channel, scheduled.message))
+                if scheduled.interval:
+                    missed = (now - scheduled.when) // scheduled.interval
+                    scheduled.when += (missed + 1) * scheduled.interval
+                    heapq.heapreplace(self._heap, (
+                        scheduled.when, next(self._sequence), scheduled))
+                else:
+                    heapq.heappop(self._heap)
+                    del self._messages[scheduled.schedid]
+                self._drop_cancelled()
+        return due
+
+    def save(self, filename):
+        """Write the messages which persist to a file"""
+        with self._lock:
+            schedules = [scheduled.as_dict()
+                         for scheduled in self._messages.values()
+                         if scheduled.persist]
+        with open(filename, 'w') as f:
+            json.dump(schedules, f)
+
+    def load(self, filename):
+        """Add the messages saved in a file, return their number
+
+        Raise IOError if the file can't be read, and ValueError if its
+        content is not valid.
+        """
+        with open(filename) as f:
+            schedules = json.load(f)
+        try:
+            for schedule in schedules:
+                self.add(float(schedule['when']), int(schedule['interval']),
+                         schedule['channel'], schedule['message'],
+                         schedule['schedid'])
+        except (KeyError, TypeError) as e:
+            raise ValueError("invalid schedule (%s)" % e)
+        return len(schedules)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+# This file is a part of Kaoz, a free irc notifier
+
+import array
+import math
+import threading
+
+
+class Stats(object):
+    """Thread-safe set of named counters"""
+
+    def __init__(self):
+        self._counters = dict()
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        """Increase a counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """Set the value of a counter"""
+        with self._lock:
+            self._counters[name] = value
+
+    def get(self, name):
+        """Get the value of a counter"""
+        return self._counters.get(name, 0)
+
+    def snapshot(self):
+        """Get a copy of every counter"""
+        with self._lock:
+            return dict(self._counters)
+
+
+class Histogram(object):
+    """Histogram of durations, in buckets of exponentially growing width
+
+    Memory use is fixed: durations from min_value seconds to about
+    min_value * growth ** buckets seconds are counted, with a relative error
+    bounded by growth, and others fall into the first or last bucket.
+    """
+
+    __slots__ = ('min_value', 'growth', 'counts', 'count')
+
+    def __init__(self, min_value=0.001, growth=2 ** 0.25, buckets=100):
+        self.min_value = min_value
+        self.growth = growth
+        self.counts = array.array('L', [0] * buckets)
+        self.count = 0
+
+    def add(self, value):
+        """Count a duration"""
+        if value < self.min_value:
+            i = 0
+        else:
+            i = min(len(self.counts) - 1, 1 + int(
+                math.log(value / self.min_value, self.growth)))
+        self.counts[i] += 1
+        self.count += 1
+
+    def percentile(self, p):
+        """Get the upper bound of the bucket where percentile p falls, or
+        None if the histogram is empty
+        """
+        if not self.count:
+            return None
+        rank = p * self.count / 100.0
+        total = 0
+        for (i, count) in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                break
+        return self.min_value * self.growth ** i
+
+
+class Latency(object):
+    """Thread-safe histograms of the latency of each stage of messages
+
+    A histogram per stage is kept in total, and for at most max_channels
+    channels. When a new channel has to be tracked, the channel with the
+    fewest counted messages is forgotten, and the new one inherits its count,
+    so that the busiest channels end up tracked.
+    """
+
+    # Percentiles given by report()
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, stages, max_channels=10):
+        self.stages = stages
+        self.max_channels = max_channels
+        self._total = self._new_histograms()
+        # Channel => [count, name, histograms]
+        self._channels = dict()
+        self._lock = threading.Lock()
+
+    def _new_histograms(self):
+        return [Histogram() for stage in self.stages]
+
+    def add(self, channel, name, durations):
+        """Count the durations of the stages of a message of a channel
+
+        channel identifies the channel and name is the one to report.
+        """
+        with self._lock:
+            for (histogram, duration) in zip(self._total, durations):
+                histogram.add(duration)
+            if not self.max_channels:
+                return
+            entry = self._channels.get(channel)
+            if entry is None:
+                count = 0
+                if len(self._channels) >= self.max_channels:
+                    evicted = min(self._channels,
+                                  key=lambda c: self._channels[c][0])
+                    count = self._channels.pop(evicted)[0]
+                entry = [count, name, self._new_histograms()]
+                self._channels[channel] = entry
+            entry[0] += 1
+            for (histogram, duration) in zip(entry[2], durations):
+                histogram.add(duration)
+
+    def _report(self, histograms):
+        """Get the count and percentiles of histograms, by name"""
+        report = dict()
+        for (stage, histogram) in zip(self.stages, histograms):
+            report['%s_count' % stage] = histogram.count
+            for p in self.PERCENTILES:
+                value = histogram.percentile(p)
+                report['%s_p%d' % (stage, p)] = (
+                    '-' if value is None else '%.3f' % value)
+        return report
+
+    def report(self, channel=None):
+        """Get the percentiles of the latency of each stage, in seconds, in
+        total or for a channel. Return None if channel is not tracked.
+        """
+        with self._lock:
+            if channel is None:
+                return self._report(self._total)
+            entry = self._channels.get(channel)
+            if entry is None:
+                return None
+            return self._report(entry[2])
+
+    def top(self):
+        """Get (name, count) tuples of the tracked channels, the busiest
+        being first
+        """
+        with self._lock:
+            entries = sorted(self._channels.values(), key=lambda e: -e[0])
+            return [(name, count) for (count, name, histograms) in entries]
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+"""Micro-benchmarks of Kaoz internals, used for performance work only
+
+Usage: python -m kaoz.tests.benchmark [options] [benchmark...]
+"""
+
+import logging
+import optparse
+import sys
+import time
+
+import kaoz.listener
+import kaoz.publishbot
+import kaoz.routing
+
+from .common import get_local_conf
+
+
+# Benchmark name => function(count)
+BENCHMARKS = dict()
+
+
+def benchmark(function):
+    """Register a benchmark"""
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def report(name, elapsed, count, unit='line'):
+    """Display the cost of one item"""
+    print("%-40s %10.3f us/%s" % (name, elapsed * 1e6 / count, unit))
+
+
+def report_size(name, size, count, unit='line'):
+    """Display the memory used by one item"""
+    print("%-40s %10.1f bytes/%s" % (name, float(size) / count, unit))
+
+
+@benchmark
+def ingest(count):
+    """Cost of sending lines one by one or in batches, up to their dequeuing
+    """
+    config = get_local_conf()
+    lines = ["#chan%d:Message number %d" % (i % 10, i) for i in range(count)]
+    for batch_size in (1, 10, 100, 1000):
+        pub = kaoz.publishbot.PublisherThread(config)
+        start = time.time()
+        if batch_size == 1:
+            for line in lines:
+                pub.send_line(line)
+        else:
+            for i in range(0, count, batch_size):
+                pub.send_lines(lines[i:i + batch_size])
+        # Dequeue lines, as the publisher is not connected
+        pub._publisher._say_messages()
+        report("ingest, batches of %d" % batch_size, time.time() - start,
+               count)
+
+
+class ChunkSocket(object):
+    """Socket which receives data in chunks of a given size"""
+
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.offset = 0
+
+    def recv(self, size):
+        size = min(size, self.chunk_size)
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+
+class NullPublisher(object):
+    """Publisher which accepts messages and does nothing with them"""
+
+    def send_many(self, messages, source=None):
+        return [None] * len(messages)
+
+    def is_busy(self, channel=None):
+        return False
+
+
+@benchmark
+def parse(count):
+    """Cost of parsing the lines received by the listener, up to their
+    queuing by the publisher, which is not measured
+    """
+    config = get_local_conf()
+    config.set('listener', 'port', '0')
+    password = config.get('listener', 'password')
+    # The server is not started, only its settings are used
+    listener = kaoz.listener.TCPListener(None, config)
+    server = listener._server
+    server.server_close()
+    # Invalid lines are logged, which is not measured
+    kaoz.listener.logger.setLevel(logging.ERROR)
+    valid = ''.join("%s:#chan%d:Message number %d\n" % (password, i % 10, i)
+                    for i in range(count)).encode('utf-8')
+    invalid = ''.join("invalid-%s:#chan%d:Message number %d\n" % (
+        password, i % 10, i) for i in range(count)).encode('utf-8')
+    for (name, data) in (("valid", valid), ("bad password", invalid)):
+        for chunk_size in (1024, 65536):
+            # Lines were split by the thread in older versions
+            server.publisher = object.__new__(kaoz.publishbot.PublisherThread)
+            server.publisher._publisher = NullPublisher()
+            handler = object.__new__(kaoz.listener.TCPListenerHandler)
+            handler.server = server
+            handler.client_address = ('127.0.0.1', 0)
+            handler.sock = ChunkSocket(data, chunk_size)
+            handler.ack = False
+            handler.batch = []
+            start = time.time()
+            handler.handle()
+            report("parse, %s, %d byte chunks" % (name, chunk_size),
+                   time.time() - start, count)
+
+
+@benchmark
+def routing(count):
+    """Cost of routing messages, depending on the number of rules, with and
+    without a first rule which has no message condition
+    """
+    messages = [("#chan%d" % (i % 100), "Message number %d" % i)
+                for i in range(count)]
+    for num_rules in (0, 10, 100, 1000):
+        rules = []
+        for i in range(num_rules):
+            if i % 2:
+                value = "channel:#team%d-* -> to #team%d" % (i, i)
+            else:
+                value = r"message:^ALERT\s%d\b -> copy #alerts" % i
+            rules.append(kaoz.routing.Rule('rule%d' % i, value))
+        for source_rule in (False, True):
+            name = "routing, %d rules" % num_rules
+            if source_rule:
+                name += " after a source rule"
+                rules = [kaoz.routing.Rule(
+                    'audit', "source:10.* -> copy #audit")] + rules
+            router = kaoz.routing.Router(rules)
+            start = time.time()
+            for (channel, message) in messages:
+                router.route('127.0.0.1', channel, message)
+            report(name, time.time() - start, count)
+
+
+@benchmark
+def queue_memory(count):
+    """Memory used by lines waiting to be said, once dequeued
+
+    The index of message states is disabled, as its size is bounded anyway.
+    """
+    # Python 3.4 and newer only
+    import tracemalloc
+    config = get_local_conf()
+    config.set('irc', 'message_index_size', '0')
+    for num_chans in (1, 100):
+        pub = kaoz.publishbot.Publisher(config)
+        lines = [("#chan%d" % (i % num_chans), "Message number %d" % i)
+                 for i in range(count)]
+        tracemalloc.start()
+        for i in range(0, count, 1000):
+            pub.send_many(lines[i:i + 1000])
+            pub._say_messages()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        pub.stop()
+        report_size("queued lines, %d channels" % num_chans, size, count)
+
+
+def main(argv):
+    """Run benchmarks"""
+    parser = optparse.OptionParser(
+        usage="usage: %prog [options] [benchmark...]")
+    parser.add_option(
+        '-n', '--count', action='store', dest='count', type='int',
+        default=100000, help="number of items per benchmark", metavar="COUNT")
+
+    opts, args = parser.parse_args(argv[1:])
+    names = args or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % name)
+    for name in names:
+        BENCHMARKS[name](opts.count)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -26,13 +26,17 @@ def get_local_conf(filename=None):
     return config
 
 
-def spawn_ircserver(config):
-    """Spawn a local IRC server, with respect to given configuration"""
+def spawn_ircserver(config, **kwargs):
+    """Spawn a local IRC server, with respect to given configuration
+
+    Keyword arguments are given to IRCServer, to emulate the behaviour of
+    real servers.
+    """
     server = config.get('irc', 'server')
     port = config.getint('irc', 'port')
     name = '%s.%d.localdomain' % (server, port)
     # TODO: SSL support
-    thread = IRCServerThread((server, port), name)
+    thread = IRCServerThread((server, port), name, **kwargs)
     thread.start()
     return thread
 
@@ -10,12 +10,24 @@ This server specificly does following things:
     * There is no right on channel. Everyone is free to do everything.
     * The server shows some users who don't do anything.
     * Users can't interact with each other, but may interact with server bots.
+
+Like real servers, it may also:
+    * Delay the lines of clients by a network latency, with some jitter.
+    * Apply flood control: each line adds a penalty to the clock of its
+      client, lines are delayed while this clock is too far ahead, and
+      clients are disconnected with "Excess Flood" when too many bytes wait.
+    * Limit the number of channels of a client (CHANLIMIT).
+    * Refuse channels named #invite... (invite only) and #banned... (banned).
 """
 
+import collections
 import logging
 import optparse
+import random
 import re
+import select
 import threading
+import time
 import sys
 
 if sys.version_info < (3,):
@@ -33,6 +45,9 @@ _rfc_1459_command_regexp = re.compile(
 SERVER_VERSION = "test-ircserver-0.0.1alpha"
 SERVER_INFO = "aAbcCdefFghHiIjkKmnoOrRsvwxXy bceiIjklLmMnoOprRstv"
 
+# Maximum number of ISUPPORT tokens in a RPL_ISUPPORT line
+ISUPPORT_TOKENS_PER_LINE = 13
+
 
 class _IRCServerHandler(socketserver.StreamRequestHandler):
     """Manage a request from TCP listener module"""
@@ -91,6 +106,22 @@ class _IRCServerHandler(socketserver.StreamRequestHandler):
             logger.info("%s tried to join unjoinable channel %s" %
                         (self._nick, channel))
             return
+        if channel.startswith('#invite'):
+            # 473 = inviteonlychan
+            self.command(473, "%s %s" % (self._nick, channel),
+                         "Cannot join channel (+i)")
+            return
+        if channel.startswith('#banned'):
+            # 474 = bannedfromchan
+            self.command(474, "%s %s" % (self._nick, channel),
+                         "Cannot join channel (+b)")
+            return
+        if (self.server.chanlimit and channel not in self._chans
+                and len(self._chans) >= self.server.chanlimit):
+            # 405 = toomanychannels
+            self.command(405, "%s %s" % (self._nick, channel),
+                         "You have joined too many channels")
+            return
         if channel not in self._chans:
             logger.info("Create channel %s with user %s" %
                         (channel, self._nick))
@@ -107,6 +138,27 @@ class _IRCServerHandler(socketserver.StreamRequestHandler):
         self.command('JOIN', None, channel, prefix=self._fullname)
         self.do_names(channel)
 
+    def on_part(self, prefix, args):
+        """Process received PART command"""
+        assert len(args) >= 1 and args[0]
+        channel = args[0]
+        if self._chans.pop(channel, None) is None:
+            # 442 = notonchannel
+            self.command(442, "%s %s" % (self._nick, channel),
+                         "You're not on that channel")
+            return
+        logger.info("User %s parts channel %s" % (self._nick, channel))
+        self.command('PART', None, channel, prefix=self._fullname)
+
+    def on_ping(self, prefix, args):
+        """Process received PING command"""
+        assert len(args) >= 1
+        self.command('PONG', self.server.name, args[0])
+
+    def on_pong(self, prefix, args):
+        """Process received PONG command"""
+        pass
+
     def on_privmsg(self, prefix, args):
         """Process received PRIVMSG command"""
         assert len(args) == 2 and args[0]
@@ -164,31 +216,97 @@ class _IRCServerHandler(socketserver.StreamRequestHandler):
         self.command(4, "%s %s %s" % (self._nick, SERVER_VERSION, SERVER_INFO),
                      None)
         # Feature list
-        self.command(5, "%s NETWORK=Testing" % self._nick,
-                     "are available on this server")
+        tokens = self.server.isupport_tokens()
+        for i in range(0, len(tokens), ISUPPORT_TOKENS_PER_LINE):
+            self.command(5, "%s %s" % (
+                self._nick, " ".join(tokens[i:i + ISUPPORT_TOKENS_PER_LINE])),
+                "are available on this server")
         # User mode
         self.command('MODE', self._nick, "+i", prefix=self._nick)
 
     def handle(self):
-        """Handle an IRC session"""
+        """Handle an IRC session
+
+        Lines are read as soon as they come, and processed once the emulated
+        latency and the flood control allow it.
+        """
         # Initialise internal state
         self._nick = None
         self._username = None
         self._fullname = None
         self._chans = dict()
         self._quit = False
+        # Received lines waiting to be processed, with their arrival time
+        self._pending = collections.deque()
+        self._pending_size = 0
+        self._last_arrival = 0
+        # Flood control clock, ahead of the current time when penalized
+        self._penalty = 0
 
         # First message
         self.command('NOTICE', 'AUTH',
                      "*** Please wait while I process your data")
 
-        for line in self.rfile:
+        data = b''
+        eof = False
+        while not self._quit:
+            timeout = self.process_pending()
+            if self._quit or (eof and not self._pending):
+                return
+            if eof:
+                time.sleep(timeout)
+                continue
+            if not select.select([self.request], [], [], timeout)[0]:
+                continue
+            chunk = self.request.recv(4096)
+            if not chunk:
+                eof = True
+                continue
+            lines = (data + chunk).split(b'\n')
+            data = lines.pop()
+            self.receive_lines(lines)
+
+    def receive_lines(self, lines):
+        """Queue received lines until they may be processed"""
+        server = self.server
+        arrival = time.time() + server.latency
+        if server.jitter:
+            arrival += random.uniform(0, server.jitter)
+        # Lines are never reordered
+        self._last_arrival = max(self._last_arrival, arrival)
+        for line in lines:
+            self._pending.append((self._last_arrival, line))
+            self._pending_size += len(line) + 1
+        if server.recvq and self._pending_size > server.recvq:
+            logger.info("%s is flooding, disconnecting" % self._nick)
+            self.command('ERROR', None, "Closing Link: %s (Excess Flood)" %
+                         self.client_address[0])
+            self._quit = True
+
+    def process_pending(self):
+        """Process the lines whose time came
+
+        Return the number of seconds until the next one may be processed, or
+        None if none is waiting.
+        """
+        server = self.server
+        while self._pending and not self._quit:
+            now = time.time()
+            arrival, line = self._pending[0]
+            ready = arrival
+            if server.flood_penalty:
+                ready = max(ready, self._penalty - server.flood_burst)
+            if ready > now:
+                return ready - now
+            self._pending.popleft()
+            self._pending_size -= len(line) + 1
+            if server.flood_penalty:
+                self._penalty = max(self._penalty, now) + server.flood_penalty
             line = line.strip().decode('utf-8')
             if line:
                 logger.debug("Received line \"%s\"" % line)
                 self.dispatch_command(line)
-            if self._quit:
-                return
+        return None
 
 
 class IRCServer(socketserver.ThreadingTCPServer):
@@ -197,14 +315,49 @@ class IRCServer(socketserver.ThreadingTCPServer):
     # Allow reuse of an address, as dirong testing the server is fast restarted
     allow_reuse_address = True
 
-    def __init__(self, address, name):
-        """Start an IRC server on give address with the specified name"""
+    def __init__(self, address, name, latency=0, jitter=0, flood_penalty=0,
+                 flood_burst=10, recvq=0, chanlimit=0, isupport=()):
+        """Start an IRC server on give address with the specified name
+
+        latency       - seconds before a line of a client is processed
+        jitter        - maximum random seconds added to the latency
+        flood_penalty - seconds added to the clock of a client for each line,
+                        0 disables flood control
+        flood_burst   - seconds the clock of a client may be ahead before its
+                        lines are delayed
+        recvq         - bytes waiting to be processed which disconnect a
+                        client, 0 means unlimited
+        chanlimit     - number of channels of a client, 0 means unlimited
+        isupport      - additional RPL_ISUPPORT tokens, like LINELEN=1024
+        """
         self.name = name
         self.display_queue = queue.Queue()
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_penalty = flood_penalty
+        self.flood_burst = flood_burst
+        self.recvq = recvq
+        self.chanlimit = chanlimit
+        self.isupport = list(isupport)
         logger.info("Starting server %s on %s:%d" %
                     (name, address[0], address[1]))
         socketserver.TCPServer.__init__(self, address, _IRCServerHandler)
 
+    def isupport_tokens(self):
+        """Get the RPL_ISUPPORT tokens of the server"""
+        tokens = collections.OrderedDict([
+            ('NETWORK', 'Testing'),
+            ('CASEMAPPING', 'rfc1459'),
+            ('CHANTYPES', '#'),
+        ])
+        if self.chanlimit:
+            tokens['CHANLIMIT'] = '#:%d' % self.chanlimit
+        for token in self.isupport:
+            name, _, value = token.partition('=')
+            tokens[name] = value
+        return [name + ('=' + value if value else '')
+                for (name, value) in tokens.items()]
+
 
 class IRCServerThread(threading.Thread):
     """Thread where an IRCServer runs"""
@@ -256,9 +409,39 @@ def main(argv):
         '-N', '--name', action='store', dest='name', default="irc.localdomain",
         help="Server name", metavar="SERVER_NAME")
 
+    parser.add_option(
+        '--latency', action='store', dest='latency', type='float', default=0,
+        help="seconds before lines are processed", metavar="SECONDS")
+    parser.add_option(
+        '--jitter', action='store', dest='jitter', type='float', default=0,
+        help="maximum random seconds added to the latency",
+        metavar="SECONDS")
+    parser.add_option(
+        '--flood-penalty', action='store', dest='flood_penalty',
+        type='float', default=0, metavar="SECONDS",
+        help="flood control penalty of each line, 0 disables it")
+    parser.add_option(
+        '--flood-burst', action='store', dest='flood_burst', type='float',
+        default=10, metavar="SECONDS",
+        help="penalty allowed before lines are delayed [%default]")
+    parser.add_option(
+        '--recvq', action='store', dest='recvq', type='int', default=0,
+        help="waiting bytes which disconnect a client for excess flood",
+        metavar="BYTES")
+    parser.add_option(
+        '--chanlimit', action='store', dest='chanlimit', type='int',
+        default=0, help="maximum number of channels of a client",
+        metavar="COUNT")
+    parser.add_option(
+        '--isupport', action='append', dest='isupport', default=[],
+        help="additional ISUPPORT token, may be repeated", metavar="TOKEN")
+
     opts, argv = parser.parse_args(argv)
     address = (opts.host, int(opts.port))
-    srv = IRCServer(address, opts.name)
+    srv = IRCServer(address, opts.name, latency=opts.latency,
+                    jitter=opts.jitter, flood_penalty=opts.flood_penalty,
+                    flood_burst=opts.flood_burst, recvq=opts.recvq,
+                    chanlimit=opts.chanlimit, isupport=opts.isupport)
     try:
         srv.serve_forever()
     except KeyboardInterrupt:
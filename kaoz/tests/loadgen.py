@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+"""Load generator which soak-tests a listener, used for testing purpose only
+
+Many clients connect at once to a running Kaoz listener, each one repeatedly
+playing a scenario picked from a weighted mix:
+    * oneshot: send a line and disconnect, like netcat
+    * stream: stay connected and send lines at a steady rate
+    * burst: send many lines at once and disconnect
+    * badpass: send a line with an invalid password
+    * command: run the channels command and read its reply
+
+With --spawn, the test IRC server and Kaoz are started on this machine, and
+the IRC server counts the lines it receives.
+
+Usage: python -m kaoz.tests.loadgen [options]
+"""
+
+import bisect
+import optparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import kaoz
+import kaoz.stats
+
+from .common import get_local_conf
+from .ircserver import IRCServerThread, logger as ircserver_logger
+
+if sys.version_info < (3,):
+    import Queue as queue
+else:
+    import queue
+
+try:
+    import ssl
+    has_ssl = True
+except ImportError:
+    has_ssl = False
+
+
+# Scenarios, named after the LoadGenerator methods which play them
+SCENARIOS = ('oneshot', 'stream', 'burst', 'badpass', 'command')
+
+# Default weights of the scenarios
+DEFAULT_MIX = 'oneshot=40,stream=10,burst=20,badpass=10,command=20'
+
+
+def parse_mix(value):
+    """Parse a "scenario=weight,..." traffic mix into (scenarios, cumulated
+    weights) lists
+    """
+    scenarios = []
+    weights = []
+    total = 0
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in SCENARIOS or not weight.isdigit():
+            raise ValueError("invalid mix item %s" % item)
+        if int(weight):
+            total += int(weight)
+            scenarios.append(name)
+            weights.append(total)
+    if not scenarios:
+        raise ValueError("empty mix")
+    return scenarios, weights
+
+
+def get_rss(pid):
+    """Get the resident memory of a process in kB, or None"""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class LoadGenerator(object):
+    """Clients of a listener, with their statistics"""
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.scenarios, self.weights = parse_mix(opts.mix)
+        self.stats = kaoz.stats.Stats()
+        self.connect_times = kaoz.stats.Histogram()
+        self._lock = threading.Lock()
+        self._counter = 0
+        self.stopping = threading.Event()
+        self._ssl_context = None
+        if opts.ssl:
+            assert has_ssl, "SSL support requested but not available"
+            # The listener is tested, not its certificate
+            self._ssl_context = ssl.SSLContext(getattr(
+                ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+            self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE
+
+    def connect(self):
+        """Open a connection, counting its setup time"""
+        start = time.time()
+        sock = self.open_socket()
+        elapsed = time.time() - start
+        with self._lock:
+            self.connect_times.add(elapsed)
+        self.stats.incr('connections')
+        return sock
+
+    def open_socket(self):
+        """Open a connection to the listener"""
+        sock = socket.create_connection((self.opts.host, self.opts.port),
+                                        self.opts.timeout)
+        if self._ssl_context is not None:
+            sock = self._ssl_context.wrap_socket(sock)
+        return sock
+
+    def lines(self, count, password=None):
+        """Build count lines to send, as bytes"""
+        with self._lock:
+            first = self._counter
+            self._counter += count
+        password = self.opts.password if password is None else password
+        return ''.join(
+            '%s:#loadgen%d:Load test message %d\n' % (
+                password, i % self.opts.channels, i)
+            for i in range(first, first + count)).encode('utf-8')
+
+    def send(self, sock, data, count):
+        """Send count lines"""
+        sock.sendall(data)
+        self.stats.incr('lines_sent', count)
+
+    def oneshot(self):
+        sock = self.connect()
+        try:
+            self.send(sock, self.lines(1), 1)
+        finally:
+            sock.close()
+
+    def stream(self):
+        sock = self.connect()
+        try:
+            for i in range(self.opts.stream_lines):
+                if self.stopping.is_set():
+                    break
+                self.send(sock, self.lines(1), 1)
+                self.stopping.wait(1.0 / self.opts.stream_rate)
+        finally:
+            sock.close()
+
+    def burst(self):
+        sock = self.connect()
+        try:
+            self.send(sock, self.lines(self.opts.burst), self.opts.burst)
+        finally:
+            sock.close()
+
+    def badpass(self):
+        sock = self.connect()
+        try:
+            sock.sendall(self.lines(1, 'invalid-' + self.opts.password))
+            self.stats.incr('bad_passwords')
+        finally:
+            sock.close()
+
+    def command(self):
+        self.run_command('channels')
+        self.stats.incr('commands')
+
+    def run_command(self, command, count=True):
+        """Run a listener command and get its reply
+
+        The connection is not counted unless count is True.
+        """
+        sock = self.connect() if count else self.open_socket()
+        try:
+            sock.sendall(('%s::%s\n' % (self.opts.password, command))
+                         .encode('utf-8'))
+            if not self.opts.ssl:
+                sock.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                if self.opts.ssl and chunk.endswith(b'\n'):
+                    # SSL sockets can't be half-closed, stop at the first
+                    # complete reply
+                    break
+            return b''.join(chunks).decode('utf-8')
+        finally:
+            sock.close()
+
+    def run_client(self):
+        """Play scenarios until the end of the test"""
+        while not self.stopping.is_set():
+            i = bisect.bisect_right(self.weights,
+                                    random.randrange(self.weights[-1]))
+            scenario = self.scenarios[i]
+            try:
+                getattr(self, scenario)()
+            except (socket.error, IOError) as e:
+                # socket.timeout and ssl.SSLError are socket errors too
+                self.stats.incr('errors')
+                self.stats.incr('errors.%s' % type(e).__name__)
+
+    def server_stats(self):
+        """Get the statistics of the listener, as a dictionary"""
+        try:
+            reply = self.run_command('stats', count=False)
+        except (socket.error, IOError):
+            return dict()
+        stats = dict()
+        for line in reply.splitlines():
+            name, _, value = line.partition(' ')
+            stats[name] = value
+        return stats
+
+
+def drain_sink(sink, stats, stopping):
+    """Count the lines the test IRC server received"""
+    while not stopping.is_set():
+        try:
+            sink.srv.display_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        stats.incr('lines_delivered')
+
+
+def spawn(opts, config):
+    """Start the test IRC server and Kaoz, return them once listening"""
+    ircserver_logger.setLevel('ERROR')
+    sink = IRCServerThread(
+        (config.get('irc', 'server'), config.getint('irc', 'port')),
+        'loadgen.localdomain')
+    sink.daemon = True
+    sink.start()
+    # Relative paths of the configuration are relative to its directory
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(kaoz.__file__)))] +
+        env.get('PYTHONPATH', '').split(os.pathsep))
+    process = subprocess.Popen(
+        [sys.executable, '-c',
+         'import sys; from kaoz import bot; bot.main(["kaoz"] + sys.argv[1:])',
+         '--config', os.path.abspath(opts.config), '--logstd'],
+        cwd=os.path.dirname(os.path.abspath(opts.config)), env=env,
+        stderr=open(os.devnull, 'w'))
+    for i in range(100):
+        try:
+            socket.create_connection((opts.host, opts.port), 1).close()
+            break
+        except socket.error:
+            time.sleep(0.1)
+    return sink, process
+
+
+def main(argv):
+    """Run a load test"""
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option(
+        '-C', '--config', action='store', dest='config', metavar="CONFIG",
+        default=os.path.join(os.path.dirname(__file__), 'kaoz.local.conf'),
+        help="read the listener address from CONFIG")
+    parser.add_option(
+        '-H', '--host', action='store', dest='host', metavar="HOST",
+        help="listener host, instead of the configured one")
+    parser.add_option(
+        '-p', '--port', action='store', dest='port', type='int',
+        metavar="PORT", help="listener port, instead of the configured one")
+    parser.add_option(
+        '--ssl', action='store_true', dest='ssl', default=None,
+        help="connect with SSL, instead of following the configuration")
+    parser.add_option(
+        '-c', '--clients', action='store', dest='clients', type='int',
+        default=100, help="number of concurrent clients", metavar="COUNT")
+    parser.add_option(
+        '-d', '--duration', action='store', dest='duration', type='float',
+        default=60, help="duration of the test in seconds", metavar="SECONDS")
+    parser.add_option(
+        '-i', '--interval', action='store', dest='interval', type='float',
+        default=5, help="seconds between reports", metavar="SECONDS")
+    parser.add_option(
+        '-m', '--mix', action='store', dest='mix', default=DEFAULT_MIX,
+        help="weights of scenarios [%default]", metavar="MIX")
+    parser.add_option(
+        '--channels', action='store', dest='channels', type='int',
+        default=10, help="number of channels to send to", metavar="COUNT")
+    parser.add_option(
+        '--burst', action='store', dest='burst', type='int', default=100,
+        help="number of lines of a burst", metavar="COUNT")
+    parser.add_option(
+        '--stream-rate', action='store', dest='stream_rate', type='float',
+        default=10, help="lines per second of a stream", metavar="RATE")
+    parser.add_option(
+        '--stream-lines', action='store', dest='stream_lines', type='int',
+        default=100, help="number of lines of a stream", metavar="COUNT")
+    parser.add_option(
+        '--timeout', action='store', dest='timeout', type='float',
+        default=10, help="socket timeout in seconds", metavar="SECONDS")
+    parser.add_option(
+        '--pid', action='store', dest='pid', type='int',
+        help="process of the server, whose memory is reported",
+        metavar="PID")
+    parser.add_option(
+        '--spawn', action='store_true', dest='spawn', default=False,
+        help="start the test IRC server and Kaoz with CONFIG")
+
+    opts, args = parser.parse_args(argv[1:])
+    config = get_local_conf(os.path.abspath(opts.config))
+    if opts.host is None:
+        opts.host = config.get('listener', 'host') or 'localhost'
+    if opts.port is None:
+        opts.port = config.getint('listener', 'port')
+    if opts.ssl is None:
+        opts.ssl = config.getboolean('listener', 'ssl')
+    opts.password = config.get('listener', 'password')
+    try:
+        generator = LoadGenerator(opts)
+    except ValueError as e:
+        parser.error(str(e))
+
+    sink = process = None
+    if opts.spawn:
+        sink, process = spawn(opts, config)
+        opts.pid = process.pid
+        threading.Thread(target=drain_sink, args=(
+            sink, generator.stats, generator.stopping)).start()
+
+    # Keep the memory of thousands of threads low
+    threading.stack_size(256 * 1024)
+    clients = []
+    for i in range(opts.clients):
+        client = threading.Thread(target=generator.run_client)
+        client.daemon = True
+        client.start()
+        clients.append(client)
+
+    print("%8s %10s %10s %10s %10s %8s %8s %8s %9s" % (
+        "time", "conn/s", "sent/s", "accept/s", "irc/s", "errors",
+        "conn_p50", "conn_p99", "rss_kB"))
+    start = previous_time = time.time()
+    previous = generator.stats.snapshot()
+    previous_received = int(generator.server_stats().get(
+        'messages_received', 0))
+    try:
+        while time.time() - start < opts.duration:
+            time.sleep(opts.interval)
+            now = time.time()
+            current = generator.stats.snapshot()
+            received = int(generator.server_stats().get(
+                'messages_received', previous_received))
+            elapsed = now - previous_time
+            rates = dict(
+                (name, (current.get(name, 0) - previous.get(name, 0)) / elapsed)
+                for name in ('connections', 'lines_sent', 'lines_delivered'))
+            with generator._lock:
+                p50 = generator.connect_times.percentile(50) or 0
+                p99 = generator.connect_times.percentile(99) or 0
+            rss = get_rss(opts.pid) if opts.pid else None
+            print("%8.1f %10.1f %10.1f %10.1f %10.1f %8d %8.3f %8.3f %9s" % (
+                now - start, rates['connections'], rates['lines_sent'],
+                (received - previous_received) / elapsed,
+                rates['lines_delivered'], current.get('errors', 0), p50, p99,
+                '-' if rss is None else rss))
+            sys.stdout.flush()
+            previous, previous_time = current, now
+            previous_received = received
+    except KeyboardInterrupt:
+        pass
+    finally:
+        generator.stopping.set()
+        for client in clients:
+            client.join(opts.timeout)
+        if process is not None:
+            process.kill()
+            process.wait()
+        if sink is not None:
+            sink.stop()
+
+    # Summary
+    stats = generator.stats.snapshot()
+    elapsed = time.time() - start
+    connections = stats.get('connections', 0)
+    print("")
+    for name in sorted(stats):
+        print("%-30s %d" % (name, stats[name]))
+    print("%-30s %.1f" % ("lines_sent/s",
+                          stats.get('lines_sent', 0) / elapsed))
+    print("%-30s %.4f" % ("error_rate",
+                          float(stats.get('errors', 0)) / max(1, connections)))
+    for p in (50, 90, 99):
+        print("%-30s %.3f" % ("connect_p%d" % p,
+                              generator.connect_times.percentile(p) or 0))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+import logging
+import sys
+import threading
+
+import kaoz.asynclog
+
+from .common import unittest
+
+
+class ListHandler(logging.Handler):
+    """Handler which stores formatted messages"""
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.messages = []
+        self.event = threading.Event()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+        self.event.set()
+
+
+class AsyncLogTestCase(unittest.TestCase):
+
+    def make_record(self, msg, *args):
+        return logging.LogRecord('kaoz.test', logging.INFO, __file__, 0,
+                                 msg, args, None)
+
+    def test_threaded_handler(self):
+        target = ListHandler()
+        handler = kaoz.asynclog.ThreadedHandler([target])
+        handler.handle(self.make_record("Hello %s", "world"))
+        self.assertTrue(target.event.wait(2), "record was not delivered")
+        handler.close()
+        self.assertEqual(target.messages, ["Hello world"])
+
+    def test_prepared_records(self):
+        target = ListHandler()
+        handler = kaoz.asynclog.ThreadedHandler([target])
+        channels = ['#chan']
+        try:
+            raise ValueError("Oops")
+        except ValueError:
+            record = logging.LogRecord('kaoz.test', logging.ERROR, __file__,
+                                       0, "Channels %s", (channels,),
+                                       sys.exc_info())
+        handler.handle(record)
+        # Arguments are formatted when the record is logged
+        channels.append('#other')
+        handler.close()
+        self.assertEqual(target.messages, ["Channels ['#chan']"])
+        self.assertTrue(record.exc_info is None, "traceback was kept")
+        self.assertTrue(record.exc_text.endswith("ValueError: Oops"))
+
+    def test_dropped_records(self):
+        target = ListHandler()
+        # Keep the handler thread busy with the first record
+        target.acquire()
+        handler = kaoz.asynclog.ThreadedHandler([target], queue_size=1)
+        for i in range(5):
+            handler.handle(self.make_record("Record %d", i))
+        target.release()
+        handler.close()
+        self.assertTrue(handler.dropped >= 3)
+        # Every dropped record is reported
+        reports = [int(message.split()[0]) for message in target.messages
+                   if message.endswith("the logging queue was full")]
+        self.assertEqual(sum(reports), handler.dropped)
+
+    def test_rate_limit(self):
+        log_filter = kaoz.asynclog.RateLimitFilter(2, period=60)
+        records = [self.make_record("[%s] say %s", '#chan', i)
+                   for i in range(5)]
+        passed = [r for r in records if log_filter.filter(r)]
+        self.assertEqual(len(passed), 2)
+
+        # An other format is not limited
+        other = self.make_record("Joined channel %s", '#chan')
+        self.assertTrue(log_filter.filter(other))
+
+        # Next window tells how many records were suppressed
+        late = self.make_record("[%s] say %s", '#chan', 5)
+        late.created += 60
+        self.assertTrue(log_filter.filter(late))
+        self.assertEqual(late.getMessage(),
+                         "[#chan] say 5 [3 similar messages suppressed]")
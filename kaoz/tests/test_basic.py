@@ -2,11 +2,58 @@
 # Copyright © 2011-2013 Binet Réseau
 # See the LICENCE file for more informations
 
+import kaoz.bot
+import os
+import shutil
+import tempfile
+
 from .common import unittest, get_local_conf
 
 
+class DummyThread(object):
+    """Publisher or listener which records the configurations it gets"""
+
+    def __init__(self):
+        self.configs = []
+
+    def reload(self, config):
+        self.configs.append(config)
+        return []
+
+
 class BasicTestCase(unittest.TestCase):
 
     def test_config(self):
         config = get_local_conf()
         self.assertTrue(config is not None)
+        kaoz.bot.check_config(config)
+
+    def test_check_config(self):
+        for (section, name, value) in (('irc', 'max_queued_bytes', 'x'),
+                                       ('irc', 'line_sleep', 'fast'),
+                                       ('irc', 'ssl', 'maybe'),
+                                       ('message_ttl', 'chan', '1m'),
+                                       ('irc', 'realname', '%(none)s')):
+            config = get_local_conf()
+            config.set(section, name, value)
+            self.assertRaises((ValueError, kaoz.bot.ConfigError),
+                              kaoz.bot.check_config, config)
+
+    def test_reload_config(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'kaoz.conf')
+            config = get_local_conf()
+            publisher = DummyThread()
+            with open(filename, 'w') as f:
+                f.write("[irc]\nline_sleep = 3\nmax_queued_bytes = x\n")
+            self.assertRaises(ValueError, kaoz.bot.reload_config,
+                              filename, config, publisher, [])
+            self.assertEqual(publisher.configs, [])
+            with open(filename, 'w') as f:
+                f.write("[irc]\ndrain_timeout = 3\n")
+            kaoz.bot.reload_config(filename, config, publisher, [])
+            self.assertEqual(len(publisher.configs), 1)
+            self.assertEqual(config.getint('irc', 'drain_timeout'), 3)
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+import kaoz.channel
+
+from .common import unittest
+
+
+class BacklogTestCase(unittest.TestCase):
+
+    def test_global_watermarks(self):
+        backlog = kaoz.channel.Backlog(high=4, low=2)
+        backlog.add('#chan1', 3)
+        self.assertFalse(backlog.is_busy('#chan1'))
+        backlog.add('#chan2')
+        self.assertTrue(backlog.is_busy('#chan1'))
+        self.assertTrue(backlog.is_busy('#chan3'))
+        self.assertEqual(backlog.excess('#chan3'), 2)
+        backlog.remove('#chan1')
+        self.assertTrue(backlog.is_busy(), "busy state left too early")
+        backlog.remove('#chan1')
+        self.assertFalse(backlog.is_busy())
+        self.assertTrue(backlog.wait('#chan1', 0))
+
+    def test_channel_watermarks(self):
+        backlog = kaoz.channel.Backlog(chan_high=2)
+        backlog.add('#chan1', 2)
+        self.assertTrue(backlog.is_busy('#chan1'))
+        self.assertFalse(backlog.is_busy('#chan2'))
+        self.assertFalse(backlog.wait('#chan1', 0))
+        backlog.remove('#chan1')
+        self.assertFalse(backlog.is_busy('#chan1'))
+        self.assertEqual(backlog.total, 1)
+
+
+class DigestTestCase(unittest.TestCase):
+
+    def test_summary(self):
+        digest = kaoz.channel.Digest(template_len=20)
+        for i in range(5):
+            digest.add("Disk %d is full" % i)
+        digest.add("Disk 1 is full, and it is a very long message")
+        digest.add("Server rebooted")
+        digest.add("Load is 42")
+        self.assertEqual(digest.summary(2), [
+            "[digest] 5 x Disk N is full",
+            "[digest] 1 x Disk N is full, and ",
+            "[digest] 2 other messages",
+        ])
+
+
+class IndexedChanDictTestCase(unittest.TestCase):
+
+    def test_casemapping(self):
+        chans = kaoz.channel.IndexedChanDict()
+        chans['#Ops[1]'].messages.append(b"Hello")
+        self.assertTrue(chans['#OPS{1}'] is chans['#ops[1]'])
+        self.assertEqual(chans['#ops{1}'].name, '#Ops[1]')
+        self.assertEqual(list(chans), ['#ops{1}'])
+
+        # With ascii casemapping, brackets are different characters
+        chans.set_casemapping('ascii')
+        chans['#Ops{1}'].messages.append(b"World")
+        self.assertEqual(sorted(chans), ['#ops[1]', '#ops{1}'])
+
+        # Back to rfc1459, channels are merged
+        chans.set_casemapping('rfc1459')
+        self.assertEqual(list(chans), ['#ops{1}'])
+        self.assertEqual([line.text for line in chans['#OPS[1]'].messages],
+                         ["Hello", "World"])
+
+    def test_leave(self):
+        chans = kaoz.channel.IndexedChanDict()
+        chans.mark_joined('#Chan')
+        chans.mark_joined('&local')
+        chans.mark_joined('&local')
+        self.assertEqual(chans.count_joined('#&'), 2)
+        self.assertEqual(chans.count_joined('#'), 1)
+        chans['#Chan'].messages.append(b"Waiting")
+        chans.leave('#CHAN')
+        self.assertTrue(chans['#chan'].need_join(), "channel is still joined")
+        del chans['&LOCAL']
+        self.assertEqual(chans.count_joined('#&'), 0)
+
+    def test_idle(self):
+        chans = kaoz.channel.IndexedChanDict()
+        for channel in ('#a', '#b', '#c'):
+            chans[channel].mark_left()
+        chans.mark_busy('#A')
+        chans.mark_busy('#b')
+        self.assertEqual(chans.least_recent_idle().name, '#c')
+        chans.mark_idle('#a')
+        chans.mark_idle('#c')
+        del chans['#c']
+        self.assertEqual(chans.least_recent_idle().name, '#a')
+        chans.mark_busy('#a')
+        self.assertTrue(chans.least_recent_idle() is None)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+import json
+import sys
+
+import kaoz.httplistener
+
+from .common import unittest, get_local_conf, configure_logger
+from .test_listener import DummyPublisher
+
+if sys.version_info < (3,):
+    import httplib as httpclient
+else:
+    import http.client as httpclient
+
+configure_logger(kaoz.httplistener.logger, 'WARNING')
+
+
+class HTTPListenerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = get_local_conf()
+        self.config.set('http', 'host', 'localhost')
+        self.config.set('http', 'port', '9011')
+        self.config.set('http', 'token', 'secret')
+        self.pub = DummyPublisher()
+
+    def post(self, conn, messages, token='secret'):
+        """Post messages and get the status and content of the reply"""
+        conn.request('POST', '/messages', json.dumps(messages), {
+            'Authorization': 'Bearer ' + token,
+            'Content-Type': 'application/json',
+        })
+        response = conn.getresponse()
+        return (response.status, json.loads(response.read().decode('utf-8')))
+
+    def test_messages(self):
+        with kaoz.httplistener.HTTPListener(self.pub, self.config):
+            conn = httpclient.HTTPConnection('localhost', 9011, timeout=2)
+            status, content = self.post(conn, [
+                {'channel': '#chan1', 'message': "Hello"},
+                {'channel': '#chan2', 'message': "World", 'priority': 'low'},
+            ])
+            self.assertEqual((status, content), (200, {'ids': ['1', '2']}))
+
+            # The connection is kept alive
+            status, content = self.post(conn, [
+                {'channel': '#chan1', 'message': "Again"}])
+            self.assertEqual((status, content), (200, {'ids': ['3']}))
+
+            status, content = self.post(conn, [{'channel': '#chan1'}])
+            self.assertEqual((status, content),
+                             (400, {'error': "Invalid message"}))
+            status, content = self.post(conn, [
+                {'channel': '#chan1',
+                 'message': b'\\ud800'.decode('unicode_escape')}])
+            self.assertEqual((status, content),
+                             (400, {'error': "Invalid characters"}))
+            status, content = self.post(conn, [], token='wrong')
+            self.assertEqual(status, 401)
+            conn.close()
+
+            # The body of a rejected request doesn't break the next one
+            conn = httpclient.HTTPConnection('localhost', 9011, timeout=2)
+            status, content = self.post(conn, [], token='wrong')
+            self.assertEqual(status, 401)
+            status, content = self.post(conn, [
+                {'channel': '#chan1', 'message': "Again"}])
+            self.assertEqual(status, 200)
+            conn.close()
+        self.assertEqual([self.pub.lines.get() for i in range(4)],
+                         ["#chan1:Hello", "#chan2:World", "#chan1:Again",
+                          "#chan1:Again"])
+
+    def test_busy(self):
+        self.pub.busy = True
+        with kaoz.httplistener.HTTPListener(self.pub, self.config):
+            conn = httpclient.HTTPConnection('localhost', 9011, timeout=2)
+            status, content = self.post(conn, [
+                {'channel': '#chan1', 'message': "Urgent", 'priority': 'high'},
+                {'channel': '#chan1', 'message': "Hello"},
+            ])
+            self.assertEqual((status, content),
+                             (503, {'error': "Busy", 'retry_after': 42}))
+            status, content = self.post(conn, [
+                {'channel': '#chan1', 'message': "Urgent", 'priority': 'high'},
+            ])
+            self.assertEqual(status, 200)
+            conn.close()
+        self.assertEqual(self.pub.lines.get(), "#chan1:Urgent")
+        self.assertTrue(self.pub.lines.empty(), "Busy line got published")
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+import socket
+import time
+
+from .common import unittest, get_local_conf, spawn_ircserver
+
+
+class IRCClient(object):
+    """Raw IRC client, to check the behaviour of the test server"""
+
+    def __init__(self, config):
+        self.sock = socket.create_connection(
+            (config.get('irc', 'server'), config.getint('irc', 'port')), 5)
+        self.lines = self.sock.makefile('rb')
+
+    def send(self, *lines):
+        self.sock.sendall(''.join(line + '\r\n' for line in lines)
+                          .encode('utf-8'))
+
+    def expect(self, command):
+        """Read lines until one has command, and return it"""
+        for line in self.lines:
+            line = line.decode('utf-8').rstrip('\r\n')
+            if line.split(' ')[1] == command:
+                return line
+        return None
+
+    def close(self):
+        self.lines.close()
+        self.sock.close()
+
+
+class IRCServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = get_local_conf()
+        self.ircsrv = None
+        self.client = None
+
+    def tearDown(self):
+        if self.client is not None:
+            self.client.close()
+        if self.ircsrv is not None:
+            self.ircsrv.stop()
+
+    def connect(self, **kwargs):
+        """Start the server and register a client"""
+        self.ircsrv = spawn_ircserver(self.config, **kwargs)
+        self.client = IRCClient(self.config)
+        self.client.send("NICK tester", "USER tester 0 * :Tester")
+        return self.client
+
+    def test_join_errors(self):
+        client = self.connect(chanlimit=1, isupport=['LINELEN=1024'])
+        isupport = client.expect('005')
+        self.assertTrue(' CHANLIMIT=#:1 ' in isupport)
+        self.assertTrue(' LINELEN=1024 ' in isupport)
+        client.send("JOIN #invite-only")
+        self.assertTrue(client.expect('473') is not None)
+        client.send("JOIN #banned-chan")
+        self.assertTrue(client.expect('474') is not None)
+        client.send("JOIN #chan1", "JOIN #chan2")
+        self.assertTrue(client.expect('JOIN').endswith('#chan1'))
+        self.assertTrue(client.expect('405').endswith(
+            ":You have joined too many channels"))
+        client.send("PART #chan1", "JOIN #chan2")
+        self.assertTrue(client.expect('JOIN').endswith('#chan2'))
+
+    def test_latency(self):
+        client = self.connect(latency=0.3, jitter=0.1)
+        client.expect('001')
+        start = time.time()
+        client.send("PING :token")
+        self.assertTrue(client.expect('PONG').endswith(' :token'))
+        self.assertTrue(0.3 <= time.time() - start < 1)
+
+    def test_flood(self):
+        client = self.connect(flood_penalty=0.5, flood_burst=2, recvq=200)
+        client.expect('001')
+        time.sleep(1)
+        # A burst of 2 seconds of penalty is processed at once, then lines
+        # are delayed
+        start = time.time()
+        client.send(*["PING :%d" % i for i in range(7)])
+        for i in range(5):
+            client.expect('PONG')
+        self.assertTrue(time.time() - start < 0.4)
+        for i in range(2):
+            client.expect('PONG')
+        self.assertTrue(time.time() - start >= 0.9)
+
+        # Too many waiting bytes disconnect the client
+        client.send(*["PRIVMSG #chan1 :%s" % ('x' * 50) for i in range(5)])
+        self.assertTrue(client.expect('ERROR').endswith("(Excess Flood)"))
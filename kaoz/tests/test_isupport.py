@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+import kaoz.isupport
+
+from .common import unittest
+
+
+class ServerLimitsTestCase(unittest.TestCase):
+
+    def test_isupport(self):
+        limits = kaoz.isupport.ServerLimits()
+        limits.update(['CHANLIMIT=#&:20,+:', 'CHANNELLEN=64', 'LINELEN=1024',
+                       'TARGMAX=PRIVMSG:4,JOIN:', 'CASEMAPPING=ascii',
+                       'are supported by this server'])
+        self.assertEqual(limits.chanlimit_for('#chan'), ('#&', 20))
+        self.assertEqual(limits.chanlimit_for('+chan'), ('+', None))
+        self.assertEqual(limits.chanlimit_for('!chan'), (None, None))
+        self.assertEqual(limits.channellen, 64)
+        self.assertEqual(limits.casemapping, 'ascii')
+        self.assertEqual(limits.targmax, {'PRIVMSG': 4, 'JOIN': None})
+        # ':nick!user@host PRIVMSG #chan :text\r\n'
+        self.assertEqual(limits.payload_len(5, 17), 1024 - 17 - 12 - 5)
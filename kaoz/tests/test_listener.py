@@ -6,6 +6,7 @@ import kaoz.listener
 import os
 import socket
 import sys
+import time
 
 from .common import unittest, get_local_conf, configure_logger
 
@@ -29,16 +30,48 @@ class DummyPublisher(object):
     def __init__(self):
         self.lines = queue.Queue()
         self._channels = None
+        self.busy = False
+        # Arrival time given with the last messages
+        self.created = None
 
     def send_line(self, line):
         """Listener sends a line to the publisher"""
         self.lines.put(line)
+        return '%x' % self.lines.qsize()
+
+    def send_lines(self, lines, source=None):
+        return [self.send_line(line) for line in lines]
+
+    def send_many(self, messages, source=None, created=None):
+        self.created = created
+        return [self.send_line("%s:%s" % message) for message in messages]
+
+    def status(self, msgid):
+        if msgid == '1':
+            return "1 sent 1.000 2.000"
 
     def channels(self, new_channel=None):
         if new_channel is not None:
             self._channels = new_channel
         return self._channels
 
+    def is_stopped(self):
+        return False
+
+    def is_busy(self, channel=None):
+        return self.busy
+
+    def wait_ready(self, channel=None, timeout=None):
+        if self.busy and timeout:
+            time.sleep(min(timeout, 0.1))
+        return not self.busy
+
+    def retry_after(self, channel=None):
+        return 42
+
+    def stats(self):
+        return {'lines_sent': 0}
+
 
 def sslize_config(config):
     """Give a new configuration with SSL enabled for the listener"""
@@ -56,6 +89,16 @@ def sslize_config(config):
     return config
 
 
+def ssl_client_socket():
+    """Get an SSL client socket, which doesn't check the test certificate"""
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT',
+                                     ssl.PROTOCOL_SSLv23))
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context.wrap_socket(
+        socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+
+
 class ListenerTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -110,8 +153,7 @@ class ListenerTestCase(unittest.TestCase):
         # Start listener
         with kaoz.listener.TCPListener(self.pub, self.ssl_config):
             # Send one line
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock = ssl.wrap_socket(sock)
+            sock = ssl_client_socket()
             sock.connect((self.host, self.port))
             packet = "%s:%s" % (self.password, sent_line)
             sock.sendall(packet.encode('UTF-8'))
@@ -125,6 +167,51 @@ class ListenerTestCase(unittest.TestCase):
         self.assertEqual(received_line, sent_line)
         self.assertTrue(self.pub.lines.empty(), "Too many published lines")
 
+    @unittest.skipUnless(has_ssl, "requires ssl library")
+    def test_ssl_handshake(self):
+        self.ssl_config.set('listener', 'handshake_timeout', '1')
+        listener = kaoz.listener.TCPListener(self.pub, self.ssl_config)
+        with listener:
+            # A client which does not start the handshake is disconnected
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host, self.port))
+            sock.settimeout(5)
+            self.assertEqual(sock.recv(1), b'')
+            sock.close()
+
+            # A client which waits after the handshake is not
+            sock = ssl_client_socket()
+            sock.connect((self.host, self.port))
+            time.sleep(1.5)
+            sock.sendall(("%s:#chan1:Hello" % self.password).encode('UTF-8'))
+            sock.close()
+            try:
+                received_line = self.pub.lines.get(timeout=2)
+            except queue.Empty:
+                self.fail("Publisher didn't receive anything")
+            stats = listener._server.get_stats()
+        self.assertEqual(received_line, "#chan1:Hello")
+        self.assertEqual(stats['ssl_handshake_timeouts'], 1)
+        self.assertEqual(stats['ssl_handshakes'], 1)
+
+    @unittest.skipUnless(has_ssl, "requires ssl library")
+    def test_ssl_reload(self):
+        listener = kaoz.listener.TCPListener(self.pub, self.ssl_config)
+        context = listener._server.ssl_context
+        ssl_cert = self.ssl_config.get('listener', 'ssl_cert')
+        try:
+            # A certificate which can't be loaded leaves the previous one
+            self.ssl_config.set('listener', 'ssl_cert', '/nonexistent.crt')
+            self.assertEqual(listener.reload(self.ssl_config), [])
+            self.assertTrue(listener._server.ssl_context is context)
+
+            # A renewed certificate is loaded without a restart
+            self.ssl_config.set('listener', 'ssl_cert', ssl_cert)
+            self.assertEqual(listener.reload(self.ssl_config), [])
+            self.assertFalse(listener._server.ssl_context is context)
+        finally:
+            listener._server.server_close()
+
     def test_commands(self):
         testing_channel = "#testing-channel"
         self.pub.channels([testing_channel])
@@ -141,3 +228,198 @@ class ListenerTestCase(unittest.TestCase):
             sock.settimeout(None)
             sock.close()
         self.assertEqual(line, testing_channel + "\n")
+
+    def test_profile(self):
+        packet = "\n".join([
+            "%s::profile start" % self.password,
+            "%s::profile stop" % self.password,
+            "%s::profile" % self.password,
+        ])
+        with kaoz.listener.TCPListener(self.pub, self.config):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host, self.port))
+            sock.sendall(packet.encode('UTF-8'))
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(2)
+            lines = sock.makefile().readlines()
+            sock.settimeout(None)
+            sock.close()
+        self.assertEqual(lines[0], "OK, profiling for 300 seconds\n")
+        self.assertTrue(lines[1].endswith(" seconds\n"))
+        self.assertEqual(lines[-1], "Usage: profile start [seconds]|stop\n")
+
+    def test_busy_reply(self):
+        self.config.set('listener', 'backpressure', 'reply')
+        self.pub.busy = True
+        with kaoz.listener.TCPListener(self.pub, self.config):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host, self.port))
+            packet = "%s:#chan1:Hello, world" % (self.password)
+            sock.sendall(packet.encode('UTF-8'))
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(2)
+            line = sock.makefile().readline()
+            sock.settimeout(None)
+            sock.close()
+        self.assertEqual(line, "BUSY 42\n")
+        self.assertTrue(self.pub.lines.empty(), "Busy line got published")
+
+    def test_busy_block(self):
+        self.pub.busy = True
+        with kaoz.listener.TCPListener(self.pub, self.config):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host, self.port))
+            sent = time.time()
+            packet = "%s:#chan1:Hello, world" % (self.password)
+            sock.sendall(packet.encode('UTF-8'))
+            sock.close()
+            time.sleep(0.5)
+            self.assertTrue(self.pub.lines.empty(), "Busy line got published")
+            self.pub.busy = False
+            self.assertEqual(self.pub.lines.get(timeout=2),
+                             "#chan1:Hello, world")
+        # The message is dated from its arrival, not from the end of the wait
+        self.assertTrue(sent <= self.pub.created < sent + 0.4)
+
+    def test_ack(self):
+        packet = "\n".join([
+            "%s::ack on" % self.password,
+            "%s:#chan1:Hello, world" % self.password,
+            "%s::status 1" % self.password,
+            "%s::status 2" % self.password,
+        ])
+        with kaoz.listener.TCPListener(self.pub, self.config):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host, self.port))
+            sock.sendall(packet.encode('UTF-8'))
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(2)
+            lines = sock.makefile().readlines()
+            sock.settimeout(None)
+            sock.close()
+        self.assertEqual(lines, ["OK\n", "OK 1\n", "1 sent 1.000 2.000\n",
+                                 "2 unknown\n"])
+
+    def test_invalid_lines(self):
+        packet = b"\n".join([
+            ("%s::ack on" % self.password).encode('UTF-8'),
+            b"invalid-password:#chan1:Hello",
+            ("%s:#chan1:\xe9" % self.password).encode('ISO-8859-1'),
+            ("%s:no channel" % self.password).encode('UTF-8'),
+            ("%s:#chan1:Hello, world" % self.password).encode('UTF-8'),
+        ])
+        with kaoz.listener.TCPListener(self.pub, self.config):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host, self.port))
+            sock.sendall(packet)
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(2)
+            lines = sock.makefile().readlines()
+            sock.settimeout(None)
+            sock.close()
+        self.assertEqual(lines, ["OK\n", "ERROR Invalid message\n",
+                                 "ERROR Invalid message\n", "OK 1\n"])
+        self.assertEqual(self.pub.lines.get(timeout=2), "#chan1:Hello, world")
+
+    def test_reload(self):
+        new_config = get_local_conf()
+        new_config.set('listener', 'password', 'new-password')
+        new_config.set('listener', 'host', '127.0.0.2')
+
+        def reload_config():
+            return listener.reload(new_config)
+
+        listener = kaoz.listener.TCPListener(self.pub, self.config,
+                                             reload_config=reload_config)
+        with listener:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host, self.port))
+            packet = "%s::reload\nnew-password:#chan1:Hello" % self.password
+            sock.sendall(packet.encode('UTF-8'))
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(2)
+            lines = sock.makefile().readlines()
+            sock.settimeout(None)
+            sock.close()
+            try:
+                received_line = self.pub.lines.get(timeout=2)
+            except queue.Empty:
+                self.fail("New password was not applied")
+        self.assertEqual(lines, ["OK\n",
+                                 "Restart needed to apply listener.host\n"])
+        self.assertEqual(received_line, "#chan1:Hello")
+
+    def test_reload_failed(self):
+        def reload_config():
+            raise ValueError("invalid line_sleep")
+
+        listener = kaoz.listener.TCPListener(self.pub, self.config,
+                                             reload_config=reload_config)
+        with listener:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host, self.port))
+            sock.sendall(("%s::reload" % self.password).encode('UTF-8'))
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(2)
+            lines = sock.makefile().readlines()
+            sock.settimeout(None)
+            sock.close()
+        self.assertEqual(lines, ["Reload failed: invalid line_sleep\n"])
+
+    def test_worker_pool(self):
+        self.config.set('listener', 'workers', '2')
+        self.config.set('listener', 'max_connections_per_ip', '1')
+        with kaoz.listener.TCPListener(self.pub, self.config):
+            idle_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            idle_sock.connect((self.host, self.port))
+
+            # A second connection from the same address is closed at once
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host, self.port))
+            sock.settimeout(2)
+            try:
+                self.assertEqual(sock.recv(1), b'')
+            except socket.error:
+                pass
+            sock.close()
+
+            idle_sock.sendall(("%s::stats" % self.password).encode('UTF-8'))
+            idle_sock.shutdown(socket.SHUT_WR)
+            idle_sock.settimeout(2)
+            lines = idle_sock.makefile().readlines()
+            idle_sock.close()
+        self.assertIn("connections_rejected 1\n", lines)
+        self.assertIn("connections 1\n", lines)
+        self.assertIn("lines_sent 0\n", lines)
+
+    def test_idle_timeout(self):
+        self.config.set('listener', 'idle_timeout', '1')
+        with kaoz.listener.TCPListener(self.pub, self.config):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host, self.port))
+            sock.settimeout(5)
+            self.assertEqual(sock.recv(1), b'')
+            sock.close()
+
+    def test_max_line_length(self):
+        self.config.set('listener', 'max_line_length', '100')
+        packet = ("%s:#chan1:Hello\n%s:#chan1:%s" % (
+            self.password, self.password, 'x' * 4096)).encode('UTF-8')
+        with kaoz.listener.TCPListener(self.pub, self.config) as listener:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host, self.port))
+            # Split the long line over several chunks, until the listener
+            # disconnects
+            try:
+                for i in range(0, len(packet), 512):
+                    sock.sendall(packet[i:i + 512])
+                    time.sleep(0.01)
+            except socket.error:
+                pass
+            sock.settimeout(5)
+            self.assertEqual(sock.recv(1), b'')
+            sock.close()
+            self.assertEqual(self.pub.lines.get(timeout=2), "#chan1:Hello")
+            stats = listener._server.get_stats()
+        self.assertEqual(stats['lines_too_long'], 1)
+        self.assertTrue(self.pub.lines.empty(), "Too many published lines")
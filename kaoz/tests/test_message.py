@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+import kaoz.message
+import kaoz.publishbot
+
+from .common import unittest
+
+
+class SmallLineQueue(kaoz.message.LineQueue):
+    compact_threshold = 2
+
+
+class LineQueueTestCase(unittest.TestCase):
+
+    def test_fifo(self):
+        queue = SmallLineQueue()
+        for i in range(5):
+            queue.append(("Line %d" % i).encode('utf-8'), '%x' % (i + 1), i)
+        self.assertEqual(len(queue), 5)
+        for i in range(3):
+            line = queue.popleft()
+            self.assertEqual((line.text, line.msgid, line.created),
+                             ("Line %d" % i, '%x' % (i + 1), i))
+        # The buffer was compacted once most lines were taken out
+        self.assertEqual(bytes(queue._buffer), b"Line 3Line 4")
+        queue.appendleft(b"First")
+        queue.appendleft(b"Summary")
+        self.assertEqual([line.text for line in queue],
+                         ["Summary", "First", "Line 3", "Line 4"])
+        self.assertTrue(queue.popleft().msgid is None)
+        # Room left at the head is reused
+        queue.appendleft(b"Again")
+        self.assertEqual([line.text for line in queue],
+                         ["Again", "First", "Line 3", "Line 4"])
+        self.assertEqual(len(queue._buffer), 24)
+        queue.clear()
+        self.assertFalse(queue)
+        self.assertRaises(IndexError, queue.popleft)
+
+    def test_append_parts(self):
+        queue = kaoz.message.LineQueue()
+        data = b"Caf\xc3\xa9 au lait"
+        lengths = kaoz.publishbot.utf8_split(data, 4)
+        self.assertEqual(lengths, [3, 4, 4, 2])
+        queue.append_parts(data, lengths[:2], '1f', 42)
+        self.assertEqual([(line.data, line.msgid) for line in queue],
+                         [(b"Caf", '1f'), (b"\xc3\xa9 a", '1f')])
+        self.assertEqual(kaoz.publishbot.utf8_split(b"\xc3\xa9", 1), [])
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+import kaoz.profiling
+import os
+import shutil
+import tempfile
+import threading
+
+from .common import unittest, configure_logger
+
+configure_logger(kaoz.profiling.logger, 'WARNING')
+
+
+def busy_loop(event):
+    """Run until event is set"""
+    while not event.is_set():
+        sum(range(100))
+
+
+class ProfilingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = kaoz.profiling.Profiler(self.directory, top=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_profile(self):
+        event = threading.Event()
+        thread = threading.Thread(target=busy_loop, args=(event,),
+                                  name='busy')
+        thread.start()
+        try:
+            self.assertEqual(self.profiler.profile("start 10"),
+                             "OK, profiling for 10 seconds")
+            self.assertEqual(self.profiler.profile("start"),
+                             "Profiling is already running")
+            event.wait(0.2)
+        finally:
+            event.set()
+            thread.join()
+        lines = self.profiler.profile("stop").splitlines()
+        self.assertEqual(self.profiler.profile("stop"),
+                         "Profiling is not running")
+        self.assertTrue(lines[0].endswith(" seconds"))
+        self.assertTrue(any(" busy " in line for line in lines[1:]))
+
+        # The stacks are written in collapsed format
+        filenames = os.listdir(self.directory)
+        self.assertEqual(len(filenames), 1)
+        with open(os.path.join(self.directory, filenames[0])) as f:
+            stacks = f.read().splitlines()
+        self.assertTrue(any(stack.startswith("busy;") and
+                            "busy_loop (test_profiling.py:" in stack
+                            for stack in stacks))
+
+    def test_max_duration(self):
+        self.profiler.max_duration = 0
+        self.assertEqual(self.profiler.profile("start 10"),
+                         "OK, profiling for 0 seconds")
+        self.assertTrue(self.profiler.profile("stop").startswith("0 samples"))
+
+    @unittest.skipUnless(kaoz.profiling.has_tracemalloc,
+                         "tracemalloc is not available")
+    def test_tracemalloc(self):
+        self.assertEqual(self.profiler.tracemalloc("snapshot"),
+                         "Tracing is not started")
+        self.assertEqual(self.profiler.tracemalloc("start"), "OK")
+        try:
+            data = [bytearray(1000) for i in range(100)]  # noqa
+            lines = self.profiler.tracemalloc("snapshot").splitlines()
+        finally:
+            self.assertEqual(self.profiler.tracemalloc("stop"), "OK")
+        self.assertTrue(lines[0].startswith("Snapshot written to "))
+        self.assertTrue(any("test_profiling.py" in line
+                            for line in lines[1:]))
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    @unittest.skipUnless(kaoz.profiling.has_tracemalloc,
+                         "tracemalloc is not available")
+    def test_tracemalloc_unwritable(self):
+        self.profiler.directory = os.path.join(self.directory, 'missing')
+        self.assertEqual(self.profiler.tracemalloc("start"), "OK")
+        try:
+            lines = self.profiler.tracemalloc("snapshot").splitlines()
+        finally:
+            self.assertEqual(self.profiler.tracemalloc("stop"), "OK")
+        self.assertTrue(lines[0].startswith("Unable to write snapshot to "))
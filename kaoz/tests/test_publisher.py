@@ -4,7 +4,9 @@
 
 from .common import unittest, get_local_conf, spawn_ircserver
 from .common import configure_ircserver_log, configure_logger
+import irc.client
 import kaoz.publishbot
+import time
 
 configure_ircserver_log('INFO')
 configure_logger(kaoz.publishbot.logger, 'DEBUG')
@@ -86,6 +88,16 @@ class PublisherTestCase(unittest.TestCase):
             self.assertEqual(message.channel, u('#ch\xe0n1'))
             self.assertEqual(message.text, text)
 
+    def test_send_lines(self):
+        with kaoz.publishbot.PublisherThread(self.config) as pub:
+            msgids = pub.send_lines(["#chan1:First", "invalid", "#chan1:Last"])
+            self.assertTrue(msgids[1] is None, "invalid line was accepted")
+            for (msgid, text) in [(msgids[0], "First"), (msgids[2], "Last")]:
+                self.assertFalse(pub.status(msgid) is None)
+                message = self.ircsrv.get_displayed_message(10)
+                self.assertFalse(message is None, "unable to display message")
+                self.assertEqual(message.text, text)
+
     def test_unjoinable_chan(self):
         private_message = "Message for a chan the bot can't join"
         public_message = "Message for a chan where the bot is allowed"
@@ -108,6 +120,436 @@ class PublisherTestCase(unittest.TestCase):
             # Check the list of channels
             self.assertEqual(pub.channels(), ['#fallback', '#public-chan'])
 
+    def test_reconnection(self):
+        # Periodic reconnection must not be needed
+        self.config.set('irc', 'reconnection_interval', '60')
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            pub.connect()
+            for num_processings in range(20):
+                if pub.is_connected():
+                    break
+                pub.reactor.process_once(0.5)
+            self.assertTrue(pub.is_connected(), "connect times out")
+
+            pub.connection.disconnect()
+            self.assertFalse(pub.is_connected())
+            for num_processings in range(20):
+                if pub.is_connected():
+                    break
+                pub.reactor.process_once(0.5)
+            self.assertTrue(pub.is_connected(), "reconnect times out")
+            self.assertEqual(pub.stats()['reconnections'], 1)
+        finally:
+            pub.stop()
+
+    def test_alternate_servers(self):
+        self.config.set('irc', 'alternate_servers', 'irc2.example.org:7000')
+        pub = kaoz.publishbot.Publisher(self.config)
+        pub._next_server()
+        self.assertEqual((pub._server, pub._port), ('irc2.example.org', 7000))
+        pub._next_server()
+        self.assertEqual((pub._server, pub._port), ('localhost', 6667))
+        pub.stop()
+
+    def test_message_status(self):
+        with kaoz.publishbot.PublisherThread(self.config) as pub:
+            msgid = pub.send_line("#chan1:Tracked message")
+            self.assertEqual(pub.status(msgid).state, 'queued')
+            message = self.ircsrv.get_displayed_message(10)
+            self.assertFalse(message is None, "unable to display a message")
+            for num_checks in range(10):
+                if pub.status(msgid).state != 'queued':
+                    break
+                time.sleep(0.1)
+            self.assertEqual(pub.status(msgid).state, 'sent')
+
+            # Too long channel names are dropped at once
+            msgid = pub.send('#' + 'a' * 200, "Dropped message")
+            self.assertEqual(pub.status(msgid).state, 'dropped')
+            self.assertTrue(pub.status('unknown') is None)
+
+    def test_latency(self):
+        with kaoz.publishbot.PublisherThread(self.config) as pub:
+            pub.send_lines(["#chan1:First", "#chan2:Second"])
+            for num_messages in range(2):
+                message = self.ircsrv.get_displayed_message(10)
+                self.assertFalse(message is None, "unable to display message")
+            for num_checks in range(10):
+                if pub.latency()['total_count'] == 2:
+                    break
+                time.sleep(0.1)
+            latency = pub.latency()
+            self.assertEqual(latency['total_count'], 2)
+            self.assertEqual(latency['join_count'], 2)
+            # The second line waited at least one line_sleep for its turn
+            self.assertTrue(float(latency['total_p99']) >= 1)
+            self.assertEqual(pub.latency('#CHAN1')['total_count'], 1)
+            self.assertTrue(pub.latency('#chan3') is None)
+            self.assertEqual(sorted(pub.latency_channels()),
+                             [('#chan1', 1), ('#chan2', 1)])
+
+    def test_schedule(self):
+        self.config.set('schedules', 'hello', 'every 1 #chan1 Recurring')
+        with kaoz.publishbot.PublisherThread(self.config) as pub:
+            schedid = pub.schedule("in 1 #chan2 Once")
+            self.assertRaises(ValueError, pub.schedule, "in 1 #chan2")
+            displayed = set()
+            for num_messages in range(3):
+                message = self.ircsrv.get_displayed_message(10)
+                self.assertFalse(message is None, "unable to display message")
+                displayed.add((message.channel, message.text))
+            self.assertTrue(('#chan2', "Once") in displayed)
+            self.assertTrue(('#chan1', "Recurring") in displayed)
+            self.assertFalse(pub.cancel_schedule(schedid))
+            self.assertTrue(pub.cancel_schedule('hello'))
+            self.assertEqual(pub.stats()['schedules'], 0)
+
+    def test_reload_schedules(self):
+        self.config.set('schedules', 'once', 'in 1 #chan Once')
+        self.config.set('schedules', 'past', 'at 1000 #chan Past')
+        self.config.set('schedules', 'hourly', 'every 1h #chan Hourly')
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            self.assertEqual(pub.stats()['schedules'], 2)
+            time.sleep(1.1)
+            pub._send_schedules(pub._schedule_timer_at)
+            self.assertEqual(pub.stats()['messages_scheduled'], 1)
+            hourly = pub._scheduler.next_time()
+            for num_reloads in range(3):
+                pub.reload(self.config)
+                self.assertEqual(pub.stats()['schedules'], 1)
+            pub._send_schedules(pub._schedule_timer_at)
+            self.assertEqual(pub.stats()['messages_scheduled'], 1)
+            # Unchanged recurring schedules keep their times
+            self.assertEqual(pub._scheduler.next_time(), hourly)
+            self.config.set('schedules', 'once', 'in 2 #chan Once again')
+            self.config.remove_option('schedules', 'hourly')
+            pub.reload(self.config)
+            self.assertEqual(pub.stats()['schedules'], 1)
+            self.assertFalse(pub.cancel_schedule('hourly'))
+        finally:
+            pub.stop()
+
+    def test_adaptive_rate(self):
+        self.config.set('irc', 'adaptive_rate', 'true')
+        self.config.set('irc', 'rate_increase', '1')
+        pub = kaoz.publishbot.Publisher(self.config)
+
+        def pong(rtt):
+            pub._ping_sent = time.time() - rtt
+            pub._ping_token = 'token'
+            pub.on_pong(None, irc.client.Event('pong', 'irc.localdomain',
+                                               'irc.localdomain', ['token']))
+
+        try:
+            self.assertEqual(pub.stats()['send_rate'], 1)
+            # The rate only increases while lines are waiting
+            pong(0.01)
+            self.assertEqual(pub.stats()['send_rate'], 1)
+            pub.send('#chan', "Waiting")
+            pong(0.01)
+            self.assertEqual(pub.stats()['send_rate'], 2)
+            # min_line_sleep is 0.5
+            pong(0.01)
+            self.assertEqual(pub.stats()['send_rate'], 2)
+            pong(1)
+            self.assertEqual(pub.stats()['send_rate'], 1)
+            self.assertEqual(pub.stats()['rtt_seconds'], 1)
+            # The rate is halved at most once per rate_interval
+            pub.on_tryagain(None, None)
+            self.assertEqual(pub.stats()['send_rate'], 1)
+            for num_slowdowns in range(3):
+                pub._last_slowdown = 0
+                pub.on_tryagain(None, None)
+            # max_line_sleep is 4
+            self.assertEqual(pub.stats()['send_rate'], 0.25)
+            self.assertEqual(pub.stats()['rate_decreases'], 4)
+            # Only notices about flooding are congestion
+            pub._last_slowdown = 0
+            pub._line_sleep = 1
+            pub.on_privnotice(None, irc.client.Event(
+                'privnotice', 'irc.localdomain', 'KaozTest',
+                ["*** Looking up your hostname"]))
+            self.assertEqual(pub.stats()['send_rate'], 1)
+            pub.on_privnotice(None, irc.client.Event(
+                'privnotice', 'irc.localdomain', 'KaozTest',
+                ["*** Message throttled due to flooding"]))
+            self.assertEqual(pub.stats()['send_rate'], 0.5)
+        finally:
+            pub.stop()
+
+    def test_auto_replies(self):
+        self.config.set('irc', 'reply_burst', '2')
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            source = irc.client.NickMask('user!user@example.org')
+            event = irc.client.Event('privmsg', source, 'KaozTest', ["Hi"])
+            for num_messages in range(3):
+                pub.on_privmsg(None, event)
+            # Only one reply is queued, and the second one is dropped for
+            # being the same, the third one for exceeding the budget
+            self.assertEqual(len(pub._replies), 1)
+            self.assertEqual(pub.stats()['replies_dropped'], 2)
+            # Waiting messages come first
+            pub.send('#chan', "Alert")
+            pub._say_messages()
+            self.assertEqual(len(pub._replies), 0)
+            self.assertEqual(pub.stats()['replies_dropped'], 3)
+            pub.on_privmsg(None, event)
+            self.assertEqual(pub.stats()['replies_dropped'], 4)
+        finally:
+            pub.stop()
+
+    def test_message_ttl(self):
+        self.config.set('irc', 'message_ttl', '60')
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            stale_ids = [pub.send('#chan', "Stale %d" % i) for i in range(2)]
+            # This one is split into several lines
+            stale_ids.append(pub.send('#chan', "Long " * 200))
+            fresh_id = pub.send('#chan', "Fresh")
+            # Make the first messages older
+            pub._queue = [
+                (channel, message, msgid,
+                 created - 120 if msgid in stale_ids else created)
+                for (channel, message, msgid, created) in pub._queue]
+            # Dequeue messages without being connected
+            pub._say_messages()
+            chanstatus = pub._chans['#chan']
+
+            pub._expire_lines(chanstatus)
+            self.assertEqual([line.text for line in chanstatus.messages],
+                             ["3 messages expired", "Fresh"])
+            self.assertEqual(pub.status(stale_ids[0]).state, 'expired')
+            self.assertEqual(pub.status(fresh_id).state, 'queued')
+            self.assertEqual(pub.stats()['lines_expired'], 5)
+            self.assertEqual(pub.stats()['backlog'], 2)
+
+            # The summary doesn't hold back the next expired lines
+            pub._message_ttl = -1
+            pub._expire_lines(chanstatus)
+            self.assertEqual([line.text for line in chanstatus.messages],
+                             ["4 messages expired"])
+            self.assertEqual(pub.status(fresh_id).state, 'expired')
+            self.assertEqual(pub.stats()['lines_expired'], 6)
+            self.assertEqual(pub.stats()['backlog'], 1)
+            self.assertEqual(pub.stats()['backlog_bytes'], 18)
+        finally:
+            pub.stop()
+
+    def test_digest(self):
+        self.config.set('irc', 'digest_threshold', '2')
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            for i in range(5):
+                pub.send('#chan', "Event %d" % i)
+            pub._say_messages()
+            chanstatus = pub._chans['#chan']
+            self.assertEqual([line.text for line in chanstatus.messages],
+                             ["Event 0", "Event 1"])
+            self.assertEqual(pub.stats()['messages_digested'], 3)
+
+            # Summary is queued, the backlog is still too long
+            pub._flush_digests()
+            self.assertEqual([line.text for line in chanstatus.messages],
+                             ["Event 0", "Event 1", "[digest] 3 x Event N"])
+            self.assertFalse(chanstatus.digest is None)
+
+            # Once the backlog cleared, messages are queued again
+            chanstatus.messages.clear()
+            pub._flush_digests()
+            self.assertTrue(chanstatus.digest is None)
+            pub.send('#chan', "Event 5")
+            pub._say_messages()
+            self.assertEqual([line.text for line in chanstatus.messages],
+                             ["Event 5"])
+        finally:
+            pub.stop()
+
+    def test_digest_threshold_one(self):
+        self.config.set('irc', 'digest_threshold', '1')
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            for i in range(3):
+                pub.send('#chan', "Event %d" % i)
+            pub._say_messages()
+            chanstatus = pub._chans['#chan']
+            self.assertFalse(chanstatus.digest is None)
+            chanstatus.messages.clear()
+            pub._flush_digests()
+            self.assertTrue(chanstatus.digest is None)
+        finally:
+            pub.stop()
+
+    def test_chanlimit(self):
+        # Emulate a server which only lets us join one channel
+        self.ircsrv.stop()
+        self.ircsrv = spawn_ircserver(self.config, chanlimit=1)
+        with kaoz.publishbot.PublisherThread(self.config) as pub:
+            pub.send('#first', "One")
+            message = self.ircsrv.get_displayed_message(10)
+            self.assertFalse(message is None, "unable to display message")
+            self.assertEqual(message.channel, '#first')
+
+            # The idle channel is left to join the new one
+            pub.send('#second', "Two")
+            message = self.ircsrv.get_displayed_message(10)
+            self.assertFalse(message is None, "unable to display message")
+            self.assertEqual(message.channel, '#second')
+            self.assertEqual(pub.channels(), ['#second'])
+            stats = pub.stats()
+            self.assertEqual(stats['channels_parted'], 1)
+            self.assertEqual(stats.get('messages_dropped', 0), 0)
+
+    def test_max_channels(self):
+        self.config.set('irc', 'max_channels', '2')
+        with kaoz.publishbot.PublisherThread(self.config) as pub:
+            pub.send('#idle', "Said")
+            message = self.ircsrv.get_displayed_message(10)
+            self.assertFalse(message is None, "unable to display message")
+
+            # The idle channel is forgotten for the new one, then every
+            # channel has messages waiting
+            msgids = pub.send_many([('#busy', "Waiting"), ('#new', "Hello"),
+                                    ('#other', "Rejected")])
+            for num_checks in range(20):
+                if pub.stats().get('messages_rejected'):
+                    break
+                time.sleep(0.1)
+            self.assertEqual(pub.status(msgids[2]).state, 'dropped')
+            stats = pub.stats()
+            self.assertEqual(stats['channels_evicted'], 1)
+            self.assertEqual(stats['messages_rejected'], 1)
+            self.assertEqual(stats['channels'], 2)
+            for num_messages in range(2):
+                message = self.ircsrv.get_displayed_message(10)
+                self.assertFalse(message is None, "unable to display message")
+                self.assertTrue(message.channel in ('#busy', '#new'))
+
+    def test_evict_idle_channel(self):
+        self.config.set('irc', 'max_channels', '10')
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            # The least recently used channels are busy, and the most recent
+            # one is left idle by an empty message
+            pub.send_many([('#busy%d' % i, "Waiting") for i in range(9)])
+            pub.send('#idle', "")
+            pub._say_messages()
+            msgid = pub.send('#new', "Hello")
+            pub._say_messages()
+            self.assertEqual(pub.status(msgid).state, 'queued')
+            self.assertFalse('#idle' in pub._chans, "#idle was not evicted")
+            stats = pub.stats()
+            self.assertEqual(stats['channels_evicted'], 1)
+            self.assertEqual(stats.get('messages_rejected', 0), 0)
+        finally:
+            pub.stop()
+
+    def test_payload(self):
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            pub._source = 'Tester!tester@127.0.0.1'
+            pub.send('#chan', 'x' * 1000)
+            pub._say_messages()
+            lines = pub._chans['#chan'].messages
+            # ':Tester!tester@127.0.0.1 PRIVMSG #chan :' takes 40 bytes
+            self.assertEqual([len(line.text) for line in lines],
+                             [470, 470, 60])
+        finally:
+            pub.stop()
+
+    def test_max_queued_bytes(self):
+        self.config.set('irc', 'max_queued_bytes', '10')
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            accents = b"\xc3\xa9\xc3\xa9".decode('utf-8')
+            msgids = pub.send_many([('#chan', "12345"), ('#chan', "123456"),
+                                    ('#chan', accents)])
+            self.assertEqual([pub.status(msgid).state for msgid in msgids],
+                             ['queued', 'dropped', 'queued'])
+            self.assertEqual(pub.stats()['backlog_bytes'], 9)
+            self.assertEqual(pub.stats()['messages_rejected'], 1)
+        finally:
+            pub.stop()
+
+    def test_routing(self):
+        self.config.set('routing', 'noise', 'message:^DEBUG -> drop')
+        self.config.set('routing', 'copy', 'source:10.* -> copy #audit')
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            msgids = pub.send_many([('#chan', "DEBUG x"), ('#chan', "Hello")],
+                                   '10.0.0.1')
+            pub._say_messages()
+            self.assertEqual(pub.status(msgids[0]).state, 'dropped')
+            self.assertEqual(pub.status(msgids[1]).parts, 2)
+            self.assertEqual(sorted(pub._chans), ['#audit', '#chan'])
+            self.assertEqual(pub.stats()['messages_filtered'], 1)
+            self.assertEqual(pub.stats()['backlog'], 2)
+        finally:
+            pub.stop()
+
+    def test_routing_dropped_copy(self):
+        self.config.set('routing', 'long', 'channel:#chan -> copy #' +
+                        'x' * 200)
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            msgid = pub.send('#chan', "Hello")
+            # The copy on the channel whose name is too long is dropped, but
+            # not the message
+            status = pub.status(msgid)
+            self.assertEqual((status.state, status.parts), ('queued', 1))
+            self.assertEqual(pub.stats()['messages_dropped'], 1)
+            pub._messages.part_sent(msgid)
+            self.assertEqual(pub.status(msgid).state, 'sent')
+        finally:
+            pub.stop()
+
+    def test_reload(self):
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            new_config = get_local_conf()
+            new_config.set('irc', 'line_sleep', '2.5')
+            new_config.set('irc', 'fallback_channel', '#other-fallback')
+            new_config.set('irc', 'nickname', 'Renamed')
+            self.assertEqual(pub.reload(new_config), ['irc.nickname'])
+            self.assertEqual(pub._line_sleep, 2.5)
+            self.assertEqual(pub._fallbackchan, '#other-fallback')
+        finally:
+            pub.stop()
+
+    def test_drain(self):
+        self.config.set('irc', 'line_sleep', '5')
+        self.config.set('irc', 'drain_line_sleep', '0.2')
+        with kaoz.publishbot.PublisherThread(self.config) as pub:
+            for i in range(3):
+                pub.send('#chan', "Message %d" % i)
+            self.assertEqual(pub.drain(10), 0)
+            for i in range(3):
+                message = self.ircsrv.get_displayed_message(1)
+                self.assertFalse(message is None, "message was not drained")
+                self.assertEqual(message.text, "Message %d" % i)
+
+    def test_drain_faster(self):
+        self.config.set('irc', 'line_sleep', '0.1')
+        pub = kaoz.publishbot.Publisher(self.config)
+        try:
+            # Draining never slows down
+            pub.drain(0)
+            self.assertEqual(pub._line_sleep, 0.1)
+        finally:
+            pub.stop()
+
+    def test_waiting_lines(self):
+        pub = kaoz.publishbot.Publisher(self.config)
+        pub.send('#chan1', "First")
+        pub._say_messages()
+        pub.send('#chan2', "Second")
+        self.assertEqual(pub.drain(0), 2)
+        pub.stop()
+        self.assertEqual(pub.waiting_lines(),
+                         [('#chan1', "First"), ('#chan2', "Second")])
+
     def test_long_message(self):
         bytes_message = b"Long message: " + (b"\xc3\xa9" * 1000)
         long_message = bytes_message.decode('utf-8')
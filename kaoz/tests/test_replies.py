@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+import kaoz.replies
+
+from .common import unittest
+
+
+class ReplyQueueTestCase(unittest.TestCase):
+
+    def test_budget(self):
+        replies = kaoz.replies.ReplyQueue(burst=2, interval=60)
+        self.assertTrue(replies.add('host1', 'privmsg', 'nick1', "1", now=0))
+        self.assertTrue(replies.add('host1', 'privmsg', 'nick1', "2", now=0))
+        self.assertFalse(replies.add('host1', 'privmsg', 'nick1', "3", now=0))
+        # Other senders have their own budget
+        self.assertTrue(replies.add('host2', 'privmsg', 'nick2', "1", now=0))
+        # One more reply every interval
+        self.assertFalse(replies.add('host1', 'privmsg', 'nick1', "3",
+                                     now=30))
+        self.assertTrue(replies.add('host1', 'privmsg', 'nick1', "3",
+                                    now=60))
+        self.assertEqual(len(replies), 4)
+        self.assertEqual(replies.pop(), ('privmsg', 'nick1', "1"))
+        self.assertEqual(replies.clear(), 3)
+        self.assertTrue(replies.pop() is None)
+
+    def test_dedup(self):
+        replies = kaoz.replies.ReplyQueue(size=2)
+        self.assertTrue(replies.add('host1', 'notice', 'nick1', "Hi"))
+        self.assertFalse(replies.add('host2', 'notice', 'nick1', "Hi"))
+        self.assertTrue(replies.add('host2', 'notice', 'nick2', "Hi"))
+        # The queue is full
+        self.assertFalse(replies.add('host3', 'notice', 'nick3', "Hi"))
+        self.assertEqual(len(replies), 2)
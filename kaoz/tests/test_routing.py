@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+import kaoz.routing
+
+from .common import unittest
+
+
+class RouterTestCase(unittest.TestCase):
+
+    def test_route(self):
+        router = kaoz.routing.Router([
+            kaoz.routing.Rule('debug', r'channel:#prod-* message:^DEBUG\s'
+                                       r' -> drop'),
+            kaoz.routing.Rule('alerts', 'source:10.0.* message:CRITICAL'
+                                        ' -> copy #oncall #ops'),
+            kaoz.routing.Rule('legacy', 'channel:#Old -> to #new'),
+        ])
+        self.assertEqual(router.route(None, '#prod-web', "DEBUG x=1"), [])
+        self.assertEqual(router.route(None, '#dev', "DEBUG x=1"), ['#dev'])
+        self.assertEqual(router.route('10.0.0.1', '#prod-web', "CRITICAL"),
+                         ['#prod-web', '#oncall', '#ops'])
+        self.assertEqual(router.route('10.1.0.1', '#prod-web', "CRITICAL"),
+                         ['#prod-web'])
+        self.assertEqual(router.route(None, '#old', "Hello"), ['#new'])
+        # The first matching rule applies
+        self.assertEqual(router.route('10.0.0.1', '#old', "CRITICAL"),
+                         ['#old', '#oncall', '#ops'])
+
+    def test_mixed_rules(self):
+        router = kaoz.routing.Router([
+            kaoz.routing.Rule('first', 'message:^A -> to #first'),
+            kaoz.routing.Rule('second', 'message:^B -> to #second'),
+            kaoz.routing.Rule('audit', 'source:10.* -> copy #audit'),
+            kaoz.routing.Rule('third', 'message:^A -> to #third'),
+            kaoz.routing.Rule('fourth', 'message:^C -> to #fourth'),
+        ])
+        # Rules without a message condition keep their place in the order
+        self.assertEqual(router.route('10.0.0.1', '#chan', "A"), ['#first'])
+        self.assertEqual(router.route('10.0.0.1', '#chan', "C"),
+                         ['#chan', '#audit'])
+        self.assertEqual(router.route(None, '#chan', "B"), ['#second'])
+        self.assertEqual(router.route(None, '#chan', "C"), ['#fourth'])
+        self.assertEqual(router.route(None, '#chan', "D"), ['#chan'])
+        self.assertEqual([len(rules) for (merged, rules) in
+                          router._get_candidates('#chan')], [2, 1, 2])
+
+    def test_invalid_rules(self):
+        for rule in ('channel:#a', 'channel:#a -> to', 'any -> drop',
+                     'message:( -> drop', '-> drop #a', '-> forward #a'):
+            self.assertRaises(ValueError, kaoz.routing.Rule, 'rule', rule)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+import kaoz.schedule
+import os
+import shutil
+import tempfile
+
+from .common import unittest
+
+
+class ScheduleTestCase(unittest.TestCase):
+
+    def test_parse_schedule(self):
+        parse = kaoz.schedule.parse_schedule
+        self.assertEqual(parse("in 90 #chan Hello, world", now=1000),
+                         (1090, 0, '#chan', "Hello, world"))
+        self.assertEqual(parse("every 5m #chan Ping", now=1000),
+                         (1300, 300, '#chan', "Ping"))
+        self.assertEqual(parse("at 1500 #chan Later", now=1000),
+                         (1500, 0, '#chan', "Later"))
+        for value in ("in 0 #chan Hello", "in 1x #chan Hello",
+                      "every -1 #chan Hello", "at noon #chan Hello",
+                      "soon 1 #chan Hello", "in 1 #chan"):
+            self.assertRaises(ValueError, parse, value)
+        self.assertRaises(ValueError, parse, "at 900 #chan Past", now=1000)
+
+    def test_pop_due(self):
+        scheduler = kaoz.schedule.Scheduler()
+        scheduler.add(30, 0, '#chan', "Third")
+        first = scheduler.add(10, 0, '#chan', "First")
+        scheduler.add(20, 100, '#chan', "Every 100s")
+        cancelled = scheduler.add(15, 0, '#chan', "Cancelled")
+        self.assertTrue(scheduler.cancel(cancelled))
+        self.assertFalse(scheduler.cancel(cancelled))
+        self.assertEqual(scheduler.next_time(), 10)
+        self.assertEqual(scheduler.pop_due(now=25), [
+            ('#chan', "First"), ('#chan', "Every 100s")])
+        self.assertFalse(scheduler.cancel(first))
+        self.assertEqual(scheduler.next_time(), 30)
+        # Missed intervals are skipped
+        self.assertEqual(scheduler.pop_due(now=350), [
+            ('#chan', "Third"), ('#chan', "Every 100s")])
+        self.assertEqual(scheduler.next_time(), 420)
+        self.assertEqual(len(scheduler), 1)
+
+    def test_save(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'schedules')
+            scheduler = kaoz.schedule.Scheduler()
+            schedid = scheduler.add(10, 60, '#chan', "Saved")
+            scheduler.add(20, 0, '#chan', "Configured", 'conf', persist=False)
+            scheduler.save(filename)
+            scheduler = kaoz.schedule.Scheduler()
+            self.assertEqual(scheduler.load(filename), 1)
+            self.assertEqual(scheduler.pop_due(now=10), [('#chan', "Saved")])
+            self.assertTrue(scheduler.cancel(schedid))
+            with open(filename, 'w') as f:
+                f.write('[{"when": 10}]')
+            self.assertRaises(ValueError, scheduler.load, filename)
+        finally:
+            shutil.rmtree(tmpdir)
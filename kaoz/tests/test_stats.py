@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2011-2013 Binet Réseau
+# See the LICENCE file for more informations
+
+import kaoz.stats
+
+from .common import unittest
+
+
+class StatsTestCase(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = kaoz.stats.Histogram()
+        self.assertTrue(histogram.percentile(50) is None)
+        for i in range(1, 101):
+            histogram.add(i / 100.0)
+        histogram.add(0)
+        histogram.add(1e9)
+        self.assertEqual(histogram.count, 102)
+        self.assertEqual(histogram.percentile(0), 0.001)
+        # Percentiles are upper bounds, within the growth of buckets
+        for (p, value) in [(50, 0.5), (90, 0.9)]:
+            self.assertTrue(value <= histogram.percentile(p) <
+                            value * histogram.growth)
+        # Longer durations fall into the last bucket
+        self.assertTrue(histogram.percentile(100) > 3600)
+
+    def test_latency(self):
+        latency = kaoz.stats.Latency(('wait', 'total'), max_channels=2)
+        for i in range(3):
+            latency.add('#a', '#A', (0.1, 0.2))
+        latency.add('#b', '#b', (0.1, 0.2))
+        # The least busy channel is forgotten, its count is inherited
+        latency.add('#c', '#c', (1, 2))
+        self.assertEqual(latency.top(), [('#A', 3), ('#c', 2)])
+        self.assertTrue(latency.report('#b') is None)
+        report = latency.report('#c')
+        self.assertEqual(report['total_count'], 1)
+        self.assertTrue(2 <= float(report['total_p50']) < 2.5)
+        report = latency.report()
+        self.assertEqual(report['wait_count'], 5)
+        self.assertTrue(0.1 <= float(report['wait_p50']) < 0.125)
+        self.assertTrue(2 <= float(report['total_p99']) < 2.5)
@@ -41,6 +41,7 @@ setup(
     ],
     scripts=[
         'bin/kaoz',
+        'bin/kaoz-loadgen',
     ],
     classifiers=[
         'Development Status :: 4 - Beta',